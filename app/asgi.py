@@ -0,0 +1,19 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+ASGI entry point.
+
+Serve it with an ASGI server like uvicorn::
+
+    uvicorn app.asgi:asgi_app
+
+This requires httpx and an ASGI server to be installed.
+"""
+
+from app.libasgi import AsgiApp
+from app.main import create_app
+from app.settings import settings
+
+asgi_app = AsgiApp(create_app(), threads=settings.APP_ASGI_THREADS)
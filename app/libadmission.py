@@ -0,0 +1,179 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Admission control for the WSGI app.
+
+Requests are sorted into route classes by endpoint. Each limited class lets a
+number of requests run at once and a number more wait a short while for a slot.
+Requests past that get a ``503`` with ``Retry-After`` straight away instead of
+tying up a server thread until the load balancer gives up on them.
+"""
+
+import json
+import threading
+import time
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import ClosingIterator
+
+from app.observability import ADMISSION_IN_FLIGHT, ADMISSION_QUEUED, ADMISSION_SHED
+from app.settings import settings
+
+# Route class of each endpoint; endpoints that aren't listed are "default"
+ROUTE_CLASSES = {
+    # NOTE(willkg): the load balancer and deploy tooling use these, so they're
+    # never shed
+    "dockerflow_lbheartbeat": "exempt",
+    "dockerflow_version": "exempt",
+    # Routes that wait on environment hosts and GitHub
+    "api_overview": "upstream",
+    "api_system": "upstream",
+    "api_systems": "upstream",
+    "overview_page": "upstream",
+    "system_page": "upstream",
+    # Routes that wait on the CPU pool
+    "cpu_intensive_page": "cpu",
+}
+
+
+class RouteClassLimit:
+    """Limits requests in flight for a route class with a bounded wait for a slot
+
+    :arg name: the route class name
+    :arg concurrency: most requests in flight; None for no limit
+    :arg max_queue: most requests waiting for a slot
+    :arg queue_timeout: most seconds a request waits for a slot
+
+    """
+
+    def __init__(self, name, concurrency, max_queue=0, queue_timeout=0):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def _shed(self, reason):
+        self.shed += 1
+        ADMISSION_SHED.inc(route_class=self.name, reason=reason)
+        return False
+
+    def _admit(self):
+        self.in_flight += 1
+        self.admitted += 1
+        ADMISSION_IN_FLIGHT.inc(route_class=self.name)
+        return True
+
+    def acquire(self):
+        """Returns True if the request is admitted and False if it's shed"""
+        with self._cond:
+            if self.concurrency is None or (
+                self.in_flight < self.concurrency and self.queued == 0
+            ):
+                return self._admit()
+            if self.queued >= self.max_queue:
+                return self._shed("queue_full")
+
+            self.queued += 1
+            ADMISSION_QUEUED.inc(route_class=self.name)
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.in_flight >= self.concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return self._shed("queue_timeout")
+                    self._cond.wait(remaining)
+                return self._admit()
+            finally:
+                self.queued -= 1
+                ADMISSION_QUEUED.dec(route_class=self.name)
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+        ADMISSION_IN_FLIGHT.dec(route_class=self.name)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "concurrency": self.concurrency,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "admitted": self.admitted,
+                "shed": self.shed,
+            }
+
+
+def default_limits():
+    """Returns dict of route class -> RouteClassLimit built from settings"""
+    return {
+        "exempt": RouteClassLimit("exempt", concurrency=None),
+        "default": RouteClassLimit("default", concurrency=None),
+        "upstream": RouteClassLimit(
+            "upstream",
+            concurrency=settings.APP_ADMISSION_UPSTREAM_CONCURRENCY,
+            max_queue=settings.APP_ADMISSION_MAX_QUEUE,
+            queue_timeout=settings.APP_ADMISSION_QUEUE_TIMEOUT,
+        ),
+        "cpu": RouteClassLimit(
+            "cpu",
+            concurrency=settings.APP_ADMISSION_CPU_CONCURRENCY,
+            max_queue=settings.APP_ADMISSION_MAX_QUEUE,
+            queue_timeout=settings.APP_ADMISSION_QUEUE_TIMEOUT,
+        ),
+    }
+
+
+class AdmissionMiddleware:
+    """WSGI middleware that admits or sheds requests by route class
+
+    A request holds its slot until its response has been sent, so streamed
+    responses count until they're done.
+
+    :arg app: the Flask app
+    :arg limits: dict of route class -> RouteClassLimit; see default_limits
+
+    """
+
+    def __init__(self, app, limits=None):
+        self.app = app
+        self.limits = limits if limits is not None else default_limits()
+        # NOTE(willkg): this lets the stats page show the limits
+        app.extensions["admission"] = self
+
+    def route_class(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            # NOTE(willkg): not found, wrong method and redirects are cheap
+            return "default"
+        return ROUTE_CLASSES.get(endpoint, "default")
+
+    def __call__(self, environ, start_response):
+        limit = self.limits[self.route_class(environ)]
+        if not limit.acquire():
+            resp = Response(
+                json.dumps({"error": "server busy"}),
+                status=503,
+                mimetype="application/json",
+            )
+            resp.headers["Retry-After"] = "1"
+            return resp(environ, start_response)
+
+        try:
+            return ClosingIterator(self.app(environ, start_response), [limit.release])
+        except BaseException:
+            limit.release()
+            raise
+
+    def stats(self):
+        return {name: limit.stats() for name, limit in sorted(self.limits.items())}
@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import gzip
+import hashlib
+import json
+
+from flask import Response, request
+
+from app.observability import span
+
+
+def status_etag(systems_status):
+    """Computes a strong ETag for status data
+
+    The ETag covers what the status of an environment is derived from: the deployed
+    commit and tag and the head of ``main``. If none of those changed for any
+    environment, the data is the same. Commits are oldest first and merge commits
+    are left out, so the status, which has the number of commits behind, is
+    included too.
+
+    :arg systems_status: dict of system name -> list of service data dicts as
+        libstatus.get_system_data returns
+
+    :returns: ETag value without quotes
+
+    """
+    hasher = hashlib.sha256()
+    for system in sorted(systems_status):
+        hasher.update(f"system:{system}\n".encode())
+        for service in systems_status[system]:
+            hasher.update(f"service:{service['name']}\n".encode())
+            for env in service["environments"]:
+                # NOTE(willkg): environments that failed may not have a commit
+                commit = env.get("commit", "")
+                head = env["commits"][-1]["sha"] if env["commits"] else commit
+                line = "\t".join(
+                    [
+                        env["name"],
+                        env["host"],
+                        commit,
+                        env.get("tag", ""),
+                        env["status"],
+                        head,
+                    ]
+                )
+                hasher.update(f"{line}\n".encode())
+    return hasher.hexdigest()[:32]
+
+
+def json_status_response(data, etag, gzip_min_size):
+    """Builds a cacheable JSON response for the current request
+
+    Returns a 304 if the request's ``If-None-Match`` matches the ETag. Otherwise
+    returns the data as JSON, gzip-compressed if it's at least ``gzip_min_size``
+    bytes and the client accepts gzip.
+
+    :arg data: JSON-serializable data
+    :arg etag: ETag value from status_etag
+    :arg gzip_min_size: smallest body in bytes worth compressing
+
+    :returns: a flask Response
+
+    """
+    gzip_etag = f"{etag}-gzip"
+    for current_etag in (etag, gzip_etag):
+        if request.if_none_match.contains(current_etag):
+            resp = Response(status=304)
+            resp.set_etag(current_etag)
+            resp.headers["Cache-Control"] = "no-cache"
+            resp.vary.add("Accept-Encoding")
+            return resp
+
+    compress = "gzip" in request.accept_encodings
+    with span("serialize"):
+        body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        compress = compress and len(body) >= gzip_min_size
+        if compress:
+            body = gzip.compress(body)
+
+    resp = Response(body, status=200, mimetype="application/json")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.vary.add("Accept-Encoding")
+
+    if compress:
+        resp.headers["Content-Encoding"] = "gzip"
+        # NOTE(willkg): strong ETags are per representation, so the compressed one
+        # gets its own
+        resp.set_etag(gzip_etag)
+    else:
+        resp.set_etag(etag)
+    return resp
@@ -0,0 +1,293 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+ASGI serving mode: async views for routes that wait on upstreams and the Flask
+app's WSGI interface in a thread pool for everything else.
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import sys
+
+import requests
+from flask import abort, jsonify, render_template
+from werkzeug.exceptions import HTTPException
+
+from app import libasync, main
+from app.libapi import json_status_response, status_etag
+from app.libdeadline import Deadline
+from app.libstatus import summarize_overview
+from app.observability import span
+
+
+def build_environ(scope, body):
+    """Returns a WSGI environ for an ASGI http scope"""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """Calls a WSGI app and returns ``(status, headers, body)``"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], body
+
+
+def load_systems():
+    with span("config"):
+        return main.get_systems_data()
+
+
+def request_deadline(app):
+    return Deadline(app.config["APP_REQUEST_DEADLINE"])
+
+
+async def get_system_status(app, system, deadline):
+    """Returns ``(data, snapshot_age)`` for a system like main's get_system_status"""
+    snapshot = main.get_snapshot_system_data(app, system)
+    if snapshot is not None:
+        return snapshot
+    return await libasync.get_system_data(system, deadline=deadline), None
+
+
+async def get_overview_status(app, systems_data, deadline):
+    """Returns ``(overview, snapshot_age)`` like main's get_overview_status"""
+    snapshot = main.get_snapshot_overview_data(app, systems_data)
+    if snapshot is not None:
+        return snapshot
+    return await libasync.get_overview_data(systems_data, deadline=deadline), None
+
+
+def api_response(app, data, systems_status):
+    return json_status_response(
+        data,
+        etag=status_etag(systems_status),
+        gzip_min_size=app.config["APP_API_GZIP_MIN_SIZE"],
+    )
+
+
+async def dockerflow_heartbeat(app):
+    resp = await libasync.ASYNC_HTTP_CLIENT.get(main.GITHUB_STATUS_URL)
+    if resp.status_code != 200:
+        return jsonify(main.heartbeat_data(app, resp.status_code)), 500
+    data = resp.json()
+    if data["status"]["indicator"] != "none":
+        return jsonify(main.heartbeat_data(app, data["status"]["indicator"])), 500
+    return jsonify(main.heartbeat_data(app, "ok")), 200
+
+
+async def system_page(app, system):
+    # NOTE(willkg): pages aren't streamed since waiting on upstreams doesn't hold a
+    # thread here
+    systems_data = load_systems()
+    if system not in systems_data.systems:
+        abort(404)
+
+    data, snapshot_age = await get_system_status(
+        app, systems_data.systems[system], request_deadline(app)
+    )
+    with span("render"):
+        return render_template(
+            "system.html", system=system, data=data, snapshot_age=snapshot_age
+        )
+
+
+async def overview_page(app):
+    overview, snapshot_age = await get_overview_status(
+        app, load_systems(), request_deadline(app)
+    )
+    with span("render"):
+        return render_template(
+            "overview.html",
+            overview=overview,
+            summary=summarize_overview(overview),
+            snapshot_age=snapshot_age,
+        )
+
+
+async def api_systems(app):
+    systems_status, _ = await get_overview_status(
+        app, load_systems(), request_deadline(app)
+    )
+    return api_response(app, systems_status, systems_status)
+
+
+async def api_overview(app):
+    systems_status, _ = await get_overview_status(
+        app, load_systems(), request_deadline(app)
+    )
+    data = {
+        "summary": summarize_overview(systems_status),
+        "systems": systems_status,
+    }
+    return api_response(app, data, systems_status)
+
+
+async def api_system(app, system):
+    systems_data = load_systems()
+    if system not in systems_data.systems:
+        return jsonify({"error": f"unknown system {system}"}), 404
+
+    data, _ = await get_system_status(
+        app, systems_data.systems[system], request_deadline(app)
+    )
+    return api_response(app, data, {system: data})
+
+
+# Endpoints of the Flask app that are served by async views; the views take the
+# Flask app and the endpoint's view arguments
+ASYNC_VIEWS = {
+    "api_overview": api_overview,
+    "api_system": api_system,
+    "api_systems": api_systems,
+    "dockerflow_heartbeat": dockerflow_heartbeat,
+    "overview_page": overview_page,
+    "system_page": system_page,
+}
+
+
+class AsgiApp:
+    """Serves the Flask app over ASGI
+
+    Routes that wait on upstreams, the system pages, the API and the heartbeat,
+    are served by async views that wait on the network without holding a thread.
+    They run with the Flask app's request context and request hooks, so templates,
+    metrics and timing work like they do for Flask views.
+
+    Every other route goes through the Flask app's WSGI interface in a thread pool,
+    so cheap routes like ``/__lbheartbeat__`` never wait behind slow ones.
+
+    :arg app: the Flask app
+    :arg threads: number of threads for routes that aren't async
+
+    """
+
+    def __init__(self, app, threads):
+        self.app = app
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="asgi"
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise ValueError(f"unsupported scope type {scope['type']}")
+
+        body = await self.read_body(receive)
+        environ = build_environ(scope, body)
+
+        view = None
+        try:
+            endpoint, view_args = self.app.url_map.bind_to_environ(environ).match()
+            view = ASYNC_VIEWS.get(endpoint)
+        except HTTPException:
+            # NOTE(willkg): the Flask app handles 404s, 405s and redirects
+            pass
+
+        if view is not None:
+            response = await self.dispatch_async(environ, view, view_args)
+            try:
+                status = response.status_code
+                headers = response.headers.to_wsgi_list()
+                body = response.get_data()
+            finally:
+                response.close()
+        else:
+            loop = asyncio.get_running_loop()
+            status, headers, body = await loop.run_in_executor(
+                self.executor, call_wsgi, self.app.wsgi_app, environ
+            )
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def dispatch_async(self, environ, view, view_args):
+        """Runs an async view like Flask's full_dispatch_request runs a view"""
+        app = self.app
+        with app.request_context(environ):
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    rv = await view(app, **view_args)
+            except HTTPException as exc:
+                rv = app.handle_user_exception(exc)
+            except requests.exceptions.RequestException as exc:
+                # NOTE(willkg): upstream failures are 500s like they are when the
+                # Flask app raises them
+                return app.handle_exception(exc)
+            return app.finalize_request(rv)
+
+    @staticmethod
+    async def read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await libasync.ASYNC_HTTP_CLIENT.close()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
@@ -0,0 +1,453 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Async versions of the upstream fetches for the ASGI app.
+
+These share caches, circuit breakers, rate limits and metrics with the
+synchronous versions; only waiting on the network is different.
+"""
+
+import asyncio
+import contextlib
+import functools
+import json
+import time
+from urllib.parse import urlparse
+
+import requests
+import stamina
+from requests.structures import CaseInsensitiveDict
+
+from app import libgithub
+from app.libdeadline import (
+    check_deadline,
+    clamp_timeout,
+    is_retryable,
+    use_deadline,
+)
+from app.libgithub import (
+    GITHUB_CACHE,
+    REST_RATE_LIMIT,
+    compact_commits,
+    compact_compare,
+    get_history_planner,
+    history_from_commits,
+    load_commits,
+    load_history,
+)
+from app.libhttp import github_headers
+from app.libratelimit import RateLimited
+from app.libstatus import (
+    add_history,
+    iter_services,
+    make_version_data,
+    overview_from_results,
+    system_environments,
+)
+from app.libupstream import BREAKERS, VERSION_CACHE, fetch
+from app.observability import UPSTREAM_DURATION, UPSTREAM_IN_FLIGHT, span
+from app.settings import settings
+
+
+class AsyncResponse:
+    """The parts of a ``requests.Response`` the fetch code uses
+
+    ``raise_for_status`` raises ``requests`` exceptions so error handling is the
+    same for both clients.
+
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                f"{self.status_code} error for url: {self.url}", response=self
+            )
+
+
+class AsyncHTTPClient:
+    """Async HTTP client with the same headers, timeouts and metrics as SessionPool
+
+    Uses an ``httpx.AsyncClient`` that keeps connections alive across requests.
+    httpx is imported the first time a request is made, so it's only needed when
+    the ASGI app is used.
+
+    :arg max_connections: maximum number of connections open across all hosts
+    :arg timeout: default ``(connect, read)`` timeout in seconds
+    :arg host_headers: dict of host -> dict of headers to send to that host
+
+    """
+
+    def __init__(self, max_connections, timeout, host_headers=None):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.host_headers = host_headers or {}
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            import httpx
+
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def get(self, url, headers=None, timeout=None):
+        """Makes a GET request and records its metrics
+
+        :raises requests.exceptions.RequestException: if the request fails
+
+        """
+        import httpx
+
+        connect_timeout, read_timeout = timeout or self.timeout
+        host = urlparse(url).netloc
+        request_headers = dict(self.host_headers.get(host, {}))
+        request_headers.update(headers or {})
+
+        UPSTREAM_IN_FLIGHT.inc(host=host)
+        start_time = time.monotonic()
+        status = "error"
+        try:
+            resp = await self._get_client().get(
+                url,
+                headers=request_headers,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            )
+            status = resp.status_code
+        except httpx.TimeoutException as exc:
+            raise requests.exceptions.Timeout(str(exc)) from exc
+        except httpx.HTTPError as exc:
+            raise requests.exceptions.ConnectionError(str(exc)) from exc
+        finally:
+            UPSTREAM_IN_FLIGHT.dec(host=host)
+            UPSTREAM_DURATION.observe(
+                time.monotonic() - start_time, host=host, status=status
+            )
+        return AsyncResponse(url, resp.status_code, resp.headers, resp.content)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+ASYNC_HTTP_CLIENT = AsyncHTTPClient(
+    max_connections=settings.APP_ASYNC_HTTP_MAX_CONNECTIONS,
+    timeout=(settings.APP_HTTP_CONNECT_TIMEOUT, settings.APP_HTTP_READ_TIMEOUT),
+    host_headers={
+        urlparse(settings.APP_GITHUB_API_URL).netloc: github_headers(
+            settings.APP_GITHUB_TOKEN
+        )
+    },
+)
+
+
+class AsyncHostLimiter:
+    """Caps the number of in-flight requests to any single upstream host"""
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+
+    @contextlib.asynccontextmanager
+    async def limit(self, url):
+        host = urlparse(url).netloc
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        async with semaphore:
+            yield
+
+
+ASYNC_HOST_LIMITER = AsyncHostLimiter(max_per_host=settings.APP_FETCH_MAX_PER_HOST)
+
+
+class AsyncSingleFlight:
+    """Coalesces concurrent calls for the same key into a single call"""
+
+    def __init__(self):
+        self._in_flight = {}
+
+    async def do(self, key, fun):
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fun())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # NOTE(willkg): one caller being cancelled doesn't cancel the call for the
+        # others
+        return await asyncio.shield(task)
+
+
+ASYNC_SINGLE_FLIGHT = AsyncSingleFlight()
+
+
+@stamina.retry(on=is_retryable, attempts=3)
+async def _fetch(url):
+    check_deadline()
+    with BREAKERS.guard(url):
+        async with ASYNC_HOST_LIMITER.limit(url):
+            resp = await ASYNC_HTTP_CLIENT.get(
+                url, timeout=clamp_timeout(ASYNC_HTTP_CLIENT.timeout)
+            )
+        resp.raise_for_status()
+    return resp.json()
+
+
+async def fetch_version(host, fresh=False):
+    """Returns the /__version__ data for a host, going through VERSION_CACHE
+
+    Stale entries are refreshed in the background with the synchronous fetch.
+
+    :arg host: the environment host
+    :arg fresh: if True, skips the cache lookup and stores the fetched value
+
+    """
+    url = f"{host}/__version__"
+    with span("version", host=host):
+        fetch_fun = functools.partial(ASYNC_SINGLE_FLIGHT.do, url, lambda: _fetch(url))
+        if fresh:
+            value = await fetch_fun()
+            VERSION_CACHE.set(url, value)
+            return value
+        return await VERSION_CACHE.get_or_fetch_async(
+            url, fetch_fun, functools.partial(fetch, url)
+        )
+
+
+@stamina.retry(on=is_retryable, attempts=3)
+async def _fetch_github(url, compact):
+    entry = GITHUB_CACHE.get(url)
+    if entry is not None and entry.is_fresh():
+        GITHUB_CACHE.record_hit()
+        return entry.data
+
+    check_deadline()
+    headers = entry.conditional_headers() if entry is not None else {}
+
+    try:
+        # NOTE(willkg): interactive calls can wait up to a second for a token, so
+        # that's done in a worker thread rather than blocking the event loop
+        await asyncio.to_thread(REST_RATE_LIMIT.acquire)
+        async with ASYNC_HOST_LIMITER.limit(url):
+            resp = await ASYNC_HTTP_CLIENT.get(
+                url, headers=headers, timeout=clamp_timeout(ASYNC_HTTP_CLIENT.timeout)
+            )
+        REST_RATE_LIMIT.update(resp)
+    except RateLimited:
+        if entry is None:
+            raise
+        GITHUB_CACHE.record_unrevalidated()
+        return entry.data
+
+    if resp.status_code == 304 and entry is not None:
+        GITHUB_CACHE.record_revalidated(entry)
+        return entry.data
+
+    resp.raise_for_status()
+    data = resp.json()
+    if compact is not None:
+        data = compact(data)
+    GITHUB_CACHE.record_miss()
+    GITHUB_CACHE.set(
+        url,
+        etag=resp.headers.get("ETag"),
+        last_modified=resp.headers.get("Last-Modified"),
+        data=data,
+    )
+    return data
+
+
+async def fetch_github(url, compact=None):
+    """Fetches a GitHub API url, revalidating against GITHUB_CACHE
+
+    See libgithub.fetch_github.
+
+    """
+    with span("github", url=url.removeprefix(libgithub.GITHUB_API)):
+        return await ASYNC_SINGLE_FLIGHT.do(url, lambda: _fetch_github(url, compact))
+
+
+async def fetch_history_from_github(user, repo, from_sha):
+    url = f"{libgithub.GITHUB_API}/repos/{user}/{repo}/compare/{from_sha}...main"
+    return load_history(await fetch_github(url, compact=compact_compare))
+
+
+async def fetch_commits_from_github(user, repo, per_page):
+    url = (
+        f"{libgithub.GITHUB_API}/repos/{user}/{repo}/commits"
+        + f"?sha=main&per_page={per_page}"
+    )
+    return load_commits(await fetch_github(url, compact=compact_commits))
+
+
+class AsyncHistoryPlanner:
+    """Works out environment histories with async REST requests
+
+    Like libgithub.HistoryPlanner, it fetches recent commits on main once per
+    repository and falls back to a compare when that doesn't give the history. All
+    of it happens in ``prime``, concurrently, so ``get_history`` doesn't fetch and
+    can be used with libstatus.add_history.
+
+    :arg window: number of recent commits on main to fetch per repository
+
+    """
+
+    def __init__(self, window=None):
+        self.window = window or settings.APP_GITHUB_COMMIT_WINDOW
+        self._histories = {}
+
+    async def _get_histories(self, user, repo, from_shas):
+        commits = await fetch_commits_from_github(user, repo, per_page=self.window)
+        for from_sha in from_shas:
+            history = history_from_commits(commits, from_sha)
+            if history is None:
+                history = await fetch_history_from_github(user, repo, from_sha)
+            self._histories[(user, repo, from_sha)] = history
+
+    async def prime(self, keys):
+        """Fetches histories for ``(user, repo, from_sha)`` keys
+
+        Histories that fail to fetch are stored as their exception.
+
+        """
+        repos = {}
+        for user, repo, from_sha in keys:
+            repos.setdefault((user, repo), set()).add(from_sha)
+
+        results = await asyncio.gather(
+            *[
+                self._get_histories(user, repo, from_shas)
+                for (user, repo), from_shas in repos.items()
+            ],
+            return_exceptions=True,
+        )
+        for ((user, repo), from_shas), result in zip(repos.items(), results):
+            if isinstance(result, Exception):
+                for from_sha in from_shas:
+                    self._histories.setdefault((user, repo, from_sha), result)
+
+    def get_history(self, user, repo, from_sha):
+        """Returns the History for a primed deployed sha
+
+        :raises requests.exceptions.RequestException: if its fetch failed
+
+        """
+        history = self._histories[(user, repo, from_sha)]
+        if isinstance(history, Exception):
+            raise history
+        return history
+
+
+async def gather_with_deadline(coros, deadline=None):
+    """Runs coroutines concurrently and returns their results in order
+
+    Exceptions are returned in place of results. Coroutines still running when the
+    deadline passes are cancelled and get the deadline's DeadlineExceeded.
+
+    :arg coros: list of coroutines
+    :arg deadline: optional libdeadline.Deadline
+
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    if not tasks:
+        return []
+    timeout = deadline.remaining() if deadline is not None else None
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+
+    results = []
+    for task in tasks:
+        if task in pending:
+            results.append(deadline.exceeded())
+        elif task.exception() is not None:
+            results.append(task.exception())
+        else:
+            results.append(task.result())
+    return results
+
+
+async def get_version_data(environment, fresh=False):
+    """Async libstatus.get_version_data"""
+    return make_version_data(
+        environment, await fetch_version(environment.host, fresh=fresh)
+    )
+
+
+async def get_environments_data(environments, deadline=None):
+    """Fetches data for a batch of environments concurrently
+
+    Versions are fetched first and then all histories together.
+
+    :arg environments: list of libsystems.Environment
+    :arg deadline: optional libdeadline.Deadline shared by all the fetches
+
+    :returns: list of environment data dicts, or the exception for environments
+        that failed, in the same order
+
+    """
+    with use_deadline(deadline):
+        versions = await gather_with_deadline(
+            [get_version_data(environment) for environment in environments], deadline
+        )
+        keys = [
+            (item["user"], item["repo"], item["commit"])
+            for item in versions
+            if not isinstance(item, Exception)
+        ]
+
+        planner = get_history_planner()
+        if planner.batched:
+            # NOTE(willkg): batched planners make one request for everything, so
+            # it's made from a worker thread
+            prime = asyncio.to_thread(planner.prime, keys)
+        else:
+            planner = AsyncHistoryPlanner()
+            prime = planner.prime(keys)
+        (result,) = await gather_with_deadline([prime], deadline)
+
+    if isinstance(result, Exception):
+        return [item if isinstance(item, Exception) else result for item in versions]
+
+    results = []
+    for item in versions:
+        if not isinstance(item, Exception):
+            try:
+                item = add_history(item, planner)
+            except requests.exceptions.RequestException as exc:
+                item = exc
+        results.append(item)
+    return results
+
+
+async def get_system_data(system, deadline=None):
+    """Async libstatus.get_system_data"""
+    results = await get_environments_data(
+        system_environments(system), deadline=deadline
+    )
+    return list(iter_services(system, results))
+
+
+async def get_overview_data(systems, deadline=None):
+    """Async libstatus.get_overview_data"""
+    hosts = systems.hosts
+    results = await get_environments_data(list(hosts.values()), deadline=deadline)
+    return overview_from_results(systems, dict(zip(hosts, results)))
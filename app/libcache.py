@@ -0,0 +1,553 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+LOGGER = logging.getLogger(__name__)
+
+
+def deep_sizeof(obj, seen=None):
+    """Returns an estimate of the bytes used by obj and everything it holds
+
+    Follows dicts, lists, tuples, sets and objects with ``__slots__``. Objects that
+    are shared are only counted once.
+
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            deep_sizeof(key, seen) + deep_sizeof(value, seen)
+            for key, value in obj.items()
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(
+            deep_sizeof(getattr(obj, name), seen)
+            for name in obj.__slots__
+            if hasattr(obj, name)
+        )
+    return size
+
+
+class TTLCache:
+    """Bounded in-process LRU cache with stale-while-revalidate
+
+    Entries younger than ``ttl`` seconds are fresh and returned as is. Entries older
+    than that, but younger than ``ttl + stale_ttl``, are stale: they're returned
+    immediately and a refresh is handed to ``submit`` to run in the background.
+    Anything older is treated as a miss and fetched inline.
+
+    :arg maxsize: maximum number of entries; least recently used entries are evicted
+    :arg ttl: seconds an entry is fresh
+    :arg stale_ttl: seconds after going stale that an entry can still be served
+    :arg submit: callable that takes a zero-argument function and runs it in the
+        background; defaults to starting a daemon thread
+    :arg backing: optional persistent store (see SQLiteNamespace) that's checked on
+        misses and written through on sets
+
+    """
+
+    def __init__(self, maxsize, ttl, stale_ttl, submit=None, backing=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.backing = backing
+        self._submit = submit or self._submit_thread
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._refreshing = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    @staticmethod
+    def _submit_thread(fun):
+        threading.Thread(target=fun, daemon=True).start()
+
+    def get(self, key):
+        """Returns ``(value, age)`` for a key or ``None`` if it's not in the cache
+
+        This doesn't count towards stats or trigger refreshes.
+
+        """
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, fetched_at = entry
+        return value, time.monotonic() - fetched_at
+
+    def _set_local(self, key, value, age=0):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() - age)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        if self.backing is not None:
+            self.backing.store(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        if self.backing is not None:
+            self.backing.invalidate(key)
+
+    def _load_backing(self, key):
+        # Fills the in-memory cache from the backing store if it has key
+        if self.backing is None:
+            return
+        with self._lock:
+            if key in self._data:
+                return
+        loaded = self.backing.load(key)
+        if loaded is not None:
+            value, age = loaded
+            self._set_local(key, value, age=age)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._refreshing.clear()
+            self.hits = 0
+            self.misses = 0
+            self.stale = 0
+
+    def _refresh(self, key, fetch_fun):
+        try:
+            self.set(key, fetch_fun())
+        except Exception:
+            LOGGER.exception("background refresh of %s failed", key)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _lookup(self, key, refresh_fun):
+        # Returns (True, value) for fresh and stale entries, handing stale ones to
+        # refresh_fun in the background, and (False, None) for misses
+        self._load_backing(key)
+        now = time.monotonic()
+        refresh = False
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, fetched_at = entry
+                age = now - fetched_at
+                if age < self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+
+                if age < self.ttl + self.stale_ttl:
+                    self._data.move_to_end(key)
+                    self.stale += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        refresh = True
+                else:
+                    entry = None
+
+            if entry is None:
+                self.misses += 1
+
+        if entry is None:
+            return False, None
+
+        if refresh:
+            self._submit(lambda: self._refresh(key, refresh_fun))
+        return True, value
+
+    def get_or_fetch(self, key, fetch_fun):
+        """Returns the cached value for key, calling fetch_fun to fill it if needed
+
+        :arg key: the cache key
+        :arg fetch_fun: zero-argument callable that returns the value for key
+
+        :returns: the value
+
+        :raises Exception: whatever fetch_fun raises on a miss
+
+        """
+        found, value = self._lookup(key, fetch_fun)
+        if not found:
+            value = fetch_fun()
+            self.set(key, value)
+        return value
+
+    async def get_or_fetch_async(self, key, fetch_fun, refresh_fun):
+        """Like get_or_fetch, but awaits fetch_fun on a miss
+
+        :arg key: the cache key
+        :arg fetch_fun: zero-argument coroutine function that returns the value
+        :arg refresh_fun: zero-argument callable that returns the value; stale
+            entries are refreshed in the background with it
+
+        :returns: the value
+
+        :raises Exception: whatever fetch_fun raises on a miss
+
+        """
+        found, value = self._lookup(key, refresh_fun)
+        if not found:
+            value = await fetch_fun()
+            self.set(key, value)
+        return value
+
+    def memory_usage(self):
+        """Returns an estimate of the bytes held by cached values"""
+        with self._lock:
+            values = [value for value, _ in self._data.values()]
+        return deep_sizeof(values)
+
+    def stats(self):
+        memory_usage = self.memory_usage()
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "bytes": memory_usage,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+            }
+
+
+class ConditionalEntry:
+    __slots__ = ("data", "etag", "expires_at", "last_modified")
+
+    def __init__(self, etag, last_modified, data, expires_at=0):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.data = data
+        # time.monotonic() until which the entry is used without revalidating it
+        self.expires_at = expires_at
+
+    def is_fresh(self):
+        return time.monotonic() < self.expires_at
+
+    def conditional_headers(self):
+        """Returns request headers for revalidating this entry"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ConditionalCache:
+    """Bounded LRU cache of HTTP responses along with their validators
+
+    Entries hold the ``ETag`` and ``Last-Modified`` response headers so callers can
+    revalidate with ``If-None-Match`` and ``If-Modified-Since`` and reuse the data
+    when the upstream responds with a ``304``. Entries are fresh for ``ttl`` seconds
+    after they're set or revalidated, and callers use fresh entries without
+    revalidating them. Entries loaded from ``backing`` start out stale.
+
+    :arg maxsize: maximum number of entries; least recently used entries are evicted
+    :arg ttl: seconds an entry is fresh
+    :arg backing: optional persistent store (see SQLiteNamespace) that's checked on
+        misses and written through on sets
+
+    """
+
+    def __init__(self, maxsize, ttl=0, backing=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backing = backing
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.unrevalidated = 0
+
+    def get(self, key):
+        """Returns the ConditionalEntry for key or ``None``"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                return entry
+
+        if self.backing is not None:
+            loaded = self.backing.load(key)
+            if loaded is not None:
+                value, _ = loaded
+                entry = ConditionalEntry(
+                    value["etag"], value["last_modified"], value["data"]
+                )
+                self._set_local(key, entry)
+        return entry
+
+    def _set_local(self, key, entry):
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set(self, key, etag, last_modified, data):
+        self._set_local(
+            key,
+            ConditionalEntry(
+                etag, last_modified, data, expires_at=time.monotonic() + self.ttl
+            ),
+        )
+        if self.backing is not None:
+            self.backing.store(
+                key, {"etag": etag, "last_modified": last_modified, "data": data}
+            )
+
+    def record_hit(self):
+        """Records a fresh entry being used"""
+        with self._lock:
+            self.hits += 1
+
+    def record_revalidated(self, entry):
+        """Records an entry being revalidated and makes it fresh again"""
+        with self._lock:
+            entry.expires_at = time.monotonic() + self.ttl
+            self.revalidated += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def record_unrevalidated(self):
+        """Records an entry being used without revalidating it"""
+        with self._lock:
+            self.unrevalidated += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        if self.backing is not None:
+            self.backing.invalidate(key)
+
+    def invalidate_prefix(self, prefix, ignore_case=False):
+        """Invalidates every entry whose key starts with prefix
+
+        :arg prefix: the key prefix
+        :arg ignore_case: whether to compare keys and prefix case-insensitively
+
+        :returns: number of entries invalidated
+
+        """
+        if ignore_case:
+            prefix = prefix.lower()
+        with self._lock:
+            keys = [
+                key
+                for key in self._data
+                if (key.lower() if ignore_case else key).startswith(prefix)
+            ]
+        for key in keys:
+            self.invalidate(key)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.revalidated = 0
+            self.misses = 0
+            self.unrevalidated = 0
+
+    def memory_usage(self):
+        """Returns an estimate of the bytes held by cached entries"""
+        with self._lock:
+            entries = list(self._data.values())
+        return deep_sizeof(entries)
+
+    def stats(self):
+        memory_usage = self.memory_usage()
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "bytes": memory_usage,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "unrevalidated": self.unrevalidated,
+            }
+
+
+class SQLiteCache:
+    """On-disk cache shared between worker processes and across restarts
+
+    Values are stored as JSON in a single table in WAL mode so several processes can
+    read while one writes. Each entry expires after its namespace's ttl. When there
+    are more than ``max_entries`` entries, the oldest ones are evicted.
+
+    Connections are per-thread.
+
+    :arg path: path to the SQLite database file
+    :arg max_entries: maximum number of entries across all namespaces
+
+    """
+
+    EVICT_EVERY = 100
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_stored_at ON cache (stored_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def namespace(self, name, ttl):
+        return SQLiteNamespace(self, name, ttl)
+
+    def load(self, namespace, key):
+        """Returns ``(value, age)`` or ``None`` if missing or expired"""
+        now = time.time()
+        try:
+            row = (
+                self._conn()
+                .execute(
+                    "SELECT value, stored_at FROM cache "
+                    "WHERE namespace = ? AND key = ? AND expires_at > ?",
+                    (namespace, key, now),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error:
+            LOGGER.exception("persistent cache read failed")
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        value, stored_at = row
+        return json.loads(value), max(now - stored_at, 0)
+
+    def store(self, namespace, key, value, ttl):
+        now = time.time()
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO cache "
+                "(namespace, key, value, stored_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), now, now + ttl),
+            )
+        except sqlite3.Error:
+            LOGGER.exception("persistent cache write failed")
+            return
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def invalidate(self, namespace, key):
+        try:
+            self._conn().execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+            )
+        except sqlite3.Error:
+            LOGGER.exception("persistent cache invalidate failed")
+
+    def evict(self):
+        """Deletes expired entries and then the oldest entries over max_entries"""
+        try:
+            conn = self._conn()
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            (count,) = conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM cache WHERE rowid IN "
+                    "(SELECT rowid FROM cache ORDER BY stored_at LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+        except sqlite3.Error:
+            LOGGER.exception("persistent cache eviction failed")
+
+    def clear(self):
+        try:
+            self._conn().execute("DELETE FROM cache")
+        except sqlite3.Error:
+            LOGGER.exception("persistent cache clear failed")
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns a dict of stats; size is None if the database can't be read"""
+        try:
+            (count,) = self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()
+        except sqlite3.Error:
+            LOGGER.exception("persistent cache stats failed")
+            count = None
+        with self._lock:
+            return {
+                "size": count,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class SQLiteNamespace:
+    """A namespace in a SQLiteCache used as the backing store for in-memory caches"""
+
+    def __init__(self, cache, name, ttl):
+        self.cache = cache
+        self.name = name
+        self.ttl = ttl
+
+    def load(self, key):
+        return self.cache.load(self.name, key)
+
+    def store(self, key, value):
+        self.cache.store(self.name, key, value, self.ttl)
+
+    def invalidate(self, key):
+        self.cache.invalidate(self.name, key)
@@ -0,0 +1,200 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Process pool for CPU-bound route work.
+
+Tasks run in worker processes so they don't hold the GIL of the process serving
+requests. Tasks must be module-level functions so they can be pickled and they
+take a ``deadline`` keyword argument: the ``time.time()`` after which they should
+give up by calling ``raise_if_expired``.
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+from app.observability import CPU_TASK_DURATION
+from app.settings import settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PoolFull(Exception):
+    """Raised instead of queueing a task when the pool's queue is full"""
+
+
+class TaskTimeout(Exception):
+    """Raised when a task doesn't finish within its timeout"""
+
+
+def raise_if_expired(deadline):
+    """Raises TaskTimeout if a task's deadline has passed
+
+    Tasks call this every so often so a task that's timed out stops and frees its
+    worker.
+
+    """
+    if time.time() >= deadline:
+        raise TaskTimeout("task ran past its deadline")
+
+
+def hash_text(text, iterations, deadline):
+    """Hashes text with SHA-256 repeatedly, hashing the hex digest each time"""
+    for i in range(iterations):
+        if i % 10_000 == 0:
+            raise_if_expired(deadline)
+        text = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return text
+
+
+class ProcessPool:
+    """Runs CPU-bound tasks in a pool of worker processes
+
+    At most ``max_workers`` tasks run at once and at most ``max_queue`` more wait
+    for a worker. Tasks past that are rejected with PoolFull straight away rather
+    than queueing up behind work that's already late.
+
+    Callers wait up to the task's timeout. Then a task that's still queued is
+    cancelled and a task that's running stops itself at its deadline.
+
+    Worker processes are started the first time a task is run.
+
+    :arg max_workers: number of worker processes; 0 for one per CPU
+    :arg max_queue: most tasks waiting for a worker
+    :arg timeout: default seconds a task has to finish
+
+    """
+
+    def __init__(self, max_workers, max_queue, timeout):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        self._in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # NOTE(willkg): the serving process has threads, so workers are
+                # spawned rather than forked
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def run(self, fun, *args, timeout=None):
+        """Runs ``fun(*args, deadline=...)`` in a worker process
+
+        :arg fun: module-level function
+        :arg args: picklable arguments
+        :arg timeout: seconds the task has to finish; defaults to the pool's
+
+        :returns: what fun returns
+
+        :raises PoolFull: if the queue is full
+        :raises TaskTimeout: if the task doesn't finish in time
+        :raises Exception: whatever fun raises
+
+        """
+        timeout = timeout or self.timeout
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PoolFull(
+                    f"{self._in_flight} tasks in flight for {self.max_workers} workers"
+                )
+            self._in_flight += 1
+
+        start_time = time.monotonic()
+        outcome = "error"
+        try:
+            try:
+                future = self._get_executor().submit(
+                    fun, *args, deadline=time.time() + timeout
+                )
+            except BaseException:
+                self._done(None)
+                raise
+
+            try:
+                result = future.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise TaskTimeout(f"task didn't finish in {timeout}s") from None
+            except BrokenProcessPool:
+                # NOTE(willkg): a worker died, so start a new pool for the next task
+                LOGGER.error("process pool broke; restarting it")
+                with self._lock:
+                    self._executor = None
+                raise
+            finally:
+                # NOTE(willkg): a task that's still running after a timeout counts
+                # as in flight until it stops
+                future.add_done_callback(self._done)
+            outcome = "ok"
+            return result
+
+        except TaskTimeout:
+            outcome = "timeout"
+            raise
+
+        finally:
+            duration = time.monotonic() - start_time
+            CPU_TASK_DURATION.observe(duration, task=fun.__name__, outcome=outcome)
+            with self._lock:
+                self.total_seconds += duration
+                if outcome == "ok":
+                    self.completed += 1
+                elif outcome == "timeout":
+                    self.timed_out += 1
+                else:
+                    self.failed += 1
+
+    def shutdown(self):
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            finished = self.completed + self.failed + self.timed_out
+            return {
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": min(self._in_flight, self.max_workers),
+                "queued": max(0, self._in_flight - self.max_workers),
+                "completed": self.completed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+                "rejected": self.rejected,
+                "mean_seconds": (
+                    round(self.total_seconds / finished, 3) if finished else None
+                ),
+            }
+
+
+CPU_POOL = ProcessPool(
+    max_workers=settings.APP_CPU_POOL_WORKERS,
+    max_queue=settings.APP_CPU_POOL_MAX_QUEUE,
+    timeout=settings.APP_CPU_TASK_TIMEOUT,
+)
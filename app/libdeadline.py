@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import contextlib
+import contextvars
+import time
+
+import requests
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """Raised when a request's deadline budget runs out"""
+
+    retryable = False
+
+
+class Deadline:
+    """Absolute point in time that a request's upstream calls have to finish by
+
+    :arg budget: seconds from now
+
+    """
+
+    __slots__ = ("budget", "expires_at")
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def exceeded(self):
+        return DeadlineExceeded(f"deadline of {self.budget}s exceeded")
+
+    def check(self):
+        if self.expired():
+            raise self.exceeded()
+
+    def clamp(self, timeout):
+        """Returns timeout cut down to what's left of the budget
+
+        :arg timeout: seconds or a ``(connect, read)`` tuple of seconds
+
+        """
+        # NOTE(willkg): requests doesn't allow a timeout of 0
+        remaining = max(self.remaining(), 0.001)
+        if isinstance(timeout, tuple):
+            return tuple(min(item, remaining) for item in timeout)
+        return min(timeout, remaining)
+
+
+_DEADLINE = contextvars.ContextVar("deadline", default=None)
+
+
+def current_deadline():
+    """Returns the Deadline for the current context or None"""
+    return _DEADLINE.get()
+
+
+@contextlib.contextmanager
+def use_deadline(deadline):
+    """Sets the deadline for upstream calls made in this context
+
+    :arg deadline: a Deadline or None for no deadline
+
+    """
+    token = _DEADLINE.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _DEADLINE.reset(token)
+
+
+def check_deadline():
+    """Raises DeadlineExceeded if the current deadline has passed"""
+    deadline = _DEADLINE.get()
+    if deadline is not None:
+        deadline.check()
+
+
+def clamp_timeout(timeout):
+    """Returns timeout cut down to what's left of the current deadline"""
+    deadline = _DEADLINE.get()
+    if deadline is None:
+        return timeout
+    return deadline.clamp(timeout)
+
+
+def is_retryable(exc):
+    """Whether a failed upstream call is worth retrying
+
+    Request exceptions are, except for ones that set ``retryable = False`` because
+    retrying can't help, like DeadlineExceeded.
+
+    """
+    return isinstance(exc, requests.exceptions.RequestException) and getattr(
+        exc, "retryable", True
+    )
@@ -0,0 +1,448 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import concurrent.futures
+import functools
+import threading
+from typing import NamedTuple
+
+import requests
+import stamina
+
+from app.libcache import ConditionalCache
+from app.libdeadline import check_deadline, clamp_timeout, is_retryable
+from app.libhttp import HTTP_CLIENT
+from app.libratelimit import RateLimited, RateLimitScheduler
+from app.libupstream import HOST_LIMITER, SINGLE_FLIGHT
+from app.observability import span
+from app.settings import settings
+
+GITHUB_API = settings.APP_GITHUB_API_URL.rstrip("/")
+
+
+class Commit(NamedTuple):
+    """The parts of a GitHub commit that get rendered"""
+
+    sha: str
+    # Number of parents; more than one is a merge commit
+    parents: int
+    # First line of the commit message
+    message: str
+    # Author login or "?"
+    author: str
+
+
+class History(NamedTuple):
+    """Commits on main that a deployed sha is behind, oldest first"""
+
+    total_commits: int
+    commits: tuple[Commit, ...]
+
+
+def compact_commit(commit):
+    """Reduces a GitHub REST commit to a Commit"""
+    message = commit["commit"]["message"].splitlines()
+    return Commit(
+        sha=commit["sha"],
+        parents=len(commit["parents"]),
+        message=message[0] if message else "",
+        author=(commit["author"] or {}).get("login", "?"),
+    )
+
+
+def compact_compare(data):
+    """Reduces a GitHub compare response to a History"""
+    return History(
+        total_commits=data["total_commits"],
+        commits=tuple(compact_commit(commit) for commit in data.get("commits", [])),
+    )
+
+
+def compact_commits(data):
+    """Reduces a GitHub commit list response to a tuple of Commit"""
+    return tuple(compact_commit(commit) for commit in data)
+
+
+def load_history(value):
+    """Returns a History from a History or its JSON form from a persistent cache"""
+    if isinstance(value, History):
+        return value
+    total_commits, commits = value
+    return History(total_commits, tuple(Commit(*commit) for commit in commits))
+
+
+def load_commits(value):
+    """Returns a tuple of Commit from one or its JSON form from a persistent cache"""
+    if isinstance(value, tuple):
+        return value
+    return tuple(Commit(*commit) for commit in value)
+
+
+class GitHubGraphQLError(requests.exceptions.RequestException):
+    """GitHub GraphQL API responded with errors"""
+
+
+GITHUB_CACHE = ConditionalCache(
+    maxsize=settings.APP_GITHUB_CACHE_MAX_SIZE, ttl=settings.APP_GITHUB_CACHE_TTL
+)
+
+
+def default_rate_limit():
+    # NOTE(willkg): these are the limits GitHub documents; responses update them
+    return 5000 if settings.APP_GITHUB_TOKEN else 60
+
+
+# NOTE(willkg): GitHub has separate budgets for the REST and GraphQL APIs
+REST_RATE_LIMIT = RateLimitScheduler(
+    name="github-rest",
+    limit=default_rate_limit(),
+    burst=settings.APP_GITHUB_RATE_LIMIT_BURST,
+    reserve=settings.APP_GITHUB_RATE_LIMIT_RESERVE,
+)
+GRAPHQL_RATE_LIMIT = RateLimitScheduler(
+    name="github-graphql",
+    limit=default_rate_limit(),
+    burst=settings.APP_GITHUB_RATE_LIMIT_BURST,
+    reserve=settings.APP_GITHUB_RATE_LIMIT_RESERVE,
+)
+
+
+@stamina.retry(on=is_retryable, attempts=3)
+def _fetch_github(url, compact):
+    entry = GITHUB_CACHE.get(url)
+    if entry is not None and entry.is_fresh():
+        GITHUB_CACHE.record_hit()
+        return entry.data
+
+    check_deadline()
+    headers = entry.conditional_headers() if entry is not None else {}
+
+    try:
+        REST_RATE_LIMIT.acquire()
+        with HOST_LIMITER.limit(url):
+            resp = HTTP_CLIENT.get(
+                url, headers=headers, timeout=clamp_timeout(HTTP_CLIENT.timeout)
+            )
+        REST_RATE_LIMIT.update(resp)
+    except RateLimited:
+        # NOTE(willkg): a response that might be out of date beats no response
+        if entry is None:
+            raise
+        GITHUB_CACHE.record_unrevalidated()
+        return entry.data
+
+    if resp.status_code == 304 and entry is not None:
+        GITHUB_CACHE.record_revalidated(entry)
+        return entry.data
+
+    resp.raise_for_status()
+    data = resp.json()
+    if compact is not None:
+        data = compact(data)
+    GITHUB_CACHE.record_miss()
+    GITHUB_CACHE.set(
+        url,
+        etag=resp.headers.get("ETag"),
+        last_modified=resp.headers.get("Last-Modified"),
+        data=data,
+    )
+    return data
+
+
+def fetch_github(url, compact=None):
+    """Fetches a GitHub API url, revalidating against GITHUB_CACHE
+
+    A cached response fetched or revalidated in the last ``APP_GITHUB_CACHE_TTL``
+    seconds is used as is. Otherwise, if there's a cached response for the url, the
+    request is made with ``If-None-Match``/``If-Modified-Since`` and a ``304``
+    reuses the cached data. GitHub doesn't count ``304`` responses against the rate
+    limit. Concurrent calls for the same url share one request.
+
+    :arg url: the GitHub API url
+    :arg compact: optional function that reduces the decoded response to just what
+        we use before it's cached; its result must be JSON-serializable so it can
+        go in the persistent cache
+
+    :returns: the decoded (and compacted) JSON response
+
+    :raises requests.exceptions.RequestException: if the request fails
+
+    """
+    with span("github", url=url.removeprefix(GITHUB_API)):
+        return SINGLE_FLIGHT.do(url, functools.partial(_fetch_github, url, compact))
+
+
+def fetch_history_from_github(user, repo, from_sha):
+    """Fetches the commits on main that from_sha is behind as a History"""
+    return load_history(
+        fetch_github(
+            f"{GITHUB_API}/repos/{user}/{repo}/compare/{from_sha}...main",
+            compact=compact_compare,
+        )
+    )
+
+
+def fetch_commits_from_github(user, repo, per_page):
+    """Fetches the most recent commits on main, newest first, as Commit tuples"""
+    return load_commits(
+        fetch_github(
+            f"{GITHUB_API}/repos/{user}/{repo}/commits?sha=main&per_page={per_page}",
+            compact=compact_commits,
+        )
+    )
+
+
+def history_from_commits(commits, from_sha):
+    """Works out the History for a deployed sha from recent commits on main
+
+    :arg commits: tuple of Commit on main, newest first
+    :arg from_sha: the deployed sha
+
+    :returns: the History, or None if it takes a compare because the sha isn't in
+        commits or there are merge commits ahead of it
+
+    """
+    for index, commit in enumerate(commits):
+        if commit.sha.startswith(from_sha):
+            ahead = commits[:index]
+            if all(commit.parents <= 1 for commit in ahead):
+                return History(len(ahead), tuple(reversed(ahead)))
+            break
+    return None
+
+
+class HistoryPlanner:
+    """Works out environment histories with one commit list fetch per repository
+
+    Environments of the same service usually deploy from the same repository. The
+    planner fetches the most recent ``window`` commits on main once per
+    ``(user, repo)`` and works out how far behind each deployed sha is from that.
+    It falls back to a compare when the deployed sha isn't in the window or when
+    there are merge commits ahead of it, since then the commit list order doesn't
+    give the ahead count.
+
+    Use one planner per batch of environments, e.g. per page build.
+
+    :arg window: number of recent commits on main to fetch per repository
+
+    """
+
+    # This planner fetches per repository as environments come in
+    batched = False
+
+    def __init__(self, window=None):
+        self.window = window or settings.APP_GITHUB_COMMIT_WINDOW
+        self._lock = threading.Lock()
+        self._commits = {}
+
+    def _get_commits(self, user, repo):
+        key = (user, repo)
+        with self._lock:
+            future = self._commits.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._commits[key] = future
+
+        if leader:
+            try:
+                commits = fetch_commits_from_github(user, repo, per_page=self.window)
+            except Exception as exc:
+                future.set_exception(exc)
+                raise
+            else:
+                future.set_result(commits)
+            finally:
+                # NOTE(willkg): threads waiting on this fetch must never hang, even
+                # if it's interrupted
+                if not future.done():
+                    future.cancel()
+        return future.result()
+
+    def prime(self, keys):
+        pass
+
+    def get_history(self, user, repo, from_sha):
+        """Returns the History for a deployed sha
+
+        :raises requests.exceptions.RequestException: if a fetch fails
+
+        """
+        history = history_from_commits(self._get_commits(user, repo), from_sha)
+        if history is not None:
+            return history
+        return fetch_history_from_github(user=user, repo=repo, from_sha=from_sha)
+
+
+HISTORY_FIELDS = (
+    "target { ... on Commit { history(first: $window) { nodes { "
+    "oid messageHeadline parents { totalCount } author { user { login } } "
+    "} } } }"
+)
+
+
+class GraphQLHistoryPlanner:
+    """Works out environment histories with one GitHub GraphQL query per batch
+
+    ``prime`` takes every ``(user, repo, sha)`` for a batch and fetches the recent
+    commits on main for each repository along with the number of commits each sha
+    is behind main in a single query. ``get_history`` then answers from that.
+    Keys that weren't primed are fetched in a query of their own.
+
+    The GraphQL API requires a token, so set ``APP_GITHUB_TOKEN`` when using this.
+
+    :arg window: number of recent commits on main to fetch per repository
+    :arg url: GraphQL endpoint url
+
+    """
+
+    batched = True
+
+    def __init__(self, window=None, url=None):
+        self.window = window or settings.APP_GITHUB_COMMIT_WINDOW
+        self.url = url or settings.APP_GITHUB_GRAPHQL_URL
+        self._lock = threading.Lock()
+        self._histories = {}
+
+    def build_query(self, keys):
+        """Returns ``(query, variables, aliases)`` for a list of keys
+
+        ``aliases`` maps each repository alias to ``(user, repo, {compare alias:
+        sha})``.
+
+        """
+        repos = {}
+        for user, repo, sha in keys:
+            repos.setdefault((user, repo), []).append(sha)
+
+        declarations = ["$window: Int!"]
+        variables = {"window": self.window}
+        fields = []
+        aliases = {}
+        for repo_index, ((user, repo), shas) in enumerate(sorted(repos.items())):
+            repo_alias = f"r{repo_index}"
+            declarations += [
+                f"${repo_alias}_owner: String!",
+                f"${repo_alias}_name: String!",
+            ]
+            variables[f"{repo_alias}_owner"] = user
+            variables[f"{repo_alias}_name"] = repo
+
+            compares = {}
+            compare_fields = []
+            for sha_index, sha in enumerate(sorted(set(shas))):
+                compare_alias = f"c{sha_index}"
+                declarations.append(f"${repo_alias}_{compare_alias}: String!")
+                variables[f"{repo_alias}_{compare_alias}"] = sha
+                compares[compare_alias] = sha
+                compare_fields.append(
+                    f"{compare_alias}: compare(headRef: ${repo_alias}_{compare_alias}) "
+                    "{ behindBy }"
+                )
+            aliases[repo_alias] = (user, repo, compares)
+
+            fields.append(
+                f"{repo_alias}: repository(owner: ${repo_alias}_owner, "
+                f"name: ${repo_alias}_name) {{ "
+                f'ref(qualifiedName: "refs/heads/main") {{ {HISTORY_FIELDS} '
+                f"{' '.join(compare_fields)} }} }}"
+            )
+
+        query = f"query({', '.join(declarations)}) {{ {' '.join(fields)} }}"
+        return query, variables, aliases
+
+    @stamina.retry(on=is_retryable, attempts=3)
+    def _query(self, query, variables):
+        check_deadline()
+        GRAPHQL_RATE_LIMIT.acquire()
+        with HOST_LIMITER.limit(self.url):
+            resp = HTTP_CLIENT.post(
+                self.url,
+                json={"query": query, "variables": variables},
+                timeout=clamp_timeout(HTTP_CLIENT.timeout),
+            )
+        GRAPHQL_RATE_LIMIT.update(resp)
+        resp.raise_for_status()
+        data = resp.json()
+        if data.get("errors"):
+            raise GitHubGraphQLError(
+                "; ".join(error.get("message", "?") for error in data["errors"])
+            )
+        return data["data"]
+
+    def prime(self, keys):
+        """Fetches histories for all keys that aren't known yet in one query
+
+        :arg keys: list of ``(user, repo, sha)``
+
+        :raises requests.exceptions.RequestException: if the query fails
+
+        """
+        with self._lock:
+            missing = sorted({key for key in keys if key not in self._histories})
+        if not missing:
+            return
+
+        query, variables, aliases = self.build_query(missing)
+        with span("github", url="graphql", repositories=len(aliases)):
+            data = self._query(query, variables)
+
+        histories = {}
+        for repo_alias, (user, repo, compares) in aliases.items():
+            ref = (data.get(repo_alias) or {}).get("ref")
+            if ref is None:
+                raise GitHubGraphQLError(f"{user}/{repo} has no main branch")
+            commits = [
+                Commit(
+                    sha=node["oid"],
+                    parents=node["parents"]["totalCount"],
+                    message=node["messageHeadline"],
+                    author=((node["author"] or {}).get("user") or {}).get("login", "?"),
+                )
+                for node in ref["target"]["history"]["nodes"]
+            ]
+            for compare_alias, sha in compares.items():
+                compare = ref[compare_alias]
+                if compare is None:
+                    # NOTE(willkg): GitHub returns null for a sha it doesn't know
+                    raise GitHubGraphQLError(f"{user}/{repo} has no commit {sha}")
+                behind = compare["behindBy"]
+                # The commits ahead of sha are the ones before it in the window; if
+                # it's not in the window, they're all ahead
+                index = next(
+                    (
+                        i
+                        for i, commit in enumerate(commits)
+                        if commit.sha.startswith(sha)
+                    ),
+                    len(commits),
+                )
+                histories[(user, repo, sha)] = History(
+                    behind, tuple(reversed(commits[:index])) if behind else ()
+                )
+
+        with self._lock:
+            self._histories.update(histories)
+
+    def get_history(self, user, repo, from_sha):
+        """Returns the History for a deployed sha
+
+        :raises requests.exceptions.RequestException: if a fetch fails
+
+        """
+        key = (user, repo, from_sha)
+        with self._lock:
+            history = self._histories.get(key)
+        if history is None:
+            self.prime([key])
+            with self._lock:
+                history = self._histories[key]
+        return history
+
+
+def get_history_planner():
+    """Returns a new history planner for the backend set by APP_GITHUB_BACKEND"""
+    if settings.APP_GITHUB_BACKEND == "graphql":
+        return GraphQLHistoryPlanner()
+    return HistoryPlanner()
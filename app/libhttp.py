@@ -0,0 +1,129 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.observability import UPSTREAM_DURATION, UPSTREAM_IN_FLIGHT
+from app.settings import settings
+
+
+class SessionPool:
+    """Keep-alive ``requests.Session`` objects, one per upstream host
+
+    Each host gets its own session with its own connection pool so TCP and TLS
+    connections are reused across requests. Retries are left to callers.
+
+    :arg pool_maxsize: maximum number of connections kept open per host
+    :arg timeout: default ``(connect, read)`` timeout in seconds
+    :arg host_headers: dict of host -> dict of headers to set on that host's session
+
+    """
+
+    def __init__(self, pool_maxsize, timeout, host_headers=None):
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.host_headers = host_headers or {}
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def _build_session(self, host):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(self.host_headers.get(host, {}))
+        return session
+
+    def get_session(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = self._build_session(host)
+                self._sessions[host] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        """Makes a request with the host's session and records its metrics"""
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlparse(url).netloc
+        UPSTREAM_IN_FLIGHT.inc(host=host)
+        start_time = time.monotonic()
+        status = "error"
+        try:
+            resp = self.get_session(url).request(method, url, **kwargs)
+            status = resp.status_code
+            return resp
+        finally:
+            UPSTREAM_IN_FLIGHT.dec(host=host)
+            UPSTREAM_DURATION.observe(
+                time.monotonic() - start_time, host=host, status=status
+            )
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def stats(self):
+        """Returns per-host connection reuse stats
+
+        ``requests`` is the number of requests made and ``connections`` is the
+        number of connections opened to make them.
+
+        """
+        with self._lock:
+            sessions = dict(self._sessions)
+
+        hosts = {}
+        for host, session in sessions.items():
+            num_requests = 0
+            num_connections = 0
+            for adapter in set(session.adapters.values()):
+                # NOTE(willkg): pools is a urllib3 RecentlyUsedContainer, which
+                # can't be iterated; keys() is a copy taken under its lock
+                pools = adapter.poolmanager.pools
+                keys = pools.keys()
+                for key in keys:
+                    pool = pools.get(key)
+                    if pool is not None:
+                        num_requests += pool.num_requests
+                        num_connections += pool.num_connections
+            hosts[host] = {"requests": num_requests, "connections": num_connections}
+        return hosts
+
+
+def github_headers(token):
+    headers = {
+        "Accept": "application/vnd.github+json",
+        "X-GitHub-Api-Version": "2022-11-28",
+    }
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    return headers
+
+
+HTTP_CLIENT = SessionPool(
+    pool_maxsize=settings.APP_HTTP_POOL_MAXSIZE,
+    timeout=(settings.APP_HTTP_CONNECT_TIMEOUT, settings.APP_HTTP_READ_TIMEOUT),
+    host_headers={
+        urlparse(settings.APP_GITHUB_API_URL).netloc: github_headers(
+            settings.APP_GITHUB_TOKEN
+        )
+    },
+)
@@ -0,0 +1,205 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+import requests
+
+from app.libdeadline import current_deadline
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Calls made from page and API requests are "interactive"; calls made by the
+# snapshot refresher are "background"
+_PRIORITY = contextvars.ContextVar("priority", default="interactive")
+
+
+@contextlib.contextmanager
+def background_priority():
+    """Marks rate-limited calls made in this context as background calls"""
+    token = _PRIORITY.set("background")
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+
+def current_priority():
+    return _PRIORITY.get()
+
+
+class RateLimited(requests.exceptions.RequestException):
+    """Raised instead of making a call the rate limit doesn't allow"""
+
+    # NOTE(willkg): retrying straight away can't help and burns budget
+    retryable = False
+
+
+class RateLimitScheduler:
+    """Token bucket scheduler for calls to a rate-limited API
+
+    Tokens refill so that the remaining budget is spread over the time left until
+    the limit resets, with at most ``burst`` tokens saved up. Responses sync the
+    budget from their ``X-RateLimit-*`` headers.
+
+    Interactive calls wait up to ``max_wait`` seconds for a token. Background calls
+    don't wait and are only made while more than ``reserve`` of the limit is left,
+    so what's left goes to interactive calls.
+
+    After a 429 or a rate limit 403, no calls are made until ``Retry-After`` says
+    so, or until the limit resets if the budget is used up, or for 60 seconds for
+    secondary rate limits that say neither.
+
+    :arg name: name for logging
+    :arg limit: calls allowed per window until the headers say otherwise
+    :arg burst: most tokens saved up
+    :arg reserve: fraction of the limit kept for interactive calls
+    :arg max_wait: longest seconds an interactive call waits for a token
+    :arg window: seconds in a rate limit window until the headers say otherwise
+
+    """
+
+    SECONDARY_BACKOFF = 60
+
+    def __init__(self, name, limit, burst, reserve, max_wait=1.0, window=3600):
+        self.name = name
+        self.initial_limit = limit
+        self.burst = burst
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.window = window
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Resets the budget and stats"""
+        with self._lock:
+            now = time.monotonic()
+            self.limit = self.initial_limit
+            self.remaining = self.initial_limit
+            self.reset_at = now + self.window
+            self.tokens = float(self.burst)
+            self.updated_at = now
+            self.blocked_until = 0.0
+
+            self.calls = {"interactive": 0, "background": 0}
+            self.throttled = 0
+            self.backoffs = 0
+
+    def _refill(self, now):
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+        rate = self.remaining / max(1.0, self.reset_at - now)
+        self.tokens = min(
+            self.burst, self.remaining, self.tokens + (now - self.updated_at) * rate
+        )
+        self.updated_at = now
+        return rate
+
+    def acquire(self):
+        """Takes a token for a call, waiting for one if it's an interactive call
+
+        :raises RateLimited: if the call can't be made
+
+        """
+        priority = current_priority()
+        max_wait = self.max_wait if priority == "interactive" else 0
+        deadline = current_deadline()
+        if deadline is not None:
+            max_wait = min(max_wait, deadline.remaining())
+        wait_until = time.monotonic() + max_wait
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    self.throttled += 1
+                    raise RateLimited(
+                        f"{self.name} rate limited for "
+                        + f"{self.blocked_until - now:.0f}s"
+                    )
+
+                rate = self._refill(now)
+                if priority == "background" and (
+                    self.remaining <= self.reserve * self.limit
+                ):
+                    self.throttled += 1
+                    raise RateLimited(
+                        f"{self.name} budget is reserved for interactive calls"
+                    )
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.remaining -= 1
+                    self.calls[priority] += 1
+                    return
+
+                wait = (1 - self.tokens) / rate if rate > 0 else None
+                if wait is None or now + wait > wait_until:
+                    self.throttled += 1
+                    raise RateLimited(f"{self.name} budget is used up")
+
+            time.sleep(wait)
+
+    def update(self, resp):
+        """Syncs the budget from a response
+
+        :raises RateLimited: if the response says the call was rate limited
+
+        """
+        headers = resp.headers
+        now = time.monotonic()
+        with self._lock:
+            remaining = headers.get("X-RateLimit-Remaining")
+            if remaining is not None and remaining.isdigit():
+                self.remaining = int(remaining)
+                self.tokens = min(self.tokens, self.remaining)
+            limit = headers.get("X-RateLimit-Limit")
+            if limit is not None and limit.isdigit():
+                self.limit = int(limit)
+            reset = headers.get("X-RateLimit-Reset")
+            if reset is not None and reset.isdigit():
+                self.reset_at = now + max(0, int(reset) - time.time())
+
+            if resp.status_code not in (403, 429):
+                return
+
+            retry_after = headers.get("Retry-After")
+            if retry_after is not None and retry_after.isdigit():
+                backoff = int(retry_after)
+            elif remaining == "0":
+                backoff = max(1, self.reset_at - now)
+            elif resp.status_code == 429 or "rate limit" in resp.text.lower():
+                backoff = self.SECONDARY_BACKOFF
+            else:
+                # NOTE(willkg): a 403 that's not about rate limits
+                return
+
+            self.blocked_until = max(self.blocked_until, now + backoff)
+            self.backoffs += 1
+
+        LOGGER.warning("%s rate limited; backing off %ss", self.name, int(backoff))
+        raise RateLimited(f"{self.name} rate limited for {backoff:.0f}s")
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "remaining": self.remaining,
+                "limit": self.limit,
+                "reset_in": round(max(0, self.reset_at - now)),
+                "tokens": round(self.tokens, 1),
+                "blocked_for": round(max(0, self.blocked_until - now)),
+                "interactive_calls": self.calls["interactive"],
+                "background_calls": self.calls["background"],
+                "throttled": self.throttled,
+                "backoffs": self.backoffs,
+            }
@@ -0,0 +1,230 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+
+from app.libratelimit import background_priority
+from app.libstatus import error_environment_data, get_environments_data
+
+LOGGER = logging.getLogger(__name__)
+
+
+class EnvironmentState:
+    __slots__ = ("data", "error", "fetched_at", "interval", "next_poll_at")
+
+    def __init__(self, interval):
+        self.data = None
+        self.fetched_at = None
+        self.interval = interval
+        self.next_poll_at = 0
+        self.error = None
+
+
+class SnapshotRefresher:
+    """Keeps an in-memory status snapshot of every environment up to date
+
+    Environments are polled in a background thread. Each environment has its own
+    poll interval: it starts at ``min_interval``, doubles every time a poll finds
+    nothing changed up to ``max_interval``, and drops back to ``min_interval`` when
+    the deployed commit or status changes. Environments that deploy often are
+    polled often and stable ones, like most prod environments, back off.
+
+    :arg get_systems: zero-argument callable returning a libsystems.Systems
+    :arg min_interval: shortest seconds between polls of an environment
+    :arg max_interval: longest seconds between polls of an environment
+    :arg tick: seconds between checks for environments that are due
+
+    """
+
+    def __init__(self, get_systems, min_interval, max_interval, tick=5):
+        self.get_systems = get_systems
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._states = {}
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _environments(self):
+        # NOTE(willkg): environments are keyed by host so a host that's in several
+        # systems is only polled once
+        return self.get_systems().hosts
+
+    def _record(self, environment, result):
+        if isinstance(result, Exception):
+            LOGGER.warning("snapshot poll of %s failed: %s", environment.host, result)
+            data = None
+            error = str(result)
+        else:
+            data = result
+            error = None
+
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.setdefault(
+                environment.host, EnvironmentState(interval=self.min_interval)
+            )
+            if data is not None:
+                changed = state.data is None or (
+                    (state.data["commit"], state.data["status"])
+                    != (data["commit"], data["status"])
+                )
+                if changed:
+                    state.interval = self.min_interval
+                else:
+                    state.interval = min(state.interval * 2, self.max_interval)
+                state.data = data
+                state.fetched_at = now
+            state.error = error
+            state.next_poll_at = now + state.interval
+
+    def _poll(self, environments):
+        with background_priority():
+            results = get_environments_data(
+                environments, fresh=True, return_exceptions=True
+            )
+        for environment, result in zip(environments, results):
+            self._record(environment, result)
+
+    def refresh_due(self):
+        """Polls every environment that's due and returns how many were polled"""
+        environments = self._environments()
+        now = time.monotonic()
+        with self._lock:
+            for host in set(self._states) - set(environments):
+                del self._states[host]
+            due = [
+                environment
+                for host, environment in environments.items()
+                if host not in self._states or self._states[host].next_poll_at <= now
+            ]
+        self._poll(due)
+        return len(due)
+
+    def mark_due(self, host=None, repo=None):
+        """Marks environments as due so they're polled on the next tick
+
+        Polls are made sooner by waking the background thread. Environments that
+        are marked due start over at ``min_interval``.
+
+        :arg host: mark the environment with this host
+        :arg repo: mark environments deployed from this ``(user, repo)``; compared
+            case-insensitively like GitHub does
+
+        :returns: number of environments marked due
+
+        """
+        if repo is not None:
+            repo = tuple(part.lower() for part in repo)
+
+        def matches(state_host, state):
+            if host is not None and state_host == host:
+                return True
+            if repo is None or state.data is None:
+                return False
+            return (state.data["user"].lower(), state.data["repo"].lower()) == repo
+
+        marked = 0
+        with self._lock:
+            for state_host, state in self._states.items():
+                if not matches(state_host, state):
+                    continue
+                state.interval = self.min_interval
+                state.next_poll_at = 0
+                marked += 1
+
+        if marked:
+            self._wake.set()
+        return marked
+
+    def get_system_data(self, system):
+        """Returns ``(data, age)`` for a system from the snapshot
+
+        :arg system: a libsystems.System
+
+        :returns: ``(data, age)`` where data is the same structure
+            libstatus.get_system_data returns and age is the age in seconds of the
+            oldest environment in it, or ``None`` if any environment hasn't been
+            polled yet; environments whose polls have only failed are rendered
+            with libstatus.error_environment_data
+
+        """
+        now = time.monotonic()
+        data = []
+        age = 0
+        with self._lock:
+            for service in system.services:
+                environments_data = []
+                for environment in service.environments:
+                    state = self._states.get(environment.host)
+                    if state is None:
+                        return None
+                    if state.data is None:
+                        # NOTE(willkg): a host that's down shouldn't keep the
+                        # whole system out of the snapshot
+                        environments_data.append(
+                            error_environment_data(environment, state.error)
+                        )
+                        continue
+                    environments_data.append(dict(state.data, name=environment.name))
+                    age = max(age, now - state.fetched_at)
+                data.append(
+                    {
+                        "name": service.name,
+                        "description": service.description or "--",
+                        "environments": environments_data,
+                    }
+                )
+        return data, age
+
+    def age(self):
+        """Returns the age in seconds of the oldest environment or None"""
+        now = time.monotonic()
+        with self._lock:
+            ages = [
+                now - state.fetched_at
+                for state in self._states.values()
+                if state.fetched_at is not None
+            ]
+        return max(ages) if ages else None
+
+    def stats(self):
+        with self._lock:
+            intervals = [state.interval for state in self._states.values()]
+            errors = sum(1 for state in self._states.values() if state.error)
+        age = self.age()
+        return {
+            "environments": len(intervals),
+            "errors": errors,
+            "age": round(age, 3) if age is not None else None,
+            "min_interval": min(intervals, default=None),
+            "max_interval": max(intervals, default=None),
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_due()
+            except Exception:
+                LOGGER.exception("snapshot refresh failed")
+            self._wake.wait(self.tick)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="snapshot-refresher", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
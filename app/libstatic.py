@@ -0,0 +1,243 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Fingerprinted, precompressed static assets.
+
+Every file in the static directory is served under its own name and under a name
+with a hash of its contents, like ``bootstrap.min.0123456789.css``. Templates
+link to the hashed names with ``static_url``, which browsers can cache forever
+since the name changes whenever the contents do.
+
+Compressed variants are served by ``Accept-Encoding``. Brotli and gzip variants
+at their best compression are written by running this module, which the Docker
+image build does::
+
+    python -m app.libstatic app/static
+
+Without them, gzip variants are built when the app starts.
+"""
+
+import argparse
+import functools
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+import brotli
+from flask import Response, request
+
+LOGGER = logging.getLogger(__name__)
+
+# Hashed names never change contents, so browsers can keep them for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Unhashed names are revalidated with the ETag
+MUTABLE_CACHE_CONTROL = "no-cache"
+
+# Encodings in order of preference and the suffix of their precompressed files
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+COMPRESSED_SUFFIXES = tuple(suffix for _, suffix in ENCODINGS)
+
+
+def is_compressible(content_type):
+    return content_type.startswith("text/") or content_type in (
+        "application/javascript",
+        "application/json",
+        "image/svg+xml",
+        "image/vnd.microsoft.icon",
+        "image/x-icon",
+    )
+
+
+def guess_type(filename):
+    # NOTE(willkg): source maps are JSON but mimetypes doesn't know them
+    if filename.endswith(".map"):
+        return "application/json"
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def hashed_name(filename, digest):
+    """Returns filename with digest before the last suffix
+
+    >>> hashed_name("css/site.min.css", "abc123")
+    'css/site.min.abc123.css'
+
+    """
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{digest}{ext}"
+
+
+class StaticAsset:
+    __slots__ = ("content_type", "digest", "hashed_name", "name", "variants")
+
+    def __init__(self, name, hashed_name, content_type, digest, variants):
+        self.name = name
+        self.hashed_name = hashed_name
+        self.content_type = content_type
+        self.digest = digest
+        # Dict of encoding -> bytes; None is the uncompressed contents
+        self.variants = variants
+
+
+class StaticAssets:
+    """Serves the files in a static directory from memory
+
+    Files are read, hashed and compressed once when this is created. Precompressed
+    ``.br`` and ``.gz`` files next to a file are used when they're there and up to
+    date. Otherwise a gzip variant is built in memory. Variants that aren't smaller than
+    the file aren't kept.
+
+    :arg directory: the static directory
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._assets = {}
+        self._hashed = {}
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                if filename.endswith(COMPRESSED_SUFFIXES):
+                    continue
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, "/")
+                asset = self._load(name, path)
+                self._assets[name] = asset
+                self._hashed[asset.hashed_name] = asset
+
+    def _load(self, name, path):
+        with open(path, "rb") as fp:
+            content = fp.read()
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        content_type = guess_type(name)
+
+        variants = {None: content}
+        if is_compressible(content_type):
+            mtime = os.stat(path).st_mtime
+            for encoding, suffix in ENCODINGS:
+                # NOTE(willkg): a precompressed file older than the file is left
+                # over from before it changed
+                if (
+                    os.path.exists(path + suffix)
+                    and os.stat(path + suffix).st_mtime >= mtime
+                ):
+                    with open(path + suffix, "rb") as fp:
+                        variants[encoding] = fp.read()
+            if "gzip" not in variants:
+                variants["gzip"] = gzip.compress(content, mtime=0)
+            variants = {
+                encoding: data
+                for encoding, data in variants.items()
+                if encoding is None or len(data) < len(content)
+            }
+
+        return StaticAsset(
+            name=name,
+            hashed_name=hashed_name(name, digest),
+            content_type=content_type,
+            digest=digest,
+            variants=variants,
+        )
+
+    def url(self, filename):
+        """Returns the hashed name for a file or filename if it isn't an asset"""
+        asset = self._assets.get(filename)
+        if asset is None:
+            LOGGER.warning("unknown static asset %s", filename)
+            return filename
+        return asset.hashed_name
+
+    def response(self, filename):
+        """Builds the response for a static file for the current request
+
+        :arg filename: the requested name, hashed or not
+
+        :returns: a flask Response or None if there's no such file
+
+        """
+        asset = self._hashed.get(filename)
+        cache_control = IMMUTABLE_CACHE_CONTROL
+        if asset is None:
+            asset = self._assets.get(filename)
+            cache_control = MUTABLE_CACHE_CONTROL
+        if asset is None:
+            return None
+
+        encoding = next(
+            (
+                encoding
+                for encoding, _ in ENCODINGS
+                if encoding in asset.variants and encoding in request.accept_encodings
+            ),
+            None,
+        )
+        # NOTE(willkg): strong ETags are per representation
+        etag = f"{asset.digest}-{encoding}" if encoding else asset.digest
+
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        else:
+            resp = Response(asset.variants[encoding], mimetype=asset.content_type)
+            if encoding:
+                resp.headers["Content-Encoding"] = encoding
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = cache_control
+        if len(asset.variants) > 1:
+            resp.vary.add("Accept-Encoding")
+        return resp
+
+
+@functools.cache
+def get_static_assets(directory):
+    """Returns the StaticAssets for a directory, loading it the first time"""
+    return StaticAssets(directory)
+
+
+def compress_directory(directory):
+    """Writes precompressed variants next to compressible files in a directory
+
+    :arg directory: the static directory
+
+    :returns: list of paths written
+
+    """
+    written = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if filename.endswith(COMPRESSED_SUFFIXES) or not is_compressible(
+                guess_type(filename)
+            ):
+                continue
+            path = os.path.join(dirpath, filename)
+            with open(path, "rb") as fp:
+                content = fp.read()
+
+            variants = {
+                ".br": brotli.compress(content),
+                ".gz": gzip.compress(content, compresslevel=9, mtime=0),
+            }
+            for suffix, data in variants.items():
+                with open(path + suffix, "wb") as fp:
+                    fp.write(data)
+                written.append(path + suffix)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Write precompressed variants of static files."
+    )
+    parser.add_argument("directory", help="static directory")
+    args = parser.parse_args(argv)
+
+    for path in compress_directory(args.directory):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import functools
+from urllib.parse import urlparse
+
+from app.libdeadline import use_deadline
+from app.libgithub import get_history_planner
+from app.libupstream import VERSION_CACHE, fan_out, fan_out_iter, fetch_version
+
+
+def get_version_data(environment, fresh=False):
+    """Fetches the deployed version of an environment
+
+    :arg environment: a libsystems.Environment
+    :arg fresh: if True, bypasses cached versions
+
+    :returns: dict of environment data without history
+
+    :raises requests.exceptions.RequestException: if the fetch fails
+
+    """
+    return make_version_data(environment, fetch_version(environment.host, fresh=fresh))
+
+
+def make_version_data(environment, host_version):
+    """Returns environment data without history from /__version__ data
+
+    :arg environment: a libsystems.Environment
+    :arg host_version: the host's /__version__ data
+
+    :returns: dict of environment data without history
+
+    """
+    environment_data = {
+        "name": environment.name,
+        "host": environment.host,
+    }
+    environment_data["commit"] = host_version["commit"]
+    environment_data["source"] = host_version["source"]
+    environment_data["tag"] = host_version.get("version") or "(none)"
+    parsed = urlparse(environment_data["source"])
+    _, user, repo = parsed.path.split("/")
+
+    environment_data["user"] = user
+    environment_data["repo"] = repo
+    return environment_data
+
+
+def add_history(environment_data, planner):
+    """Adds status and commits to environment data from get_version_data
+
+    :arg environment_data: dict from get_version_data
+    :arg planner: history planner from libgithub.get_history_planner
+
+    :returns: environment_data
+
+    :raises requests.exceptions.RequestException: if a fetch fails
+
+    """
+    history = planner.get_history(
+        user=environment_data["user"],
+        repo=environment_data["repo"],
+        from_sha=environment_data["commit"],
+    )
+
+    if history.total_commits == 0:
+        environment_data["status"] = "up-to-date"
+        environment_data["commits"] = []
+
+    else:
+        environment_data["status"] = f"{history.total_commits} commits behind"
+        # output.append(
+        #     f"  https://github.com/{user}/{repo}/compare/{commit[:8]}...main"
+        # )
+
+        commit_data = []
+        for i, commit in enumerate(history.commits):
+            if commit.parents > 1:
+                # Skip merge commits
+                continue
+
+            commit_data.append(
+                {
+                    "sha": commit.sha,
+                    "is_head": i == 0,
+                    "message": commit.message,
+                    "author": commit.author,
+                }
+            )
+        environment_data["commits"] = commit_data
+
+    return environment_data
+
+
+def get_environment_data(environment, planner=None, fresh=False):
+    """Fetches the deployed version of an environment and its history
+
+    :arg environment: a libsystems.Environment
+    :arg planner: history planner shared by environments fetched together
+    :arg fresh: if True, bypasses cached versions
+
+    :returns: dict of environment data for rendering
+
+    :raises requests.exceptions.RequestException: if an upstream fetch fails
+
+    """
+    planner = planner or get_history_planner()
+    return add_history(get_version_data(environment, fresh=fresh), planner)
+
+
+def get_environments_data(
+    environments, fresh=False, return_exceptions=False, deadline=None
+):
+    """Fetches data for a batch of environments concurrently
+
+    With a batched history planner, all versions are fetched first and then all
+    histories are fetched together. Otherwise each environment's history is
+    fetched as soon as its version is in.
+
+    :arg environments: list of libsystems.Environment
+    :arg fresh: if True, bypasses cached versions
+    :arg return_exceptions: if True, exceptions are returned in place of the data
+        for environments that failed rather than raised
+    :arg deadline: optional libdeadline.Deadline shared by all the fetches
+
+    :returns: list of environment data dicts in the same order
+
+    :raises requests.exceptions.RequestException: if an upstream fetch fails and
+        return_exceptions is False
+
+    """
+    planner = get_history_planner()
+    if not planner.batched:
+        return fan_out(
+            functools.partial(get_environment_data, planner=planner, fresh=fresh),
+            environments,
+            return_exceptions=return_exceptions,
+            deadline=deadline,
+        )
+
+    versions = fan_out(
+        functools.partial(get_version_data, fresh=fresh),
+        environments,
+        return_exceptions=return_exceptions,
+        deadline=deadline,
+    )
+    try:
+        with use_deadline(deadline):
+            planner.prime(
+                [
+                    (item["user"], item["repo"], item["commit"])
+                    for item in versions
+                    if not isinstance(item, Exception)
+                ]
+            )
+    except Exception as exc:
+        if not return_exceptions:
+            raise
+        return [item if isinstance(item, Exception) else exc for item in versions]
+
+    return [
+        item if isinstance(item, Exception) else add_history(item, planner)
+        for item in versions
+    ]
+
+
+def error_environment_data(environment, exc):
+    """Returns environment data for rendering an environment that failed
+
+    The status is unknown. If there's a last known version for the environment,
+    even an expired one, it's included so the page still shows what was deployed.
+
+    :arg environment: a libsystems.Environment
+    :arg exc: the exception the environment failed with or its message
+
+    :returns: dict of environment data for rendering
+
+    """
+    environment_data = {
+        "name": environment.name,
+        "host": environment.host,
+        "status": "unknown",
+        "error": str(exc),
+        "commits": [],
+    }
+    last_known = VERSION_CACHE.get(f"{environment.host}/__version__")
+    if last_known is not None:
+        host_version, age = last_known
+        environment_data["status"] = "unknown/stale"
+        environment_data["error"] = f"{exc}; showing the version from {int(age)}s ago"
+        environment_data["commit"] = host_version["commit"]
+        environment_data["source"] = host_version["source"]
+        environment_data["tag"] = host_version.get("version") or "(none)"
+    return environment_data
+
+
+def iter_services(system, results):
+    # Groups environment results back into services, rendering failed environments
+    # with error_environment_data
+    results = iter(results)
+    for service in system.services:
+        environments_data = []
+        for environment in service.environments:
+            result = next(results)
+            if isinstance(result, Exception):
+                result = error_environment_data(environment, result)
+            environments_data.append(result)
+        yield {
+            "name": service.name,
+            "description": service.description or "--",
+            "environments": environments_data,
+        }
+
+
+def system_environments(system):
+    return [
+        environment
+        for service in system.services
+        for environment in service.environments
+    ]
+
+
+def get_system_data(system, deadline=None):
+    """Fetches data for all environments of a system concurrently
+
+    Environments that fail or miss the deadline are rendered with
+    error_environment_data rather than failing the whole system.
+
+    :arg system: a libsystems.System
+    :arg deadline: optional libdeadline.Deadline for all the fetches
+
+    :returns: list of service data dicts for rendering
+
+    """
+    results = get_environments_data(
+        system_environments(system), return_exceptions=True, deadline=deadline
+    )
+    return list(iter_services(system, results))
+
+
+def overview_from_results(systems, results):
+    """Builds status data for every system from results for each unique host
+
+    :arg systems: a libsystems.Systems
+    :arg results: dict of host -> environment data dict or the exception it failed
+        with
+
+    :returns: dict of system name -> list of service data dicts
+
+    """
+    overview = {}
+    for name, system in sorted(systems.systems.items()):
+        # NOTE(willkg): a host's data is shared by every environment with that
+        # host, so it's copied with the environment's own name
+        system_results = []
+        for environment in system_environments(system):
+            result = results[environment.host]
+            if not isinstance(result, Exception):
+                result = dict(result, name=environment.name)
+            system_results.append(result)
+        overview[name] = list(iter_services(system, system_results))
+    return overview
+
+
+def get_overview_data(systems, deadline=None):
+    """Fetches data for every environment of every system in one pass
+
+    Each host is fetched once no matter how many systems it's in, and one history
+    planner is shared by all of them, so each repository's history is fetched once
+    too.
+
+    :arg systems: a libsystems.Systems
+    :arg deadline: optional libdeadline.Deadline for all the fetches
+
+    :returns: dict of system name -> list of service data dicts
+
+    """
+    hosts = systems.hosts
+    results = get_environments_data(
+        list(hosts.values()), return_exceptions=True, deadline=deadline
+    )
+    return overview_from_results(systems, dict(zip(hosts, results)))
+
+
+def summarize_overview(overview):
+    """Returns counts of environments by status and of unique hosts and repos
+
+    :arg overview: dict of system name -> list of service data dicts
+
+    :returns: dict of counts
+
+    """
+    statuses = {"up-to-date": 0, "behind": 0, "unknown": 0}
+    hosts = set()
+    repos = set()
+    environments = 0
+    for services in overview.values():
+        for service in services:
+            for env in service["environments"]:
+                environments += 1
+                hosts.add(env["host"])
+                if "user" in env:
+                    repos.add((env["user"].lower(), env["repo"].lower()))
+                if env["status"] == "up-to-date":
+                    statuses["up-to-date"] += 1
+                elif env["status"].endswith("behind"):
+                    statuses["behind"] += 1
+                else:
+                    statuses["unknown"] += 1
+    return {
+        "systems": len(overview),
+        "environments": environments,
+        "hosts": len(hosts),
+        "repos": len(repos),
+        "statuses": statuses,
+    }
+
+
+def iter_system_data(system, deadline=None):
+    """Yields service data for a system in order as soon as each service is in
+
+    Like get_system_data, failed environments are rendered with
+    error_environment_data.
+
+    :arg system: a libsystems.System
+    :arg deadline: optional libdeadline.Deadline for all the fetches
+
+    :returns: generator of service data dicts for rendering
+
+    """
+    environments = system_environments(system)
+    planner = get_history_planner()
+    if planner.batched:
+        # NOTE(willkg): batched planners fetch all histories together, so nothing
+        # is in until everything is
+        results = get_environments_data(
+            environments, return_exceptions=True, deadline=deadline
+        )
+    else:
+        results = fan_out_iter(
+            functools.partial(get_environment_data, planner=planner),
+            environments,
+            return_exceptions=True,
+            deadline=deadline,
+        )
+    yield from iter_services(system, results)
@@ -2,25 +2,39 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import functools
 import json
+import logging
+import os
+import threading
+import time
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, PrivateAttr
 import yaml
 
+from app.settings import settings
+
+
+LOGGER = logging.getLogger(__name__)
+
 
 class Environment(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     name: str
     host: str
 
 
 class Service(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     name: str
     description: str | None = None
     environments: list[Environment]
 
 
 class System(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     services: list[Service]
 
     def __len__(self):
@@ -28,16 +42,156 @@ class System(BaseModel):
 
 
 class Systems(BaseModel):
+    """Validated systems configuration with indexes built when it's loaded
+
+    Instances are frozen so they can be shared by requests while a reload swaps
+    in a new one.
+
+    """
+
+    model_config = ConfigDict(frozen=True)
+
     systems: dict[str, System]
 
+    # List of (system name, number of services) sorted by system name
+    _system_list: list = PrivateAttr(default_factory=list)
+    # Dict of host -> Environment; environments with the same host share one
+    _hosts: dict = PrivateAttr(default_factory=dict)
+    # Dict of host -> list of (system name, service name, environment name)
+    _host_environments: dict = PrivateAttr(default_factory=dict)
+
+    def model_post_init(self, context):
+        self._system_list = sorted(
+            (name, len(system)) for name, system in self.systems.items()
+        )
+        for system_name, system in sorted(self.systems.items()):
+            for service in system.services:
+                for environment in service.environments:
+                    self._hosts.setdefault(environment.host, environment)
+                    self._host_environments.setdefault(environment.host, []).append(
+                        (system_name, service.name, environment.name)
+                    )
+
+    @property
+    def system_list(self):
+        return self._system_list
+
+    @property
+    def hosts(self):
+        return self._hosts
+
+    def environments_for_host(self, host):
+        """Returns list of (system name, service name, environment name) for a host"""
+        return self._host_environments.get(host, [])
+
+
+class SystemsConfig:
+    """Loads the systems configuration file and reloads it when it changes
+
+    The file's mtime is checked at most every ``check_interval`` seconds. When it
+    changed, the file is loaded and validated and the new Systems is swapped in.
+    If the new file doesn't load or validate, the error is logged and the last good
+    Systems is kept.
+
+    :arg path: path to the systems yaml file
+    :arg check_interval: seconds between mtime checks; 0 checks on every call
+
+    """
+
+    def __init__(self, path, check_interval):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._systems = None
+        self._mtime = None
+        self._checked_at = None
+        self.loaded_at = None
+        self.reloads = 0
+        self.errors = 0
+        self.last_error = None
+
+    def _load(self):
+        with open(self.path, "rb") as fp:
+            data = yaml.safe_load(fp)
+        return Systems.model_validate(data)
+
+    def _check(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as exc:
+            if self._systems is None:
+                raise
+            self._record_error(exc)
+            return
+
+        if mtime == self._mtime:
+            return
+
+        try:
+            systems = self._load()
+        except Exception as exc:
+            if self._systems is None:
+                raise
+            self._record_error(exc)
+            # NOTE(willkg): remember the mtime so a bad file isn't reloaded and
+            # logged on every check; the next edit gets loaded
+            self._mtime = mtime
+            return
+
+        if self._systems is not None:
+            self.reloads += 1
+            LOGGER.info("reloaded systems configuration from %s", self.path)
+        self._systems = systems
+        self._mtime = mtime
+        self.loaded_at = time.time()
+
+    def _record_error(self, exc):
+        self.errors += 1
+        self.last_error = str(exc)
+        LOGGER.error("systems configuration %s not reloaded: %s", self.path, exc)
+
+    def get(self):
+        """Returns the current Systems
+
+        :raises OSError: if the file can't be read the first time
+        :raises pydantic.ValidationError: if the file isn't valid the first time
+
+        """
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return self._systems
+
+        with self._lock:
+            if self._checked_at is None or (
+                now - self._checked_at >= self.check_interval
+            ):
+                self._check()
+                self._checked_at = now
+            return self._systems
+
+    def stats(self):
+        systems = self._systems
+        return {
+            "path": self.path,
+            "loaded_at": self.loaded_at,
+            "systems": len(systems.systems) if systems is not None else None,
+            "hosts": len(systems.hosts) if systems is not None else None,
+            "reloads": self.reloads,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+# NOTE(willkg): the default path is relative to repository root
+SYSTEMS_CONFIG = SystemsConfig(
+    path=settings.APP_SYSTEMS_PATH,
+    check_interval=settings.APP_SYSTEMS_CHECK_INTERVAL,
+)
 
-@functools.cache
-def get_systems_data():
-    # NOTE(willkg): relative to repository root
-    with open("app/systems.yaml", "rb") as fp:
-        data = yaml.safe_load(fp)
 
-    return Systems.model_validate(data)
+def get_systems_data():
+    return SYSTEMS_CONFIG.get()
 
 
 def print_schema():
@@ -0,0 +1,452 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+import stamina
+
+from app.libcache import TTLCache
+from app.libdeadline import (
+    check_deadline,
+    clamp_timeout,
+    current_deadline,
+    is_retryable,
+    use_deadline,
+)
+from app.libhttp import HTTP_CLIENT
+from app.observability import span
+from app.settings import settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class HostLimiter:
+    """Caps the number of in-flight requests to any single upstream host."""
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _get_semaphore(self, host):
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_per_host)
+                self._semaphores[host] = semaphore
+            return semaphore
+
+    @contextlib.contextmanager
+    def limit(self, url):
+        with self._get_semaphore(urlparse(url).netloc):
+            yield
+
+
+HOST_LIMITER = HostLimiter(max_per_host=settings.APP_FETCH_MAX_PER_HOST)
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """Raised instead of calling a host whose circuit is open"""
+
+    # NOTE(willkg): retrying would fail fast anyway
+    retryable = False
+
+
+class Circuit:
+    __slots__ = ("failures", "opened_at", "state")
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+
+
+class CircuitBreakers:
+    """Per-host circuit breakers for upstream calls
+
+    A host's circuit is closed to start with and calls go through. After
+    ``failure_threshold`` failures in a row, it opens and calls fail fast with
+    CircuitOpen. Once ``cooldown`` seconds have passed, it's half-open: one call is
+    let through as a probe while the others keep failing fast. If the probe works,
+    the circuit closes; if it fails, the circuit opens again.
+
+    Connection errors, timeouts and 5xx responses are failures. Other responses
+    mean the host is up.
+
+    :arg failure_threshold: failures in a row that open a circuit
+    :arg cooldown: seconds a circuit stays open before a probe
+
+    """
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._circuits = {}
+        self.rejected = 0
+
+    @staticmethod
+    def is_failure(exc):
+        if isinstance(exc, requests.exceptions.HTTPError):
+            return exc.response is None or exc.response.status_code >= 500
+        return isinstance(exc, requests.exceptions.RequestException)
+
+    def _allow(self, host):
+        with self._lock:
+            circuit = self._circuits.setdefault(host, Circuit())
+            if circuit.state == "open":
+                if time.monotonic() - circuit.opened_at >= self.cooldown:
+                    circuit.state = "half-open"
+                    return
+            elif circuit.state == "closed":
+                return
+            self.rejected += 1
+            state = circuit.state
+        raise CircuitOpen(f"circuit for {host} is {state}")
+
+    def _record(self, host, failed):
+        with self._lock:
+            circuit = self._circuits.setdefault(host, Circuit())
+            if not failed:
+                circuit.state = "closed"
+                circuit.failures = 0
+                return
+
+            circuit.failures += 1
+            if (
+                circuit.state == "half-open"
+                or circuit.failures >= self.failure_threshold
+            ):
+                if circuit.state != "open":
+                    LOGGER.warning("circuit for %s opened", host)
+                circuit.state = "open"
+                circuit.opened_at = time.monotonic()
+
+    @contextlib.contextmanager
+    def guard(self, url):
+        """Wraps a call to url
+
+        :raises CircuitOpen: if the host's circuit is open
+
+        """
+        host = urlparse(url).netloc
+        self._allow(host)
+        try:
+            yield
+        except Exception as exc:
+            self._record(host, failed=self.is_failure(exc))
+            raise
+        else:
+            self._record(host, failed=False)
+
+    def clear(self):
+        with self._lock:
+            self._circuits.clear()
+            self.rejected = 0
+
+    def state(self, url):
+        with self._lock:
+            circuit = self._circuits.get(urlparse(url).netloc)
+            return circuit.state if circuit is not None else "closed"
+
+    def not_closed(self):
+        """Returns a sorted list of hosts whose circuits aren't closed"""
+        with self._lock:
+            return sorted(
+                host
+                for host, circuit in self._circuits.items()
+                if circuit.state != "closed"
+            )
+
+    def stats(self):
+        with self._lock:
+            states = collections.Counter(
+                circuit.state for circuit in self._circuits.values()
+            )
+            return {
+                "closed": states["closed"],
+                "open": states["open"],
+                "half_open": states["half-open"],
+                "rejected": self.rejected,
+            }
+
+
+BREAKERS = CircuitBreakers(
+    failure_threshold=settings.APP_BREAKER_FAILURE_THRESHOLD,
+    cooldown=settings.APP_BREAKER_COOLDOWN,
+)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into a single call
+
+    While a call for a key is in flight, other callers for that key wait for it and
+    get its result (or exception) instead of making their own call.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fun):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fun()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._in_flight),
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+            }
+
+
+# NOTE(willkg): keys are urls, so this is shared by all upstream fetches
+SINGLE_FLIGHT = SingleFlight()
+
+
+@functools.cache
+def get_executor():
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=settings.APP_FETCH_MAX_WORKERS,
+        thread_name_prefix="fetch",
+    )
+
+
+@functools.cache
+def get_hedge_executor():
+    # NOTE(willkg): hedged calls are made from fetch workers, so they get their own
+    # pool to avoid waiting on themselves
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=settings.APP_FETCH_MAX_WORKERS * 2,
+        thread_name_prefix="hedge",
+    )
+
+
+def fan_out(fun, items, return_exceptions=False, deadline=None):
+    """Calls fun on each item concurrently and returns the results in order
+
+    If any call raises an exception, the exception for the earliest item is
+    re-raised once that item has finished. If return_exceptions is True,
+    exceptions are returned in place of results instead.
+
+    Calls run with the caller's context variables. If there's a deadline, calls run
+    with it and items that aren't done when it passes get DeadlineExceeded. The
+    calls themselves carry on in the background.
+
+    :arg deadline: a libdeadline.Deadline; defaults to the current deadline
+
+    """
+    return list(
+        fan_out_iter(fun, items, return_exceptions=return_exceptions, deadline=deadline)
+    )
+
+
+def fan_out_iter(fun, items, return_exceptions=False, deadline=None):
+    """Like fan_out, but yields each result in order as soon as it's in
+
+    All calls are started on the first iteration.
+
+    """
+    deadline = deadline or current_deadline()
+
+    def call(item):
+        with use_deadline(deadline):
+            return fun(item)
+
+    executor = get_executor()
+    futures = [
+        executor.submit(contextvars.copy_context().run, call, item) for item in items
+    ]
+    for future in futures:
+        timeout = deadline.remaining() if deadline is not None else None
+        try:
+            exc = future.exception(timeout=timeout)
+        except TimeoutError:
+            exc = deadline.exceeded()
+
+        if exc is None:
+            yield future.result()
+        elif return_exceptions:
+            yield exc
+        else:
+            raise exc
+
+
+class Hedger:
+    """Hedges slow calls by making a second call and using whichever is done first
+
+    A call that hasn't finished after the given percentile of recent call latencies
+    gets a second, identical call. Until there are enough samples, calls aren't
+    hedged.
+
+    :arg percentile: latency percentile in (0, 100) to hedge after; 0 disables
+        hedging
+    :arg min_delay: shortest seconds to wait before hedging
+    :arg window: number of recent latencies to keep
+    :arg min_samples: number of latencies needed before hedging
+
+    """
+
+    def __init__(self, percentile, min_delay, window=256, min_samples=20):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def delay(self):
+        """Returns seconds to wait before hedging or None to not hedge"""
+        if not self.percentile:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(latencies[index], self.min_delay)
+
+    def _timed(self, fun):
+        start_time = time.monotonic()
+        result = fun()
+        with self._lock:
+            self._latencies.append(time.monotonic() - start_time)
+        return result
+
+    def call(self, fun):
+        """Calls fun, hedging it if it's slow, and returns the first result
+
+        :raises Exception: what fun raises if both calls fail
+        :raises DeadlineExceeded: if the deadline passes before either call is done
+
+        """
+        with self._lock:
+            self.calls += 1
+        delay = self.delay()
+        if delay is None:
+            return self._timed(fun)
+
+        executor = get_hedge_executor()
+        timed = functools.partial(self._timed, fun)
+        first = executor.submit(contextvars.copy_context().run, timed)
+        try:
+            return first.result(timeout=delay)
+        except TimeoutError:
+            pass
+
+        with self._lock:
+            self.hedged += 1
+        second = executor.submit(contextvars.copy_context().run, timed)
+
+        deadline = current_deadline()
+        timeout = deadline.remaining() if deadline is not None else None
+        errors = []
+        try:
+            for future in concurrent.futures.as_completed(
+                [first, second], timeout=timeout
+            ):
+                if future.exception() is None:
+                    if future is second:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return future.result()
+                errors.append(future.exception())
+        except TimeoutError:
+            raise deadline.exceeded() from None
+        raise errors[0]
+
+    def stats(self):
+        delay = self.delay()
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "delay": round(delay, 3) if delay is not None else None,
+            }
+
+
+VERSION_HEDGER = Hedger(
+    percentile=settings.APP_VERSION_HEDGE_PERCENTILE,
+    min_delay=settings.APP_VERSION_HEDGE_MIN_DELAY,
+)
+
+
+@stamina.retry(on=is_retryable, attempts=3)
+def _fetch(url):
+    check_deadline()
+    # NOTE(willkg): the host limit is held per attempt so that retry backoff doesn't
+    # hold a slot
+    with BREAKERS.guard(url), HOST_LIMITER.limit(url):
+        resp = HTTP_CLIENT.get(url, timeout=clamp_timeout(HTTP_CLIENT.timeout))
+        # FIXME(willkg): handle 429s, retrying, and other response codes
+        resp.raise_for_status()
+    return resp.json()
+
+
+def fetch(url):
+    return SINGLE_FLIGHT.do(
+        url, functools.partial(VERSION_HEDGER.call, functools.partial(_fetch, url))
+    )
+
+
+VERSION_CACHE = TTLCache(
+    maxsize=settings.APP_VERSION_CACHE_MAX_SIZE,
+    ttl=settings.APP_VERSION_CACHE_TTL,
+    stale_ttl=settings.APP_VERSION_CACHE_STALE_TTL,
+    submit=lambda fun: get_executor().submit(fun),
+)
+
+
+def fetch_version(host, fresh=False):
+    """Returns the /__version__ data for a host, going through VERSION_CACHE
+
+    :arg host: the environment host
+    :arg fresh: if True, skips the cache lookup and stores the fetched value
+
+    """
+    url = f"{host}/__version__"
+    with span("version", host=host):
+        if fresh:
+            value = fetch(url)
+            VERSION_CACHE.set(url, value)
+            return value
+        return VERSION_CACHE.get_or_fetch(url, functools.partial(fetch, url))
@@ -0,0 +1,129 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Webhooks that invalidate cached data when repositories and environments change.
+
+Both kinds of webhook are signed the way GitHub signs them: the
+``X-Hub-Signature-256`` header is ``sha256=`` followed by the hex HMAC-SHA256 of
+the request body using the shared secret.
+
+GitHub ``push`` events for main invalidate the repository's cached GitHub
+responses and mark environments deployed from it as due in the snapshot.
+
+Deploy notifications are JSON like::
+
+    {"host": "https://example.com", "commit": "<sha>"}
+
+and invalidate the host's cached ``/__version__`` data and mark it as due in the
+snapshot.
+"""
+
+import hashlib
+import hmac
+import logging
+
+from app.libgithub import GITHUB_API, GITHUB_CACHE
+from app.libupstream import VERSION_CACHE
+
+LOGGER = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "X-Hub-Signature-256"
+
+
+class WebhookError(Exception):
+    """Raised when a webhook payload is missing something it needs"""
+
+
+def sign(secret, body):
+    """Returns the signature header value for a body"""
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def verify_signature(secret, body, signature):
+    """Returns whether signature is the signature of body
+
+    :arg secret: the shared secret
+    :arg body: the raw request body as bytes
+    :arg signature: the signature header value or None
+
+    """
+    if not secret or not signature:
+        return False
+    return hmac.compare_digest(sign(secret, body), signature)
+
+
+def handle_push(payload, refresher):
+    """Invalidates what a push to a repository makes out of date
+
+    Pushes to branches other than main are ignored since histories are worked out
+    against main.
+
+    :arg payload: the decoded GitHub push event
+    :arg refresher: the SnapshotRefresher or None
+
+    :returns: dict summarizing what was invalidated
+
+    :raises WebhookError: if the payload isn't a push event
+
+    """
+    try:
+        ref = payload["ref"]
+        user, repo = payload["repository"]["full_name"].split("/")
+    except (KeyError, TypeError, ValueError) as exc:
+        raise WebhookError(f"not a push event: {exc}") from exc
+
+    result = {"repository": f"{user}/{repo}", "github_cache": 0, "environments": 0}
+    if ref != "refs/heads/main":
+        return result
+
+    # NOTE(willkg): GitHub owner and repository names are case-insensitive, but
+    # cache keys use the case from the environment's source url
+    prefix = f"{GITHUB_API}/repos/{user}/{repo}/"
+    result["github_cache"] = GITHUB_CACHE.invalidate_prefix(prefix, ignore_case=True)
+    if refresher is not None:
+        result["environments"] = refresher.mark_due(repo=(user, repo))
+    LOGGER.info(
+        "push to %s/%s: invalidated %s github responses, %s environments",
+        user,
+        repo,
+        result["github_cache"],
+        result["environments"],
+    )
+    return result
+
+
+def handle_deploy(payload, hosts, refresher):
+    """Invalidates what a deploy to a host makes out of date
+
+    :arg payload: the decoded deploy notification
+    :arg hosts: the configured hosts; see libsystems.Systems.hosts
+    :arg refresher: the SnapshotRefresher or None
+
+    :returns: dict summarizing what was invalidated
+
+    :raises WebhookError: if the payload is missing the host or commit or the host
+        isn't configured
+
+    """
+    try:
+        host = payload["host"].rstrip("/")
+        commit = payload["commit"]
+    except (AttributeError, KeyError, TypeError) as exc:
+        raise WebhookError(f"not a deploy notification: {exc}") from exc
+
+    # NOTE(willkg): configured hosts may or may not end in a slash; caches and the
+    # snapshot use the host as it's configured
+    configured = {configured.rstrip("/"): configured for configured in hosts}
+    if host not in configured:
+        raise WebhookError(f"unknown host {host}")
+    host = configured[host]
+
+    VERSION_CACHE.invalidate(f"{host}/__version__")
+    result = {"host": host, "commit": commit, "environments": 0}
+    if refresher is not None:
+        result["environments"] = refresher.mark_due(host=host)
+    LOGGER.info("deploy of %s to %s: invalidated version", commit, host)
+    return result
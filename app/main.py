@@ -3,13 +3,11 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import functools
-import hashlib
 import json
 import logging
 import os
 import string
 import time
-from urllib.parse import urlparse
 
 from flask import (
     abort,
@@ -17,31 +15,52 @@ from flask import (
     jsonify,
     render_template,
     request,
-    send_from_directory,
+    Response,
+    stream_template,
+    url_for,
 )
-import requests
-import stamina
 
-from app.libsystems import get_systems_data
-from app.observability import log_settings, setup_logging
+from app.libapi import json_status_response, status_etag
+from app.libcache import SQLiteCache
+from app.libcpu import CPU_POOL, hash_text, PoolFull, TaskTimeout
+from app.libdeadline import Deadline
+from app.libgithub import GITHUB_CACHE, GRAPHQL_RATE_LIMIT, REST_RATE_LIMIT
+from app.libhttp import HTTP_CLIENT
+from app.libsnapshot import SnapshotRefresher
+from app.libstatic import get_static_assets
+from app.libstatus import (
+    get_overview_data,
+    get_system_data,
+    iter_system_data,
+    summarize_overview,
+)
+from app.libsystems import get_systems_data, SYSTEMS_CONFIG
+from app.libupstream import (
+    BREAKERS,
+    SINGLE_FLIGHT,
+    VERSION_CACHE,
+    VERSION_HEDGER,
+)
+from app.libwebhooks import (
+    handle_deploy,
+    handle_push,
+    SIGNATURE_HEADER,
+    verify_signature,
+    WebhookError,
+)
+from app.observability import (
+    log_settings,
+    METRICS,
+    setup_logging,
+    setup_metrics,
+    setup_timing,
+    span,
+    WEBHOOKS,
+)
 from app.settings import settings
 
 
-@stamina.retry(on=requests.exceptions.RequestException, attempts=3)
-def fetch(url):
-    resp = requests.get(url, timeout=5)
-    # FIXME(willkg): handle 429s, retrying, and other response codes
-    resp.raise_for_status()
-    return resp.json()
-
-
-@functools.lru_cache
-@stamina.retry(on=requests.exceptions.RequestException, attempts=3)
-def fetch_history_from_github(user, repo, from_sha):
-    url = f"https://api.github.com/repos/{user}/{repo}/compare/{from_sha}...main"
-    resp = requests.get(url, timeout=5)
-    resp.raise_for_status()
-    return resp.json()
+GITHUB_STATUS_URL = "https://www.githubstatus.com/api/v2/status.json"
 
 
 def log_render_time(fun):
@@ -50,7 +69,7 @@ def log_render_time(fun):
 
     @functools.wraps(fun)
     def _log_render_time(*args, **kwargs):
-        start_time = time.time()
+        start_time = time.perf_counter()
         status_code = 0
         try:
             ret = fun(*args, **kwargs)
@@ -58,6 +77,8 @@ def log_render_time(fun):
                 status_code = 200
             elif isinstance(ret, tuple) and isinstance(ret[1], int):
                 status_code = ret[1]
+            elif isinstance(ret, Response):
+                status_code = ret.status_code
             else:
                 logger.info("unknown return type: %s %s", type(ret), repr(ret)[:20])
             return ret
@@ -73,7 +94,7 @@ def log_render_time(fun):
                 "%s (%s) render time: %s",
                 fun_name,
                 status_code,
-                f"{time.time() - start_time:0.03f}s",
+                f"{time.perf_counter() - start_time:0.03f}s",
             )
 
     return _log_render_time
@@ -94,8 +115,141 @@ def get_version():
     return data
 
 
+def hit_ratio(hits, total):
+    return hits / total if total else 0.0
+
+
+def register_collectors(app):
+    """Exposes stats the app already keeps as metrics"""
+
+    def cache_lookups():
+        version = VERSION_CACHE.stats()
+        github = GITHUB_CACHE.stats()
+        return [
+            ({"cache": "version", "result": "hit"}, version["hits"]),
+            ({"cache": "version", "result": "stale"}, version["stale"]),
+            ({"cache": "version", "result": "miss"}, version["misses"]),
+            ({"cache": "github", "result": "hit"}, github["hits"]),
+            ({"cache": "github", "result": "revalidated"}, github["revalidated"]),
+            ({"cache": "github", "result": "unrevalidated"}, github["unrevalidated"]),
+            ({"cache": "github", "result": "miss"}, github["misses"]),
+        ]
+
+    def cache_hit_ratios():
+        version = VERSION_CACHE.stats()
+        github = GITHUB_CACHE.stats()
+        version_hits = version["hits"] + version["stale"]
+        github_hits = github["hits"] + github["revalidated"] + github["unrevalidated"]
+        return [
+            (
+                {"cache": "version"},
+                hit_ratio(version_hits, version_hits + version["misses"]),
+            ),
+            (
+                {"cache": "github"},
+                hit_ratio(github_hits, github_hits + github["misses"]),
+            ),
+        ]
+
+    def cache_bytes():
+        return [
+            ({"cache": "version"}, VERSION_CACHE.memory_usage()),
+            ({"cache": "github"}, GITHUB_CACHE.memory_usage()),
+        ]
+
+    def rate_limit_remaining():
+        return [
+            ({"api": "rest"}, REST_RATE_LIMIT.stats()["remaining"]),
+            ({"api": "graphql"}, GRAPHQL_RATE_LIMIT.stats()["remaining"]),
+        ]
+
+    def circuits():
+        stats = BREAKERS.stats()
+        return [
+            ({"state": state}, stats[state])
+            for state in ("closed", "open", "half_open")
+        ]
+
+    def snapshot_age():
+        refresher = app.extensions["snapshot_refresher"]
+        age = refresher.age() if refresher is not None else None
+        return [({}, age)] if age is not None else []
+
+    METRICS.collector(
+        "cache_lookups_total", "Cache lookups by result", cache_lookups, "counter"
+    )
+    METRICS.collector("cache_hit_ratio", "Ratio of cache lookups hit", cache_hit_ratios)
+    METRICS.collector("cache_bytes", "Estimated bytes held by caches", cache_bytes)
+    METRICS.collector(
+        "github_rate_limit_remaining",
+        "GitHub API calls left until the rate limit resets",
+        rate_limit_remaining,
+    )
+    METRICS.collector(
+        "circuit_breakers", "Environment host circuits by state", circuits
+    )
+    METRICS.collector(
+        "single_flight_coalesced_total",
+        "Upstream calls that waited on an identical call in flight",
+        lambda: [({}, SINGLE_FLIGHT.stats()["coalesced"])],
+        "counter",
+    )
+    METRICS.collector(
+        "cpu_pool_tasks",
+        "CPU-bound tasks in the process pool by state",
+        lambda: [
+            ({"state": state}, CPU_POOL.stats()[state])
+            for state in ("running", "queued")
+        ],
+    )
+    METRICS.collector(
+        "snapshot_age_seconds",
+        "Age of the oldest environment in the snapshot",
+        snapshot_age,
+    )
+
+
+def get_snapshot_system_data(app, system):
+    """Returns ``(data, snapshot_age)`` for a system from the snapshot or None"""
+    refresher = app.extensions["snapshot_refresher"]
+    if refresher is None:
+        return None
+    return refresher.get_system_data(system)
+
+
+def get_snapshot_overview_data(app, systems):
+    """Returns ``(overview, snapshot_age)`` for all systems from the snapshot or None
+
+    :arg systems: a libsystems.Systems
+
+    :returns: ``(overview, snapshot_age)`` if the snapshot has every system and
+        None otherwise
+
+    """
+    overview = {}
+    snapshot_age = 0
+    for name, system in sorted(systems.systems.items()):
+        snapshot = get_snapshot_system_data(app, system)
+        if snapshot is None:
+            return None
+        overview[name], age = snapshot
+        snapshot_age = max(snapshot_age, age)
+    return overview, snapshot_age
+
+
+def heartbeat_data(app, github_status):
+    # NOTE(willkg): environment hosts being down doesn't make this service
+    # unhealthy, so open circuits are reported but don't affect the status code
+    data = {"github": github_status, "open_circuits": BREAKERS.not_closed()}
+    refresher = app.extensions["snapshot_refresher"]
+    if refresher is not None:
+        data["snapshot_age"] = refresher.age()
+    return data
+
+
 def create_app(settings_overrides=None):
-    app = Flask(__name__)
+    # NOTE(willkg): static files are served by the "static" route below
+    app = Flask(__name__, static_folder=None)
     app.config.from_object("app.settings.settings")
 
     if settings_overrides:
@@ -107,20 +261,108 @@ def create_app(settings_overrides=None):
 
     log_settings(app)
 
+    persistent_cache = None
+    if app.config["APP_SQLITE_CACHE_PATH"]:
+        persistent_cache = SQLiteCache(
+            path=app.config["APP_SQLITE_CACHE_PATH"],
+            max_entries=app.config["APP_SQLITE_CACHE_MAX_ENTRIES"],
+        )
+        VERSION_CACHE.backing = persistent_cache.namespace(
+            "version", ttl=VERSION_CACHE.ttl + VERSION_CACHE.stale_ttl
+        )
+        GITHUB_CACHE.backing = persistent_cache.namespace(
+            "github", ttl=app.config["APP_SQLITE_CACHE_TTL"]
+        )
+    app.extensions["persistent_cache"] = persistent_cache
+
+    refresher = None
+    if app.config["APP_SNAPSHOT_ENABLED"]:
+        refresher = SnapshotRefresher(
+            get_systems=lambda: get_systems_data(),
+            min_interval=app.config["APP_SNAPSHOT_MIN_INTERVAL"],
+            max_interval=app.config["APP_SNAPSHOT_MAX_INTERVAL"],
+        )
+        refresher.start()
+    app.extensions["snapshot_refresher"] = refresher
+
+    # NOTE(willkg): set by libadmission.AdmissionMiddleware when it wraps the app
+    app.extensions["admission"] = None
+
+    static_assets = get_static_assets(os.path.join(app.root_path, "static"))
+
+    @app.template_global()
+    def static_url(filename):
+        """Returns the url of the fingerprinted version of a static file"""
+        return url_for("static", filename=static_assets.url(filename))
+
+    setup_metrics(app)
+    setup_timing(app)
+    register_collectors(app)
+
+    def load_systems():
+        with span("config"):
+            return get_systems_data()
+
+    def render(template_name, **context):
+        with span("render"):
+            return render_template(template_name, **context)
+
+    def get_snapshot_age():
+        refresher = app.extensions["snapshot_refresher"]
+        return refresher.age() if refresher is not None else None
+
+    def request_deadline():
+        return Deadline(app.config["APP_REQUEST_DEADLINE"])
+
+    def get_system_status(system, deadline):
+        """Returns ``(data, snapshot_age)`` for a system
+
+        Data comes from the snapshot if it has the system and is fetched otherwise,
+        in which case snapshot_age is None.
+
+        """
+        snapshot = get_snapshot_system_data(app, system)
+        if snapshot is not None:
+            return snapshot
+
+        # NOTE(willkg): the snapshot doesn't have this system yet (the refresher
+        # is disabled or still warming up), so fetch it now
+        return get_system_data(system, deadline=deadline), None
+
+    def get_overview_status(systems_data, deadline):
+        """Returns ``(overview, snapshot_age)`` for all systems
+
+        The overview comes from the snapshot if it has every system and is fetched
+        in one pass otherwise, in which case snapshot_age is None.
+
+        """
+        snapshot = get_snapshot_overview_data(app, systems_data)
+        if snapshot is not None:
+            return snapshot
+        return get_overview_data(systems_data, deadline=deadline), None
+
+    def api_response(data, systems_status):
+        return json_status_response(
+            data,
+            etag=status_etag(systems_status),
+            gzip_min_size=app.config["APP_API_GZIP_MIN_SIZE"],
+        )
+
+    def heartbeat_response(github_status, status_code):
+        return jsonify(heartbeat_data(app, github_status)), status_code
+
     @app.route("/__heartbeat__", methods=["GET"])
     @log_render_time
     def dockerflow_heartbeat():
         # Check GitHub status and return whether GitHub is up or not
-        resp = requests.get(
-            "https://www.githubstatus.com/api/v2/status.json", timeout=5
-        )
+        resp = HTTP_CLIENT.get(GITHUB_STATUS_URL)
         if resp.status_code != 200:
-            return jsonify({"github": resp.status_code}), 500
+            return heartbeat_response(resp.status_code, 500)
         data = resp.json()
         if data["status"]["indicator"] != "none":
-            return jsonify({"github": data["status"]["indicator"]}), 500
+            return heartbeat_response(data["status"]["indicator"], 500)
 
-        return jsonify({"github": "ok"}), 200
+        return heartbeat_response("ok", 200)
 
     @app.route("/__lbheartbeat__", methods=["GET"])
     @log_render_time
@@ -133,94 +375,176 @@ def create_app(settings_overrides=None):
     def dockerflow_version():
         return jsonify(get_version()), 200
 
+    @app.route("/__stats__", methods=["GET"])
+    @log_render_time
+    def stats_page():
+        # Returns internal stats for tuning caches and pools
+        refresher = app.extensions["snapshot_refresher"]
+        admission = app.extensions["admission"]
+        return jsonify(
+            {
+                "admission": admission.stats() if admission is not None else None,
+                "circuit_breakers": BREAKERS.stats(),
+                "cpu_pool": CPU_POOL.stats(),
+                "github_cache": GITHUB_CACHE.stats(),
+                "github_rate_limit": {
+                    "rest": REST_RATE_LIMIT.stats(),
+                    "graphql": GRAPHQL_RATE_LIMIT.stats(),
+                },
+                "http_pools": HTTP_CLIENT.stats(),
+                "persistent_cache": (
+                    persistent_cache.stats() if persistent_cache is not None else None
+                ),
+                "single_flight": SINGLE_FLIGHT.stats(),
+                "snapshot": refresher.stats() if refresher is not None else None,
+                "systems_config": SYSTEMS_CONFIG.stats(),
+                "version_cache": VERSION_CACHE.stats(),
+                "version_hedging": VERSION_HEDGER.stats(),
+            }
+        ), 200
+
+    @app.route("/__metrics__", methods=["GET"])
+    def metrics_page():
+        # Returns metrics in the Prometheus text format
+        if not app.config["APP_METRICS_ENABLED"]:
+            abort(404)
+        return Response(
+            METRICS.render_prometheus(),
+            mimetype="text/plain; version=0.0.4; charset=utf-8",
+        )
+
     @app.route("/", methods=["GET"])
     @log_render_time
     def index_page():
-        systems_data = get_systems_data()
-        systems = list(
-            sorted([(key, len(val)) for key, val in systems_data.systems.items()])
+        systems_data = load_systems()
+        return render(
+            "index.html",
+            systems=systems_data.system_list,
+            snapshot_age=get_snapshot_age(),
+        )
+
+    @app.route("/overview", methods=["GET"])
+    @log_render_time
+    def overview_page():
+        overview, snapshot_age = get_overview_status(load_systems(), request_deadline())
+        return render(
+            "overview.html",
+            overview=overview,
+            summary=summarize_overview(overview),
+            snapshot_age=snapshot_age,
         )
-        return render_template("index.html", systems=systems)
 
     @app.route("/system/<system>", methods=["GET"])
     @log_render_time
     def system_page(system):
-        def on_error(system, msg):
-            return render_template("system_error.html", system=system, msg=msg)
+        systems_data = load_systems()
+        if system not in systems_data.systems:
+            abort(404)
+
+        snapshot = get_snapshot_system_data(app, systems_data.systems[system])
+        if snapshot is not None:
+            data, snapshot_age = snapshot
+
+        elif app.config["APP_STREAM_SYSTEM_PAGE"]:
+            # NOTE(willkg): the shell and overview are sent before anything is
+            # fetched, so errors are shown per environment instead of as an error
+            # page
+            return Response(
+                stream_template(
+                    "system_stream.html",
+                    system=system,
+                    services=systems_data.systems[system].services,
+                    data=iter_system_data(
+                        systems_data.systems[system], deadline=request_deadline()
+                    ),
+                )
+            )
+
+        else:
+            snapshot_age = None
+            data = get_system_data(
+                systems_data.systems[system], deadline=request_deadline()
+            )
+
+        return render(
+            "system.html", system=system, data=data, snapshot_age=snapshot_age
+        )
 
-        systems_data = get_systems_data()
+    @app.route("/api/systems", methods=["GET"])
+    @log_render_time
+    def api_systems():
+        # Returns status data for all systems keyed by system name
+        systems_status, _ = get_overview_status(load_systems(), request_deadline())
+        return api_response(systems_status, systems_status)
+
+    @app.route("/api/overview", methods=["GET"])
+    @log_render_time
+    def api_overview():
+        # Returns status data for all systems with counts by status
+        systems_status, _ = get_overview_status(load_systems(), request_deadline())
+        data = {
+            "summary": summarize_overview(systems_status),
+            "systems": systems_status,
+        }
+        return api_response(data, systems_status)
+
+    @app.route("/api/system/<system>", methods=["GET"])
+    @log_render_time
+    def api_system(system):
+        # Returns status data for a system; the same data the system page renders
+        systems_data = load_systems()
         if system not in systems_data.systems:
+            return jsonify({"error": f"unknown system {system}"}), 404
+
+        data, _ = get_system_status(systems_data.systems[system], request_deadline())
+
+        # NOTE(willkg): the ETag covers the system name so responses for different
+        # systems never share one
+        return api_response(data, {system: data})
+
+    def webhook_response(event, handler):
+        """Verifies a webhook request's signature and runs handler on its payload"""
+        secret = app.config["APP_WEBHOOK_SECRET"]
+        if not secret:
             abort(404)
 
-        data = []
-        for service in systems_data.systems[system].services:
-            service_data = {
-                "name": service.name,
-                "description": service.description or "--",
-            }
+        body = request.get_data()
+        if not verify_signature(secret, body, request.headers.get(SIGNATURE_HEADER)):
+            WEBHOOKS.inc(event=event, result="bad_signature")
+            return jsonify({"error": "bad signature"}), 401
 
-            environments_data = []
-            for environment in service.environments:
-                environment_data = {
-                    "name": environment.name,
-                    "host": environment.host,
-                }
-
-                try:
-                    host_version = fetch(f"{environment.host}/__version__")
-                except requests.exceptions.RequestException as request_exc:
-                    return on_error(system=system, msg=str(request_exc))
-
-                environment_data["commit"] = host_version["commit"]
-                environment_data["source"] = host_version["source"]
-                environment_data["tag"] = host_version.get("version") or "(none)"
-                parsed = urlparse(environment_data["source"])
-                _, user, repo = parsed.path.split("/")
-
-                environment_data["user"] = user
-                environment_data["repo"] = repo
-
-                try:
-                    history = fetch_history_from_github(
-                        user=user,
-                        repo=repo,
-                        from_sha=environment_data["commit"],
-                    )
-                except requests.exceptions.RequestException as request_exc:
-                    return on_error(system=system, msg=str(request_exc))
-
-                if history["total_commits"] == 0:
-                    environment_data["status"] = "up-to-date"
-                    environment_data["commits"] = []
-
-                else:
-                    environment_data["status"] = (
-                        f"{history['total_commits']} commits behind"
-                    )
-                    # output.append(
-                    #     f"  https://github.com/{user}/{repo}/compare/{commit[:8]}...main"
-                    # )
-
-                    commit_data = []
-                    for i, commit in enumerate(history["commits"]):
-                        if len(commit["parents"]) > 1:
-                            # Skip merge commits
-                            continue
-
-                        commit_data.append(
-                            {
-                                "sha": commit["sha"],
-                                "is_head": i == 0,
-                                "message": commit["commit"]["message"].splitlines()[0],
-                                "author": (commit["author"] or {}).get("login", "?"),
-                            }
-                        )
-                    environment_data["commits"] = commit_data
-                environments_data.append(environment_data)
-            service_data["environments"] = environments_data
-            data.append(service_data)
-
-        return render_template("system.html", system=system, data=data)
+        try:
+            data = handler(json.loads(body))
+        except (ValueError, WebhookError) as exc:
+            WEBHOOKS.inc(event=event, result="error")
+            return jsonify({"error": str(exc)}), 400
+        WEBHOOKS.inc(event=event, result="ok")
+        return jsonify(data), 200
+
+    @app.route("/webhooks/github", methods=["POST"])
+    @log_render_time
+    def github_webhook():
+        # Invalidates a repository's cached data when main is pushed to
+        event = request.headers.get("X-GitHub-Event", "")
+        if event == "ping":
+            return webhook_response("ping", lambda payload: {})
+        if event != "push":
+            return webhook_response("other", lambda payload: {"ignored": event})
+        return webhook_response(
+            "push",
+            lambda payload: handle_push(payload, app.extensions["snapshot_refresher"]),
+        )
+
+    @app.route("/webhooks/deploy", methods=["POST"])
+    @log_render_time
+    def deploy_webhook():
+        # Invalidates a host's cached version when something is deployed to it
+        return webhook_response(
+            "deploy",
+            lambda payload: handle_deploy(
+                payload, load_systems().hosts, app.extensions["snapshot_refresher"]
+            ),
+        )
 
     @app.route("/throw_error", methods=["GET"])
     @log_render_time
@@ -231,16 +555,26 @@ def create_app(settings_overrides=None):
     @log_render_time
     def cpu_intensive_page():
         msg = request.args.get("text", string.ascii_letters)[:200]
-        for i in range(500_000):
-            msg = hashlib.sha256(msg.encode("utf-8")).hexdigest()
+        try:
+            msg = CPU_POOL.run(hash_text, msg, 500_000)
+        except PoolFull:
+            resp = jsonify({"error": "too many cpu-bound requests"})
+            resp.status_code = 503
+            resp.headers["Retry-After"] = "1"
+            return resp
+        except TaskTimeout:
+            return jsonify({"error": "timed out"}), 504
         return jsonify({"msg": msg}), 200
 
+    @app.route("/static/<path:filename>", methods=["GET"])
+    def static(filename):
+        resp = static_assets.response(filename)
+        if resp is None:
+            abort(404)
+        return resp
+
     @app.route("/favicon.ico")
     def favicon():
-        return send_from_directory(
-            os.path.join(app.root_path, "static"),
-            "favicon.ico",
-            mimetype="image/vnd.microsoft.icon",
-        )
+        return static_assets.response("favicon.ico")
 
     return app
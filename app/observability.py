@@ -2,9 +2,21 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import bisect
+import contextlib
+import contextvars
+import functools
 import json
 import logging
 from logging.config import dictConfig
+import math
+import random
+import secrets
+import threading
+import time
+
+from flask import current_app, g, request
+import stamina.instrumentation
 
 
 LOGGER = logging.getLogger(__name__)
@@ -77,5 +89,638 @@ def setup_logging(env, logging_level):
     LOGGER.info("logging set up; environment=%s level=%s", env, logging_level)
 
 
-def setup_metrics(config):
-    pass
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """Base class for metrics in a MetricsRegistry
+
+    Values are kept per combination of label values.
+
+    """
+
+    kind = None
+
+    def __init__(self, registry, name, help_text, labels):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        """Returns a list of ``(suffix, labels dict, value)``"""
+        with self._lock:
+            return [
+                ("", dict(zip(self.labels, key)), value)
+                for key, value in sorted(self._values.items())
+            ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self.registry.notify(self, amount, labels)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self.registry.notify(self, amount, labels)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, labels, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            # NOTE(willkg): values above the largest bucket are only in +Inf
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+        self.registry.notify(self, value, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                labels = dict(zip(self.labels, key))
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append(
+                        ("_bucket", {**labels, "le": format_value(bucket)}, cumulative)
+                    )
+                samples.append(("_bucket", {**labels, "le": "+Inf"}, count))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, count))
+        return samples
+
+
+class Collector:
+    """Metric whose values are read from a callable at collection time
+
+    This is for exposing numbers other parts of the app already keep, like cache
+    stats.
+
+    :arg fun: zero-argument callable returning a list of ``(labels dict, value)``
+    :arg kind: "gauge" or "counter" for values that only go up
+
+    """
+
+    def __init__(self, name, help_text, fun, kind="gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.fun = fun
+        self.kind = kind
+
+    def samples(self):
+        try:
+            return [("", labels, value) for labels, value in self.fun()]
+        except Exception:
+            LOGGER.exception("collecting %s failed", self.name)
+            return []
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    """In-process metrics registry
+
+    Metrics are rendered in the Prometheus text format by render_prometheus. Every
+    update is also passed to listeners, which is how metrics get to OpenTelemetry.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._listeners = []
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(*args, **kwargs)
+                self._metrics[name] = metric
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._get_or_create(Counter, name, self, name, help_text, labels)
+
+    def gauge(self, name, help_text, labels=()):
+        return self._get_or_create(Gauge, name, self, name, help_text, labels)
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(
+            Histogram, name, self, name, help_text, labels, buckets=buckets
+        )
+
+    def collector(self, name, help_text, fun, kind="gauge"):
+        """Adds or replaces a Collector"""
+        collector = Collector(name, help_text, fun, kind=kind)
+        with self._lock:
+            self._metrics[name] = collector
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener.add_collector(collector)
+        return collector
+
+    def metrics(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+        for metric in self.metrics():
+            if isinstance(metric, Collector):
+                listener.add_collector(metric)
+
+    def notify(self, metric, value, labels):
+        for listener in self._listeners:
+            try:
+                listener.record(metric, value, labels)
+            except Exception:
+                LOGGER.exception("metrics listener failed")
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(
+                        f'{key}="{escape_label_value(str(val))}"'
+                        for key, val in labels.items()
+                    )
+                    lines.append(
+                        f"{metric.name}{suffix}{{{label_text}}} {format_value(value)}"
+                    )
+                else:
+                    lines.append(f"{metric.name}{suffix} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+ROUTE_DURATION = METRICS.histogram(
+    "http_request_duration_seconds",
+    "Seconds to handle a request until the response is returned",
+    labels=("route", "method", "status"),
+)
+REQUESTS_IN_FLIGHT = METRICS.gauge(
+    "http_requests_in_flight", "Requests being handled", labels=("route",)
+)
+UPSTREAM_DURATION = METRICS.histogram(
+    "upstream_request_duration_seconds",
+    "Seconds upstream requests took",
+    labels=("host", "status"),
+)
+UPSTREAM_IN_FLIGHT = METRICS.gauge(
+    "upstream_requests_in_flight", "Upstream requests in flight", labels=("host",)
+)
+CPU_TASK_DURATION = METRICS.histogram(
+    "cpu_task_duration_seconds",
+    "Seconds CPU-bound tasks took including time queued for a worker",
+    labels=("task", "outcome"),
+)
+RETRIES = METRICS.counter(
+    "upstream_retries_total", "Retried upstream calls", labels=("function", "error")
+)
+ADMISSION_IN_FLIGHT = METRICS.gauge(
+    "admission_requests_in_flight",
+    "Admitted requests in flight by route class",
+    labels=("route_class",),
+)
+ADMISSION_QUEUED = METRICS.gauge(
+    "admission_requests_queued",
+    "Requests waiting to be admitted by route class",
+    labels=("route_class",),
+)
+ADMISSION_SHED = METRICS.counter(
+    "admission_shed_total",
+    "Requests shed with a 503 by route class",
+    labels=("route_class", "reason"),
+)
+WEBHOOKS = METRICS.counter(
+    "webhooks_total", "Webhook requests received", labels=("event", "result")
+)
+
+
+class OpenTelemetryListener:
+    """Forwards metrics to an OpenTelemetry meter
+
+    Counters become counters, gauges become up-down counters, histograms become
+    histograms and collectors become observable gauges or counters.
+
+    """
+
+    def __init__(self, meter, observation_cls):
+        self.meter = meter
+        self.observation_cls = observation_cls
+        self._lock = threading.Lock()
+        self._instruments = {}
+
+    def _instrument(self, metric):
+        with self._lock:
+            instrument = self._instruments.get(metric.name)
+            if instrument is None:
+                if metric.kind == "counter":
+                    create = self.meter.create_counter
+                elif metric.kind == "gauge":
+                    create = self.meter.create_up_down_counter
+                else:
+                    create = self.meter.create_histogram
+                instrument = create(metric.name, description=metric.help_text)
+                self._instruments[metric.name] = instrument
+            return instrument
+
+    def record(self, metric, value, labels):
+        instrument = self._instrument(metric)
+        attributes = {key: str(val) for key, val in labels.items()}
+        if metric.kind == "histogram":
+            instrument.record(value, attributes=attributes)
+        else:
+            instrument.add(value, attributes=attributes)
+
+    def add_collector(self, collector):
+        def callback(options):
+            return [
+                self.observation_cls(value, attributes=labels)
+                for _, labels, value in collector.samples()
+            ]
+
+        with self._lock:
+            if collector.name in self._instruments:
+                return
+            if collector.kind == "counter":
+                create = self.meter.create_observable_counter
+            else:
+                create = self.meter.create_observable_gauge
+            self._instruments[collector.name] = create(
+                collector.name, callbacks=[callback], description=collector.help_text
+            )
+
+
+@functools.cache
+def setup_opentelemetry(endpoint, export_interval):
+    """Sets up exporting metrics to an OpenTelemetry collector
+
+    The ``opentelemetry-sdk`` package and an OTLP exporter package are in the
+    ``otel`` extra. If they're not installed, this logs that and does nothing.
+    Endpoints starting with ``http://`` or ``https://`` use OTLP over HTTP; others
+    use OTLP over gRPC.
+
+    This only sets up an endpoint once, so apps created after the first one share
+    its MeterProvider and observations aren't exported twice.
+
+    :arg endpoint: collector endpoint
+    :arg export_interval: seconds between exports
+
+    :returns: the MeterProvider or None
+
+    """
+    try:
+        from opentelemetry.metrics import Observation
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+
+        if endpoint.startswith(("http://", "https://")):
+            from opentelemetry.exporter.otlp.proto.http.metric_exporter import (
+                OTLPMetricExporter,
+            )
+
+            exporter = OTLPMetricExporter(endpoint=f"{endpoint}/v1/metrics")
+        else:
+            from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import (
+                OTLPMetricExporter,
+            )
+
+            exporter = OTLPMetricExporter(endpoint=endpoint, insecure=True)
+    except ImportError:
+        LOGGER.info("opentelemetry isn't installed; not exporting metrics")
+        return None
+
+    reader = PeriodicExportingMetricReader(
+        exporter, export_interval_millis=export_interval * 1000
+    )
+    provider = MeterProvider(metric_readers=[reader])
+    meter = provider.get_meter("service-deploy-status")
+    METRICS.add_listener(OpenTelemetryListener(meter, Observation))
+    LOGGER.info("exporting metrics to %s", endpoint)
+    return provider
+
+
+@functools.cache
+def setup_opentelemetry_tracing(endpoint):
+    """Sets up exporting request spans to an OpenTelemetry collector
+
+    Like setup_opentelemetry, this does nothing if opentelemetry isn't installed
+    and only sets up an endpoint once.
+
+    :arg endpoint: collector endpoint
+
+    :returns: the TracerProvider or None
+
+    """
+    try:
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        if endpoint.startswith(("http://", "https://")):
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+
+            exporter = OTLPSpanExporter(endpoint=f"{endpoint}/v1/traces")
+        else:
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+                OTLPSpanExporter,
+            )
+
+            exporter = OTLPSpanExporter(endpoint=endpoint, insecure=True)
+    except ImportError:
+        LOGGER.info("opentelemetry isn't installed; not exporting spans")
+        return None
+
+    provider = TracerProvider()
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    return provider
+
+
+class Span:
+    """A timed phase of a request"""
+
+    __slots__ = ("attributes", "duration", "name", "parent_id", "span_id", "start")
+
+    def __init__(self, name, parent_id, attributes):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.duration = None
+        self.attributes = attributes
+
+    def to_dict(self, request_start):
+        return {
+            "name": self.name,
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "start_ms": round((self.start - request_start) * 1000, 1),
+            "dur_ms": round(self.duration * 1000, 1),
+            **self.attributes,
+        }
+
+
+class RequestTimer:
+    """Collects the spans of a request
+
+    Spans can be added from any thread that runs with the request's context, like
+    fan_out workers.
+
+    """
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.start = time.perf_counter()
+        self.start_time_ns = time.time_ns()
+        self.duration = None
+        self._lock = threading.Lock()
+        self.spans = []
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    def phases(self):
+        """Returns a list of ``(name, total seconds, count)`` in order of first use
+
+        Spans of a phase can overlap when they run concurrently, so a phase's total
+        can be more than the wall clock time it took.
+
+        """
+        phases = {}
+        with self._lock:
+            for span in sorted(self.spans, key=lambda span: span.start):
+                total, count = phases.get(span.name, (0.0, 0))
+                phases[span.name] = (total + span.duration, count + 1)
+        return [(name, total, count) for name, (total, count) in phases.items()]
+
+    def server_timing(self):
+        """Returns a Server-Timing header value"""
+        items = []
+        for name, total, count in self.phases():
+            item = f"{name};dur={total * 1000:.1f}"
+            if count > 1:
+                item += f';desc="{count} calls"'
+            items.append(item)
+        items.append(f"total;dur={self.duration * 1000:.1f}")
+        return ", ".join(items)
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return {
+            "trace_id": self.trace_id,
+            "dur_ms": round(self.duration * 1000, 1),
+            "spans": [span.to_dict(self.start) for span in spans],
+        }
+
+    def export(self, tracer, name):
+        """Replays the spans to an OpenTelemetry tracer as a trace"""
+        from opentelemetry import trace
+
+        def to_ns(perf_time):
+            return self.start_time_ns + int((perf_time - self.start) * 1e9)
+
+        root = tracer.start_span(name, start_time=self.start_time_ns)
+        otel_spans = {}
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        for span in spans:
+            parent = otel_spans.get(span.parent_id, root)
+            otel_span = tracer.start_span(
+                span.name,
+                context=trace.set_span_in_context(parent),
+                start_time=to_ns(span.start),
+                attributes={key: str(val) for key, val in span.attributes.items()},
+            )
+            otel_span.end(end_time=to_ns(span.start + span.duration))
+            otel_spans[span.span_id] = otel_span
+        root.end(end_time=to_ns(self.start + self.duration))
+
+
+_TIMER = contextvars.ContextVar("request_timer", default=None)
+_PARENT_SPAN = contextvars.ContextVar("parent_span", default=None)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Times a phase of the current request
+
+    Spans started while another one is open are nested under it. Outside of a
+    request this does nothing.
+
+    :arg name: phase name; used as the Server-Timing metric name
+    :arg attributes: details for the slow request log and trace, like the host
+
+    """
+    timer = _TIMER.get()
+    if timer is None:
+        yield None
+        return
+
+    current = Span(name, _PARENT_SPAN.get(), attributes)
+    token = _PARENT_SPAN.set(current.span_id)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _PARENT_SPAN.reset(token)
+        timer.add(current)
+
+
+def setup_timing(app):
+    """Sets up per-request phase timing for an app
+
+    Phases are returned in a ``Server-Timing`` header. Requests that take longer
+    than ``APP_SLOW_REQUEST_THRESHOLD`` seconds are logged with all their spans,
+    ``APP_SLOW_REQUEST_SAMPLE_RATE`` of the time. If opentelemetry is enabled,
+    spans are exported as traces too.
+
+    Streamed responses are timed until the response is returned, so they don't
+    include rendering the streamed body.
+
+    """
+    tracer = None
+    if app.config["APP_OTEL_ENABLED"] and app.config["APP_OTEL_COLLECTOR_ENDPOINT"]:
+        provider = setup_opentelemetry_tracing(
+            app.config["APP_OTEL_COLLECTOR_ENDPOINT"]
+        )
+        app.extensions["otel_tracer_provider"] = provider
+        if provider is not None:
+            tracer = provider.get_tracer("service-deploy-status")
+
+    @app.before_request
+    def start_timer():
+        g.timer_token = _TIMER.set(RequestTimer())
+
+    @app.after_request
+    def finish_timer(response):
+        timer = _TIMER.get()
+        if timer is None:
+            return response
+
+        timer.finish()
+        if current_app.config["APP_SERVER_TIMING_ENABLED"]:
+            response.headers["Server-Timing"] = timer.server_timing()
+
+        config = current_app.config
+        if (
+            timer.duration >= config["APP_SLOW_REQUEST_THRESHOLD"]
+            and random.random() < config["APP_SLOW_REQUEST_SAMPLE_RATE"]
+        ):
+            LOGGER.info(
+                "slow request: %s %s (%s) %s",
+                request.method,
+                request.path,
+                response.status_code,
+                json.dumps(timer.to_dict()),
+            )
+
+        if tracer is not None:
+            try:
+                timer.export(tracer, name=f"{request.method} {request.path}")
+            except Exception:
+                LOGGER.exception("exporting spans failed")
+        return response
+
+    @app.teardown_request
+    def reset_timer(exc):
+        token = g.pop("timer_token", None)
+        if token is not None:
+            _TIMER.reset(token)
+
+
+def record_retry(details):
+    RETRIES.inc(function=details.name, error=type(details.caused_by).__name__)
+
+
+def setup_metrics(app):
+    """Sets up request metrics for an app and metrics export
+
+    :arg app: the Flask app
+
+    """
+    # NOTE(willkg): stamina's hooks are global and apps get created more than once
+    # in tests
+    hooks = stamina.instrumentation.get_on_retry_hooks()
+    if record_retry not in hooks:
+        stamina.instrumentation.set_on_retry_hooks([*hooks, record_retry])
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+        g.metrics_start_time = time.monotonic()
+        REQUESTS_IN_FLIGHT.inc(route=g.metrics_route)
+
+    @app.after_request
+    def record_request_metrics(response):
+        if "metrics_start_time" in g:
+            ROUTE_DURATION.observe(
+                time.monotonic() - g.metrics_start_time,
+                route=g.metrics_route,
+                method=request.method,
+                status=response.status_code,
+            )
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        if "metrics_start_time" in g:
+            REQUESTS_IN_FLIGHT.dec(route=g.metrics_route)
+
+    if app.config["APP_OTEL_ENABLED"] and app.config["APP_OTEL_COLLECTOR_ENDPOINT"]:
+        app.extensions["otel_meter_provider"] = setup_opentelemetry(
+            endpoint=app.config["APP_OTEL_COLLECTOR_ENDPOINT"],
+            export_interval=app.config["APP_OTEL_EXPORT_INTERVAL"],
+        )
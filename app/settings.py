@@ -2,14 +2,46 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+from typing import Literal
+
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
-    # Sets the opentelemetry collector endpoint
+    # Sets the opentelemetry collector endpoint; "host:port" for OTLP over gRPC or
+    # an http(s) url for OTLP over HTTP
     APP_OTEL_COLLECTOR_ENDPOINT: str = "localhost:4317"
 
+    # Whether to export metrics to the opentelemetry collector; requires the otel
+    # extra, which the image installs
+    APP_OTEL_ENABLED: bool = False
+
+    # Seconds between metrics exports to the opentelemetry collector
+    APP_OTEL_EXPORT_INTERVAL: int = 30
+
+    # Whether to serve metrics in the Prometheus text format at /__metrics__
+    APP_METRICS_ENABLED: bool = True
+
+    # Whether responses have a Server-Timing header with how long each phase of the
+    # request took
+    APP_SERVER_TIMING_ENABLED: bool = True
+
+    # Requests that take at least this many seconds are logged with the timing of
+    # every phase and upstream call
+    APP_SLOW_REQUEST_THRESHOLD: float = 2.0
+
+    # Fraction of slow requests that are logged
+    APP_SLOW_REQUEST_SAMPLE_RATE: float = 1.0
+
+    # Path to the systems configuration file; relative paths are relative to the
+    # repository root
+    APP_SYSTEMS_PATH: str = "app/systems.yaml"
+
+    # Seconds between checks for changes to the systems configuration file; changes
+    # are loaded without a restart
+    APP_SYSTEMS_CHECK_INTERVAL: float = 5.0
+
     # "local", "stage", or "prod"; defaults to "prod" because that's generally a safer
     # default and less likely to reveal secrets
     APP_ENVIRONMENT: str = "prod"
@@ -17,6 +49,142 @@ class Settings(BaseSettings):
     # "INFO" or "WARNING"
     APP_LOGGING_LEVEL: str = "INFO"
 
+    # Maximum number of upstream requests in flight at once across all hosts
+    APP_FETCH_MAX_WORKERS: int = 16
+
+    # Maximum number of upstream requests in flight at once to any single host
+    APP_FETCH_MAX_PER_HOST: int = 4
+
+    # Seconds a cached /__version__ response is fresh
+    APP_VERSION_CACHE_TTL: int = 60
+
+    # Seconds after going stale that a cached /__version__ response is still served
+    # while it's refreshed in the background
+    APP_VERSION_CACHE_STALE_TTL: int = 600
+
+    # Maximum number of cached /__version__ responses
+    APP_VERSION_CACHE_MAX_SIZE: int = 1024
+
+    # Seconds a page or API request waits on upstreams in total; environments that
+    # aren't in by then are shown as unknown with their last known version
+    APP_REQUEST_DEADLINE: float = 10.0
+
+    # Percentile of recent /__version__ latencies after which a slow request is
+    # hedged with a second one; 0 disables hedging
+    APP_VERSION_HEDGE_PERCENTILE: float = 95.0
+
+    # Shortest seconds to wait before hedging a /__version__ request
+    APP_VERSION_HEDGE_MIN_DELAY: float = 0.05
+
+    # Number of failed requests in a row to an environment host that opens its
+    # circuit; while it's open, requests to the host fail fast
+    APP_BREAKER_FAILURE_THRESHOLD: int = 5
+
+    # Seconds a host's circuit stays open before a request is let through to probe
+    # whether it's back
+    APP_BREAKER_COOLDOWN: float = 30.0
+
+    # Maximum number of connections the ASGI app's async HTTP client keeps open
+    # across all upstream hosts
+    APP_ASYNC_HTTP_MAX_CONNECTIONS: int = 100
+
+    # Number of threads the ASGI app runs routes that aren't async in
+    APP_ASGI_THREADS: int = 8
+
+    # Number of worker processes for CPU-bound route work; 0 for one per CPU
+    APP_CPU_POOL_WORKERS: int = 0
+
+    # Most CPU-bound tasks waiting for a worker; requests past that get a 503
+    APP_CPU_POOL_MAX_QUEUE: int = 16
+
+    # Seconds a CPU-bound task has to finish, including time queued; requests whose
+    # task takes longer get a 504
+    APP_CPU_TASK_TIMEOUT: float = 10.0
+
+    # Most requests in flight at once for routes that wait on upstreams and for
+    # CPU-bound routes; requests past that wait for a slot or are shed with a 503.
+    # Keep the server's thread count above the sum of these and the queues so
+    # there are always threads for cheap routes and health checks
+    APP_ADMISSION_UPSTREAM_CONCURRENCY: int = 4
+    APP_ADMISSION_CPU_CONCURRENCY: int = 2
+
+    # Most requests per route class waiting for a slot, and the most seconds each
+    # waits before it's shed
+    APP_ADMISSION_MAX_QUEUE: int = 4
+    APP_ADMISSION_QUEUE_TIMEOUT: float = 1.0
+
+    # Maximum number of keep-alive connections per upstream host
+    APP_HTTP_POOL_MAXSIZE: int = 10
+
+    # Seconds to wait to connect to and to read from upstream hosts
+    APP_HTTP_CONNECT_TIMEOUT: float = 3.0
+    APP_HTTP_READ_TIMEOUT: float = 5.0
+
+    # GitHub API token; requests are unauthenticated if this is empty
+    APP_GITHUB_TOKEN: str = ""
+
+    # Backend for working out how far behind environments are: "rest" makes REST
+    # requests per repository; "graphql" makes one GraphQL query per page or refresh
+    # and requires APP_GITHUB_TOKEN
+    APP_GITHUB_BACKEND: Literal["rest", "graphql"] = "rest"
+
+    # GitHub REST API base url
+    APP_GITHUB_API_URL: str = "https://api.github.com"
+
+    # GitHub GraphQL API endpoint
+    APP_GITHUB_GRAPHQL_URL: str = "https://api.github.com/graphql"
+
+    # Number of recent commits on main fetched per repository to work out how far
+    # behind environments are; at most 100
+    APP_GITHUB_COMMIT_WINDOW: int = 100
+
+    # Most GitHub API calls made in a burst; the rest of the rate limit budget is
+    # spread over the time until it resets
+    APP_GITHUB_RATE_LIMIT_BURST: int = 100
+
+    # Fraction of the GitHub rate limit kept for page requests; background
+    # refreshes stop calling GitHub when less than this is left
+    APP_GITHUB_RATE_LIMIT_RESERVE: float = 0.2
+
+    # Maximum number of cached GitHub API responses
+    APP_GITHUB_CACHE_MAX_SIZE: int = 1024
+
+    # Seconds a cached GitHub API response is used without revalidating it; push
+    # webhooks invalidate responses for a repository before then
+    APP_GITHUB_CACHE_TTL: int = 30
+
+    # Whether to keep an in-memory status snapshot of all systems up to date in a
+    # background thread and render pages from it
+    APP_SNAPSHOT_ENABLED: bool = True
+
+    # Shortest and longest seconds between background polls of an environment;
+    # environments that haven't changed back off towards the longest interval
+    APP_SNAPSHOT_MIN_INTERVAL: int = 30
+    APP_SNAPSHOT_MAX_INTERVAL: int = 600
+
+    # Path to a SQLite database for caching versions and GitHub responses across
+    # worker processes and restarts; empty disables it
+    APP_SQLITE_CACHE_PATH: str = ""
+
+    # Maximum number of entries in the SQLite cache; oldest entries are evicted first
+    APP_SQLITE_CACHE_MAX_ENTRIES: int = 10000
+
+    # Seconds GitHub responses are kept in the SQLite cache; they're revalidated with
+    # GitHub before being used
+    APP_SQLITE_CACHE_TTL: int = 86400
+
+    # Whether system pages that aren't in the snapshot are streamed: the page shell
+    # is sent straight away and each service is sent as soon as it's fetched
+    APP_STREAM_SYSTEM_PAGE: bool = True
+
+    # Smallest JSON API response in bytes that's gzip-compressed for clients that
+    # accept it
+    APP_API_GZIP_MIN_SIZE: int = 1024
+
+    # Shared secret that webhook requests are signed with using HMAC-SHA256; empty
+    # disables the webhook endpoints
+    APP_WEBHOOK_SECRET: str = ""
+
     # APP_DEBUG sets Flask's DEBUG variable; DON'T set this in server environments.
     # https://flask.palletsprojects.com/en/stable/config/#DEBUG
     DEBUG: bool = Field(alias="APP_DEBUG", default=False)
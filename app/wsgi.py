@@ -2,8 +2,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+from app.libadmission import AdmissionMiddleware
 from app.main import create_app
 
 
-# NOTE(willkg): this allows us to wrap the app in middleware later
-wsgi_app = create_app()
+# NOTE(willkg): expensive routes are shed before they tie up a server thread
+wsgi_app = AdmissionMiddleware(create_app())
@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Compares two benchmark results files from benchmarks.run.
+
+Usage: python -m benchmarks.compare OLD NEW
+"""
+
+import argparse
+import json
+import pathlib
+
+METRICS = [
+    ("throughput_rps", lambda result: result["throughput_rps"]),
+    ("p50_ms", lambda result: result["latency_ms"]["p50"]),
+    ("p95_ms", lambda result: result["latency_ms"]["p95"]),
+    ("p99_ms", lambda result: result["latency_ms"]["p99"]),
+    ("errors", lambda result: result["errors"]),
+]
+
+
+def change(old, new):
+    if old is None or new is None:
+        return "--"
+    if old == 0:
+        return "--" if new == 0 else "new"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def compare(old, new):
+    """Returns rows of ``(scenario, page, metric, old, new, change)``
+
+    Only scenarios and pages that are in both results are compared.
+
+    """
+    rows = []
+    for scenario, pages in old["results"].items():
+        for page, old_result in pages.items():
+            new_result = new["results"].get(scenario, {}).get(page)
+            if new_result is None:
+                continue
+            for name, get_value in METRICS:
+                old_value = get_value(old_result)
+                new_value = get_value(new_result)
+                rows.append(
+                    (
+                        scenario,
+                        page,
+                        name,
+                        old_value,
+                        new_value,
+                        change(old_value, new_value),
+                    )
+                )
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare benchmark results.")
+    parser.add_argument("old", help="results file of the baseline run")
+    parser.add_argument("new", help="results file of the run to compare")
+    args = parser.parse_args(argv)
+
+    old = json.loads(pathlib.Path(args.old).read_text())
+    new = json.loads(pathlib.Path(args.new).read_text())
+    if old["params"] != new["params"]:
+        print("WARNING: runs have different parameters")
+    print(f"old: {old['meta']['commit']}  new: {new['meta']['commit']}")
+
+    header = ("scenario", "page", "metric", "old", "new", "change")
+    rows = [header] + [tuple(str(item) for item in row) for row in compare(old, new)]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        line = "  ".join(item.ljust(width) for item, width in zip(row, widths))
+        print(line.rstrip())
+
+
+if __name__ == "__main__":
+    main()
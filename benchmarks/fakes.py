@@ -0,0 +1,250 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Local stand-ins for environment hosts and the GitHub REST API.
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlparse
+
+
+class Profile(NamedTuple):
+    """How a fake upstream behaves"""
+
+    # Seconds every response takes
+    latency: float = 0.0
+    # Up to this many more seconds, picked uniformly at random per response
+    jitter: float = 0.0
+    # Fraction of responses that are a 500
+    error_rate: float = 0.0
+    # Bytes of padding added to every response body
+    payload_size: int = 0
+
+
+class FakeServer:
+    """Threaded HTTP server on a free local port
+
+    Subclasses implement ``respond(path, query, headers)`` returning ``(status,
+    headers, data)`` where data is JSON-serializable or None.
+
+    :arg profile: a Profile
+
+    """
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # NOTE(willkg): HTTP/1.1 so the app's connection pools keep connections
+            # alive like they do with real hosts
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, handler):
+        profile = self.profile
+        time.sleep(profile.latency + random.uniform(0, profile.jitter))
+
+        with self._lock:
+            self.requests += 1
+            failed = random.random() < profile.error_rate
+            if failed:
+                self.errors += 1
+
+        if failed:
+            status, headers, data = 500, {}, {"message": "fake error"}
+        else:
+            parsed = urlparse(handler.path)
+            status, headers, data = self.respond(
+                parsed.path, parse_qs(parsed.query), handler.headers
+            )
+
+        body = b""
+        if data is not None:
+            body = json.dumps(data).encode("utf-8")
+        handler.send_response(status)
+        for key, val in headers.items():
+            handler.send_header(key, val)
+        if data is not None:
+            handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def respond(self, path, query, headers):
+        raise NotImplementedError
+
+    def padding(self):
+        return "x" * self.profile.payload_size
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+            self._thread = None
+
+
+class FakeHost(FakeServer):
+    """Serves ``/__version__`` for the environments under one host
+
+    Several environments share a FakeHost: an environment's host is the server url
+    plus a path prefix, so ``{url}/{prefix}/__version__`` is its version.
+
+    :arg profile: a Profile
+    :arg versions: dict of path prefix -> /__version__ data; shared by the hosts of
+        a FakeFleet
+
+    """
+
+    def __init__(self, profile, versions):
+        super().__init__(profile)
+        self.versions = versions
+
+    def respond(self, path, query, headers):
+        prefix = path.removesuffix("/__version__").strip("/")
+        data = self.versions.get(prefix)
+        if data is None or not path.endswith("/__version__"):
+            return 404, {}, None
+        if self.profile.payload_size:
+            data = dict(data, padding=self.padding())
+        return 200, {}, data
+
+
+class FakeFleet:
+    """A fleet of fake environment hosts
+
+    Environments are spread over ``num_hosts`` servers. Each server is its own
+    host to the app's per-host connection pools, concurrency limits and circuit
+    breakers.
+
+    :arg profile: a Profile
+    :arg num_hosts: number of servers
+
+    """
+
+    def __init__(self, profile, num_hosts):
+        self.versions = {}
+        self.hosts = [FakeHost(profile, self.versions) for _ in range(num_hosts)]
+
+    @property
+    def urls(self):
+        return [host.url for host in self.hosts]
+
+    @property
+    def requests(self):
+        return sum(host.requests for host in self.hosts)
+
+    def start(self):
+        for host in self.hosts:
+            host.start()
+        return self
+
+    def stop(self):
+        for host in self.hosts:
+            host.stop()
+
+
+def fake_sha(*parts):
+    return hashlib.sha1("/".join(str(part) for part in parts).encode()).hexdigest()
+
+
+class FakeGitHub(FakeServer):
+    """Serves the GitHub REST commits and compare APIs for fake repositories
+
+    Responses have ETags and conditional requests get a ``304`` like they do from
+    GitHub. Rate limit headers always say there's plenty left.
+
+    :arg profile: a Profile
+    :arg repos: dict of ``(user, repo)`` -> list of commit shas on main, newest
+        first
+
+    """
+
+    def __init__(self, profile, repos=None):
+        super().__init__(profile)
+        self.repos = repos if repos is not None else {}
+
+    def commit(self, user, repo, sha):
+        return {
+            "sha": sha,
+            "commit": {"message": f"Change {sha[:8]} in {repo}\n\n{self.padding()}"},
+            "parents": [{"sha": fake_sha(sha, "parent")}],
+            "author": {"login": user},
+        }
+
+    def respond(self, path, query, headers):
+        parts = path.strip("/").split("/")
+        if len(parts) < 4 or parts[0] != "repos":
+            return 404, {}, {"message": "Not Found"}
+        _, user, repo, endpoint, *rest = parts
+        shas = self.repos.get((user, repo))
+        if shas is None:
+            return 404, {}, {"message": "Not Found"}
+
+        if endpoint == "commits" and not rest:
+            per_page = int(query.get("per_page", ["30"])[0])
+            data = [self.commit(user, repo, sha) for sha in shas[:per_page]]
+
+        elif endpoint == "compare" and rest and rest[0].endswith("...main"):
+            from_sha = rest[0].removesuffix("...main")
+            ahead = next(
+                (i for i, sha in enumerate(shas) if sha.startswith(from_sha)), None
+            )
+            if ahead is None:
+                return 404, {}, {"message": "Not Found"}
+            data = {
+                "total_commits": ahead,
+                "commits": [
+                    self.commit(user, repo, sha) for sha in reversed(shas[:ahead])
+                ],
+            }
+
+        else:
+            return 404, {}, {"message": "Not Found"}
+
+        etag = '"' + fake_sha(user, repo, path, shas[0]) + '"'
+        response_headers = {
+            "ETag": etag,
+            "X-RateLimit-Limit": "1000000",
+            "X-RateLimit-Remaining": "1000000",
+            "X-RateLimit-Reset": str(int(time.time()) + 60),
+        }
+        if headers.get("If-None-Match") == etag:
+            return 304, response_headers, None
+        return 200, response_headers, data
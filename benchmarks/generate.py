@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Generates synthetic systems.yaml configurations and the fake upstream data that
+goes with them.
+
+Usage: python -m benchmarks.generate [--systems N] [--services N] > systems.yaml
+"""
+
+import argparse
+import random
+import sys
+from typing import NamedTuple
+
+import yaml
+
+from benchmarks.fakes import fake_sha
+
+ENVIRONMENT_NAMES = ["prod", "stage", "dev", "test", "qa"]
+
+
+class Fleet(NamedTuple):
+    """A synthetic configuration and the upstream data for it"""
+
+    # systems.yaml data
+    systems: dict
+    # dict of host path prefix -> /__version__ data for FakeFleet.versions
+    versions: dict
+    # dict of (user, repo) -> commit shas on main, newest first, for FakeGitHub
+    repos: dict
+
+
+def generate_fleet(
+    host_urls,
+    num_systems=100,
+    num_services=20,
+    num_environments=2,
+    history=200,
+    max_behind=20,
+    seed=0,
+):
+    """Generates a synthetic fleet
+
+    Every service has its own repository on GitHub with ``history`` commits on
+    main. Each environment is deployed between 0 and ``max_behind`` commits behind
+    main; the first environment, prod, is the furthest behind.
+
+    :arg host_urls: base urls environments are spread over, like FakeFleet.urls
+    :arg num_systems: number of systems
+    :arg num_services: number of services per system
+    :arg num_environments: number of environments per service
+    :arg history: number of commits on main per repository
+    :arg max_behind: most commits an environment is behind main
+    :arg seed: random seed so the same arguments generate the same fleet
+
+    :returns: a Fleet
+
+    """
+    rng = random.Random(seed)
+    systems = {}
+    versions = {}
+    repos = {}
+
+    index = 0
+    for system_num in range(num_systems):
+        system_name = f"system{system_num:03d}"
+        services = []
+        for service_num in range(num_services):
+            service_name = f"service{service_num:03d}"
+            repo = f"{system_name}-{service_name}"
+            shas = [fake_sha(repo, i) for i in range(history)]
+            repos[("bench", repo)] = shas
+
+            environments = []
+            behind = rng.randint(0, max_behind)
+            for env_num in range(num_environments):
+                if env_num < len(ENVIRONMENT_NAMES):
+                    env_name = ENVIRONMENT_NAMES[env_num]
+                else:
+                    env_name = f"env{env_num}"
+                prefix = f"{system_name}/{service_name}/{env_name}"
+                host_url = host_urls[index % len(host_urls)]
+                index += 1
+
+                environments.append(
+                    {"name": env_name, "host": f"{host_url.rstrip('/')}/{prefix}"}
+                )
+                versions[prefix] = {
+                    "source": f"https://github.com/bench/{repo}",
+                    "version": f"v{history - behind}",
+                    "commit": shas[min(behind, history - 1)],
+                    "build": f"https://ci.example.com/{repo}/{behind}",
+                }
+                # Later environments are closer to main
+                behind = rng.randint(0, behind)
+
+            services.append(
+                {
+                    "name": service_name,
+                    "description": f"Synthetic service {service_num}",
+                    "environments": environments,
+                }
+            )
+        systems[system_name] = {"services": services}
+
+    return Fleet(systems={"systems": systems}, versions=versions, repos=repos)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic systems.yaml.")
+    parser.add_argument("--systems", type=int, default=100, help="number of systems")
+    parser.add_argument(
+        "--services", type=int, default=20, help="number of services per system"
+    )
+    parser.add_argument(
+        "--environments",
+        type=int,
+        default=2,
+        help="number of environments per service",
+    )
+    parser.add_argument(
+        "--host-url",
+        action="append",
+        dest="host_urls",
+        help="base url for environment hosts; can be given more than once",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args(argv)
+
+    fleet = generate_fleet(
+        host_urls=args.host_urls or ["http://127.0.0.1:8001"],
+        num_systems=args.systems,
+        num_services=args.services,
+        num_environments=args.environments,
+        seed=args.seed,
+    )
+    yaml.safe_dump(fleet.systems, sys.stdout, sort_keys=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Benchmarks the index and system pages in-process against a fake fleet of
+environment hosts and a fake GitHub.
+
+Usage: python -m benchmarks.run [--systems N] [--services N] [--output FILE]
+
+Run it from the repository root. Results are written as JSON; compare two runs
+with ``python -m benchmarks.compare OLD NEW``.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import math
+import os
+import pathlib
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from benchmarks.fakes import FakeFleet, FakeGitHub, Profile
+from benchmarks.generate import generate_fleet
+
+# Settings for the app under test; anything already set in the environment wins
+DEFAULT_ENVIRONMENT = {
+    "APP_LOGGING_LEVEL": "WARNING",
+    "APP_SNAPSHOT_ENABLED": "false",
+    "APP_SQLITE_CACHE_PATH": "",
+    "APP_OTEL_ENABLED": "false",
+    # NOTE(willkg): the token only sets the rate limit the app starts with; the
+    # fake GitHub's rate limit headers take over after the first response
+    "APP_GITHUB_TOKEN": "benchmark",
+}
+
+
+def percentile(values, pct):
+    """Returns the nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    rank = math.ceil(pct / 100 * len(values)) - 1
+    return values[max(0, min(len(values) - 1, rank))]
+
+
+def summarize(latencies, errors, elapsed):
+    """Summarizes one page's requests
+
+    :arg latencies: list of seconds per request
+    :arg errors: number of requests that failed or got a 5xx
+    :arg elapsed: wall clock seconds for all the requests
+
+    :returns: dict of results with latencies in milliseconds
+
+    """
+    latencies = sorted(latencies)
+    latency_ms = {}
+    for name, pct in [("p50", 50), ("p90", 90), ("p95", 95), ("p99", 99)]:
+        latency_ms[name] = round(percentile(latencies, pct) * 1000, 2)
+    latency_ms["max"] = round(latencies[-1] * 1000, 2)
+    latency_ms["mean"] = round(sum(latencies) / len(latencies) * 1000, 2)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_ms": latency_ms,
+    }
+
+
+def run_page(app, paths, concurrency, before_request=None):
+    """Requests paths through the app with a number of concurrent clients
+
+    :arg app: the Flask app
+    :arg paths: list of paths to request; each is requested once
+    :arg concurrency: number of requests in flight at once
+    :arg before_request: optional zero-argument callable run before each request
+
+    :returns: dict from summarize
+
+    """
+
+    def request(path):
+        if before_request is not None:
+            before_request()
+        client = app.test_client()
+        start = time.perf_counter()
+        resp = client.get(path)
+        # NOTE(willkg): streamed pages are only rendered as the body is read
+        resp.get_data()
+        latency = time.perf_counter() - start
+        resp.close()
+        return latency, resp.status_code
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(request, paths))
+    elapsed = time.perf_counter() - start
+
+    errors = sum(1 for _, status_code in results if status_code >= 500)
+    return summarize([latency for latency, _ in results], errors, elapsed)
+
+
+def clear_state():
+    from app.libgithub import GITHUB_CACHE, GRAPHQL_RATE_LIMIT, REST_RATE_LIMIT
+    from app.libupstream import BREAKERS, VERSION_CACHE
+
+    VERSION_CACHE.clear()
+    GITHUB_CACHE.clear()
+    BREAKERS.clear()
+    REST_RATE_LIMIT.clear()
+    GRAPHQL_RATE_LIMIT.clear()
+
+
+def clear_caches():
+    from app.libgithub import GITHUB_CACHE
+    from app.libupstream import VERSION_CACHE
+
+    VERSION_CACHE.clear()
+    GITHUB_CACHE.clear()
+
+
+def run_benchmark(app, systems_data, num_requests, concurrency, scenarios, seed=0):
+    """Runs the benchmark scenarios against an app
+
+    Scenarios:
+
+    * ``cold``: caches are cleared before every request, so every request fetches
+      every environment and repository. Requests are made one at a time so they
+      don't share fetches.
+    * ``warm``: caches are filled first and requests are made ``concurrency`` at a
+      time.
+
+    :arg app: the Flask app
+    :arg systems_data: the libsystems.Systems the app serves
+    :arg num_requests: number of requests per page per scenario
+    :arg concurrency: number of requests in flight at once for warm scenarios
+    :arg scenarios: list of scenario names
+    :arg seed: random seed for picking systems
+
+    :returns: dict of scenario -> page -> dict from summarize
+
+    """
+    rng = random.Random(seed)
+    system_names = sorted(systems_data.systems)
+    pages = {
+        "index_page": ["/"] * num_requests,
+        "system_page": [
+            f"/system/{rng.choice(system_names)}" for _ in range(num_requests)
+        ],
+    }
+
+    results = {}
+    for scenario in scenarios:
+        clear_state()
+        results[scenario] = {}
+        for page, paths in pages.items():
+            if scenario == "cold":
+                results[scenario][page] = run_page(
+                    app, paths, concurrency=1, before_request=clear_caches
+                )
+            elif scenario == "warm":
+                run_page(app, sorted(set(paths)), concurrency=concurrency)
+                results[scenario][page] = run_page(app, paths, concurrency=concurrency)
+            else:
+                raise ValueError(f"unknown scenario {scenario}")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pages in-process.")
+    parser.add_argument("--systems", type=int, default=100, help="number of systems")
+    parser.add_argument(
+        "--services", type=int, default=20, help="number of services per system"
+    )
+    parser.add_argument(
+        "--environments", type=int, default=2, help="environments per service"
+    )
+    parser.add_argument(
+        "--hosts", type=int, default=20, help="number of fake environment hosts"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="seconds per /__version__"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.02, help="extra random seconds per version"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of version errors"
+    )
+    parser.add_argument(
+        "--payload-size", type=int, default=0, help="bytes of padding per version"
+    )
+    parser.add_argument(
+        "--github-latency", type=float, default=0.05, help="seconds per GitHub call"
+    )
+    parser.add_argument(
+        "--github-jitter", type=float, default=0.05, help="extra seconds per call"
+    )
+    parser.add_argument(
+        "--github-error-rate", type=float, default=0.0, help="fraction of errors"
+    )
+    parser.add_argument(
+        "--github-payload-size",
+        type=int,
+        default=0,
+        help="bytes of padding per GitHub commit message",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=50, help="requests per page per scenario"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="requests in flight when warm"
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        dest="scenarios",
+        choices=["cold", "warm"],
+        help="scenario to run; can be given more than once; defaults to both",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--output", help="file to write JSON results to; defaults to stdout"
+    )
+    args = parser.parse_args(argv)
+    scenarios = args.scenarios or ["cold", "warm"]
+
+    fleet = FakeFleet(
+        Profile(args.latency, args.jitter, args.error_rate, args.payload_size),
+        num_hosts=args.hosts,
+    ).start()
+    github = FakeGitHub(
+        Profile(
+            args.github_latency,
+            args.github_jitter,
+            args.github_error_rate,
+            args.github_payload_size,
+        )
+    ).start()
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        generated = generate_fleet(
+            host_urls=fleet.urls,
+            num_systems=args.systems,
+            num_services=args.services,
+            num_environments=args.environments,
+            seed=args.seed,
+        )
+        fleet.versions.update(generated.versions)
+        github.repos.update(generated.repos)
+
+        systems_path = pathlib.Path(tmpdir) / "systems.yaml"
+        systems_path.write_text(yaml.safe_dump(generated.systems))
+
+        for key, val in DEFAULT_ENVIRONMENT.items():
+            os.environ.setdefault(key, val)
+        os.environ["APP_GITHUB_API_URL"] = github.url
+        os.environ["APP_SYSTEMS_PATH"] = str(systems_path)
+
+        # NOTE(willkg): settings are read when app modules are imported, so they're
+        # imported after the environment is set up
+        from app.libsystems import get_systems_data
+        from app.main import create_app
+
+        app = create_app()
+        started_at = datetime.datetime.now(datetime.UTC)
+        results = run_benchmark(
+            app,
+            get_systems_data(),
+            num_requests=args.requests,
+            concurrency=args.concurrency,
+            scenarios=scenarios,
+            seed=args.seed,
+        )
+
+        upstream = {
+            "version_requests": fleet.requests,
+            "github_requests": github.requests,
+        }
+
+    finally:
+        fleet.stop()
+        github.stop()
+        shutil.rmtree(tmpdir)
+
+    output = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "started_at": started_at.isoformat(timespec="seconds"),
+        },
+        "params": {
+            key: val for key, val in sorted(vars(args).items()) if key != "output"
+        },
+        "results": results,
+        "upstream": upstream,
+    }
+    output["params"]["scenarios"] = scenarios
+
+    text = json.dumps(output, indent=2, sort_keys=True) + "\n"
+    if args.output:
+        pathlib.Path(args.output).write_text(text)
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    main()
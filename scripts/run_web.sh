@@ -8,13 +8,26 @@
 : "${PORT:=8000}"
 : "${APP_GUNICORN_TIMEOUT:=300}"
 : "${APP_WAITRESS_TIMEOUT:=300}"
+# NOTE(willkg): keep this above the admission limits and queues in app/settings.py
+# so cheap routes and health checks always have a thread
+: "${APP_WAITRESS_THREADS:=16}"
 
 (set -o posix; set) | grep APP_WAITRESS
 
 cd /app/
 
+# APP_SERVER is "wsgi" to serve with waitress or "asgi" to serve the ASGI app with
+# uvicorn; the ASGI app requires the asgi extra, which the image installs
+if [ "${APP_SERVER:-wsgi}" = "asgi" ]; then
+    exec uv run uvicorn \
+        --host=0.0.0.0 \
+        --port=${PORT} \
+        --timeout-keep-alive="${APP_WAITRESS_TIMEOUT}" \
+        app.asgi:asgi_app
+fi
+
 exec uv run waitress-serve \
     --port=${PORT} \
-    --threads=1 \
+    --threads="${APP_WAITRESS_THREADS}" \
     --channel-timeout="${APP_WAITRESS_TIMEOUT}" \
     app.wsgi:wsgi_app
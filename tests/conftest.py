@@ -2,14 +2,41 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
+import stamina
 
+from app.libgithub import GITHUB_CACHE, GRAPHQL_RATE_LIMIT, REST_RATE_LIMIT
+from app.libupstream import BREAKERS, VERSION_CACHE
 from app.main import create_app
 
 
+@pytest.fixture(autouse=True, scope="session")
+def no_retry_backoff():
+    # Upstream failures in tests shouldn't wait on retry backoff
+    stamina.set_testing(True)
+    yield
+    stamina.set_testing(False)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    VERSION_CACHE.clear()
+    GITHUB_CACHE.clear()
+    BREAKERS.clear()
+    REST_RATE_LIMIT.clear()
+    GRAPHQL_RATE_LIMIT.clear()
+    yield
+
+
 @pytest.fixture()
 def app():
-    app = create_app(settings_overrides={"TESTING": True})
+    app = create_app(
+        settings_overrides={"TESTING": True, "APP_SNAPSHOT_ENABLED": False}
+    )
     app.config.update(
         {
             "APP_ENVIRONMENT": "test",
@@ -22,3 +49,96 @@ def app():
 @pytest.fixture()
 def client(app):
     return app.test_client()
+
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    """Local stand-in for an OpenTelemetry collector's OTLP over HTTP endpoints
+
+    It keeps the ``(path, body)`` of everything posted to it.
+
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append((self.path, body))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def fake_collector():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CollectorHandler)
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FakeGraphQL:
+    """Local stand-in for the GitHub GraphQL API
+
+    It answers the queries GraphQLHistoryPlanner builds from the query variables
+    and a dict of (owner, name) -> list of commit shas on main, newest first.
+
+    """
+
+    def __init__(self, repos):
+        self.repos = repos
+        self.queries = []
+
+    def __call__(self, request):
+        body = json.loads(request.body)
+        self.queries.append(body)
+        variables = body["variables"]
+
+        data = {}
+        for key in variables:
+            if not key.endswith("_owner"):
+                continue
+            repo_alias = key.removesuffix("_owner")
+            shas = self.repos[(variables[key], variables[f"{repo_alias}_name"])]
+            ref = {
+                "target": {
+                    "history": {
+                        "nodes": [
+                            {
+                                "oid": sha,
+                                "messageHeadline": f"commit {sha}",
+                                "parents": {"totalCount": 1},
+                                "author": {"user": {"login": "willkg"}},
+                            }
+                            for sha in shas[: variables["window"]]
+                        ]
+                    }
+                }
+            }
+            for name, value in variables.items():
+                if name.startswith(f"{repo_alias}_c"):
+                    compare_alias = name.removeprefix(f"{repo_alias}_")
+                    # NOTE(willkg): like GitHub, shas that aren't in the
+                    # repository compare as null
+                    ref[compare_alias] = (
+                        {"behindBy": shas.index(value)} if value in shas else None
+                    )
+            data[repo_alias] = {"ref": ref}
+        return 200, {}, json.dumps({"data": data})
+
+
+@pytest.fixture()
+def fake_graphql(responses):
+    """Returns a function that registers a FakeGraphQL for a dict of repos"""
+
+    def _fake_graphql(repos):
+        fake = FakeGraphQL(repos)
+        responses.add_callback(
+            responses.POST, "https://api.github.com/graphql", callback=fake
+        )
+        return fake
+
+    return _fake_graphql
@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from app import libgithub, main
+from app.libsystems import Systems
+from benchmarks.fakes import FakeFleet, FakeGitHub, Profile
+from benchmarks.generate import generate_fleet
+from benchmarks.run import percentile, run_benchmark
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([7], 95) == 7
+    assert percentile([], 50) is None
+
+
+@pytest.fixture()
+def fakes(responses):
+    fleet = FakeFleet(Profile(), num_hosts=2).start()
+    github = FakeGitHub(Profile()).start()
+    responses.add_passthru("http://127.0.0.1")
+    yield fleet, github
+    fleet.stop()
+    github.stop()
+
+
+def test_run_benchmark(app, fakes, monkeypatch):
+    fleet, github = fakes
+    generated = generate_fleet(
+        host_urls=fleet.urls, num_systems=2, num_services=3, max_behind=5
+    )
+    fleet.versions.update(generated.versions)
+    github.repos.update(generated.repos)
+    systems_data = Systems.model_validate(generated.systems)
+    monkeypatch.setattr(main, "get_systems_data", lambda: systems_data)
+    monkeypatch.setattr(libgithub, "GITHUB_API", github.url)
+
+    results = run_benchmark(
+        app, systems_data, num_requests=3, concurrency=2, scenarios=["cold", "warm"]
+    )
+
+    for scenario in ["cold", "warm"]:
+        for page in ["index_page", "system_page"]:
+            result = results[scenario][page]
+            assert result["requests"] == 3
+            assert result["errors"] == 0
+            assert set(result["latency_ms"]) == {
+                "p50",
+                "p90",
+                "p95",
+                "p99",
+                "max",
+                "mean",
+            }
+
+    # Every environment and repository was fetched
+    assert fleet.requests >= 2 * 3 * 2
+    assert github.requests >= 3
@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import threading
+import time
+
+import pytest
+from werkzeug.test import Client, EnvironBuilder
+
+from app.libadmission import AdmissionMiddleware, RouteClassLimit
+from app.observability import METRICS
+
+
+def test_limit_admits_up_to_concurrency():
+    limit = RouteClassLimit("test", concurrency=2, max_queue=0)
+    assert limit.acquire()
+    assert limit.acquire()
+    assert not limit.acquire()
+    limit.release()
+    assert limit.acquire()
+    assert limit.stats()["shed"] == 1
+    assert limit.stats()["in_flight"] == 2
+
+
+def test_limit_queue_timeout():
+    limit = RouteClassLimit("test", concurrency=1, max_queue=1, queue_timeout=0.05)
+    assert limit.acquire()
+    start = time.monotonic()
+    assert not limit.acquire()
+    assert time.monotonic() - start >= 0.05
+    assert limit.stats()["queued"] == 0
+
+
+def test_limit_queued_request_gets_slot():
+    limit = RouteClassLimit("test", concurrency=1, max_queue=1, queue_timeout=5)
+    assert limit.acquire()
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(limit.acquire()))
+    waiter.start()
+    while limit.stats()["queued"] == 0:
+        time.sleep(0.01)
+
+    # The queue is full, so this is shed straight away
+    assert not limit.acquire()
+
+    limit.release()
+    waiter.join()
+    assert results == [True]
+
+
+def test_unlimited():
+    limit = RouteClassLimit("test", concurrency=None)
+    assert all(limit.acquire() for _ in range(100))
+
+
+@pytest.fixture()
+def middleware(app):
+    return AdmissionMiddleware(
+        app,
+        limits={
+            "exempt": RouteClassLimit("exempt", concurrency=None),
+            "default": RouteClassLimit("default", concurrency=None),
+            "upstream": RouteClassLimit("upstream", concurrency=1),
+            "cpu": RouteClassLimit("cpu", concurrency=1),
+        },
+    )
+
+
+def test_route_class(middleware):
+    def route_class(path, method="GET"):
+        return middleware.route_class(
+            EnvironBuilder(path=path, method=method).get_environ()
+        )
+
+    assert route_class("/__lbheartbeat__") == "exempt"
+    assert route_class("/system/exampleapp") == "upstream"
+    assert route_class("/api/systems") == "upstream"
+    assert route_class("/cpu_intensive") == "cpu"
+    assert route_class("/") == "default"
+    assert route_class("/not-a-page") == "default"
+    assert route_class("/api/systems", method="POST") == "default"
+
+
+def test_sheds_busy_route_class(middleware):
+    client = Client(middleware)
+    # Take the only upstream slot
+    assert middleware.limits["upstream"].acquire()
+
+    resp = client.get("/api/systems")
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+    assert json.loads(resp.data) == {"error": "server busy"}
+
+    # Health checks and other route classes still get through
+    assert client.get("/__lbheartbeat__").status_code == 200
+    assert client.get("/__version__").status_code == 200
+
+    resp = client.get("/__stats__")
+    assert json.loads(resp.data)["admission"]["upstream"]["shed"] == 1
+    assert (
+        'admission_shed_total{route_class="upstream",reason="queue_full"}'
+        in METRICS.render_prometheus()
+    )
+
+
+def test_releases_slot_when_response_is_done(middleware):
+    client = Client(middleware)
+    resp = client.get("/__lbheartbeat__")
+    assert resp.status_code == 200
+    assert resp.data == b"{}"
+    assert middleware.limits["exempt"].stats()["in_flight"] == 1
+    resp.close()
+    assert middleware.limits["exempt"].stats()["in_flight"] == 0
+    assert middleware.limits["exempt"].stats()["admitted"] == 1
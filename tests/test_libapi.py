@@ -0,0 +1,44 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import copy
+
+from app.libapi import status_etag
+
+SYSTEMS_STATUS = {
+    "exampleapp": [
+        {
+            "name": "Service 1",
+            "description": "--",
+            "environments": [
+                {
+                    "name": "prod",
+                    "host": "http://service1.example.com",
+                    "commit": "bbbbb12345",
+                    "tag": "v2025.06.10",
+                    "status": "1 commits behind",
+                    "commits": [{"sha": "ccccc12345", "is_head": True}],
+                },
+            ],
+        },
+    ],
+}
+
+
+def test_status_etag_is_stable():
+    assert status_etag(SYSTEMS_STATUS) == status_etag(copy.deepcopy(SYSTEMS_STATUS))
+
+
+def test_status_etag_changes_with_deploy():
+    changed = copy.deepcopy(SYSTEMS_STATUS)
+    changed["exampleapp"][0]["environments"][0]["commit"] = "ccccc12345"
+    assert status_etag(changed) != status_etag(SYSTEMS_STATUS)
+
+
+def test_status_etag_changes_with_head():
+    changed = copy.deepcopy(SYSTEMS_STATUS)
+    changed["exampleapp"][0]["environments"][0]["commits"].append(
+        {"sha": "ddddd12345", "is_head": False}
+    )
+    assert status_etag(changed) != status_etag(SYSTEMS_STATUS)
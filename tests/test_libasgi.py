@@ -0,0 +1,239 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import json
+import time
+
+import pytest
+
+from app import libasync, main
+from app.libasgi import AsgiApp
+from app.libasync import AsyncResponse
+from app.libsystems import Systems
+
+
+def asgi_get(asgi_app, path):
+    """Makes a GET request to an ASGI app and returns ``(status, headers, body)``"""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"testserver")],
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 12345),
+    }
+    asyncio.run(asgi_app(scope, receive, send))
+
+    start, *body_messages = messages
+    headers = {
+        name.decode("latin-1"): value.decode("latin-1")
+        for name, value in start["headers"]
+    }
+    body = b"".join(message["body"] for message in body_messages)
+    return start["status"], headers, body
+
+
+class FakeAsyncClient:
+    """Stands in for the async HTTP client with canned responses by url"""
+
+    timeout = (1.0, 1.0)
+
+    def __init__(self, responses, delay=0):
+        self.responses = responses
+        self.delay = delay
+        self.urls = []
+
+    async def get(self, url, headers=None, timeout=None):
+        self.urls.append(url)
+        await asyncio.sleep(self.delay)
+        status_code, data = self.responses[url]
+        return AsyncResponse(
+            url,
+            status_code,
+            {"Content-Type": "application/json"},
+            json.dumps(data).encode("utf-8"),
+        )
+
+
+def version(commit):
+    return {
+        "source": "https://github.com/example/service1",
+        "version": "main",
+        "commit": commit,
+        "build": "https://example.com/build",
+    }
+
+
+def commit(sha):
+    return {
+        "sha": sha,
+        "parents": [{}],
+        "commit": {"message": f"change {sha}"},
+        "author": {"login": "willkg"},
+    }
+
+
+@pytest.fixture()
+def asgi_app(app, monkeypatch):
+    def get_systems_data_mock():
+        return Systems.model_validate(
+            {
+                "systems": {
+                    "exampleapp": {
+                        "services": [
+                            {
+                                "name": "Service 1",
+                                "environments": [
+                                    {
+                                        "name": "stage",
+                                        "host": "http://service1-stage.example.com",
+                                    },
+                                    {
+                                        "name": "prod",
+                                        "host": "http://service1.example.com",
+                                    },
+                                ],
+                            },
+                        ],
+                    },
+                },
+            }
+        )
+
+    monkeypatch.setattr(main, "get_systems_data", get_systems_data_mock)
+    asgi_app = AsgiApp(app, threads=2)
+    yield asgi_app
+    asgi_app.executor.shutdown()
+
+
+@pytest.fixture()
+def fake_client(monkeypatch):
+    client = FakeAsyncClient(
+        {
+            "http://service1-stage.example.com/__version__": (200, version("aaaaa")),
+            "http://service1.example.com/__version__": (200, version("bbbbb")),
+            (
+                "https://api.github.com/repos/example/service1/commits"
+                + "?sha=main&per_page=100"
+            ): (200, [commit("aaaaa"), commit("ccccc"), commit("bbbbb")]),
+            "https://www.githubstatus.com/api/v2/status.json": (
+                200,
+                {"status": {"indicator": "none"}},
+            ),
+        }
+    )
+    monkeypatch.setattr(libasync, "ASYNC_HTTP_CLIENT", client)
+    return client
+
+
+def test_wsgi_routes(asgi_app):
+    status, _, body = asgi_get(asgi_app, "/__lbheartbeat__")
+    assert status == 200
+    assert body == b"{}"
+
+
+def test_not_found(asgi_app):
+    status, _, _ = asgi_get(asgi_app, "/not-a-page")
+    assert status == 404
+
+
+def test_system_page(asgi_app, fake_client):
+    status, headers, body = asgi_get(asgi_app, "/system/exampleapp")
+    assert status == 200
+    assert b"up-to-date" in body
+    assert b"2 commits" in body
+
+    # The page's fetches are timed like they are for Flask views
+    phases = [item.split(";")[0] for item in headers["server-timing"].split(", ")]
+    assert phases == ["config", "version", "github", "render", "total"]
+
+    # The repository's commits were fetched once for both environments
+    assert len([url for url in fake_client.urls if "/commits" in url]) == 1
+
+
+def test_system_page_bad_system(asgi_app, fake_client):
+    status, _, _ = asgi_get(asgi_app, "/system/notasystem")
+    assert status == 404
+
+
+def test_system_page_fetches_concurrently(asgi_app, fake_client):
+    fake_client.delay = 0.2
+    start = time.monotonic()
+    status, _, _ = asgi_get(asgi_app, "/system/exampleapp")
+    assert status == 200
+    # Two versions at the same time and then the commits
+    assert time.monotonic() - start < 0.6
+
+
+def test_system_page_environment_fails(asgi_app, fake_client):
+    fake_client.responses["http://service1.example.com/__version__"] = (500, {})
+    status, _, body = asgi_get(asgi_app, "/system/exampleapp")
+    assert status == 200
+    assert b"up-to-date" in body
+    assert b"unknown" in body
+
+
+def test_api_system(asgi_app, fake_client):
+    status, headers, body = asgi_get(asgi_app, "/api/system/exampleapp")
+    assert status == 200
+    assert headers["etag"]
+    data = json.loads(body)
+    assert [env["status"] for env in data[0]["environments"]] == [
+        "up-to-date",
+        "2 commits behind",
+    ]
+
+
+def test_api_systems(asgi_app, fake_client):
+    status, _, body = asgi_get(asgi_app, "/api/systems")
+    assert status == 200
+    assert list(json.loads(body)) == ["exampleapp"]
+
+
+def test_api_overview(asgi_app, fake_client):
+    status, _, body = asgi_get(asgi_app, "/api/overview")
+    assert status == 200
+    data = json.loads(body)
+    assert data["summary"]["statuses"] == {"up-to-date": 1, "behind": 1, "unknown": 0}
+
+
+def test_overview_page(asgi_app, fake_client):
+    status, _, body = asgi_get(asgi_app, "/overview")
+    assert status == 200
+    assert b"1 up-to-date" in body
+
+
+def test_api_system_bad_system(asgi_app, fake_client):
+    status, _, body = asgi_get(asgi_app, "/api/system/notasystem")
+    assert status == 404
+    assert json.loads(body) == {"error": "unknown system notasystem"}
+
+
+def test_heartbeat(asgi_app, fake_client):
+    status, _, body = asgi_get(asgi_app, "/__heartbeat__")
+    assert status == 200
+    assert json.loads(body) == {"github": "ok", "open_circuits": []}
+
+
+def test_system_page_github_fails(asgi_app, fake_client):
+    fake_client.responses[
+        "https://api.github.com/repos/example/service1/commits?sha=main&per_page=100"
+    ] = (500, {})
+    status, _, body = asgi_get(asgi_app, "/system/exampleapp")
+    assert status == 200
+    assert b"up-to-date" not in body
+    assert b"unknown" in body
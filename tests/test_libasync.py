@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import http.server
+import json
+import socket
+import threading
+
+import pytest
+import requests
+
+from app.libasync import AsyncHTTPClient
+
+
+class VersionHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/__version__":
+            self.send_error(404)
+            return
+        body = json.dumps(
+            {"commit": "abc123", "authorization": self.headers.get("Authorization")}
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), VersionHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def fetch(client, *urls):
+    async def _fetch():
+        try:
+            return [await client.get(url) for url in urls]
+        finally:
+            await client.close()
+
+    return asyncio.run(_fetch())
+
+
+def test_get(server):
+    client = AsyncHTTPClient(
+        max_connections=2,
+        timeout=(1.0, 1.0),
+        host_headers={server: {"Authorization": "token secret"}},
+    )
+    resp, missing = fetch(
+        client, f"http://{server}/__version__", f"http://{server}/missing"
+    )
+
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"] == "application/json"
+    assert resp.json() == {"commit": "abc123", "authorization": "token secret"}
+    assert missing.status_code == 404
+
+
+def test_get_connection_error():
+    client = AsyncHTTPClient(max_connections=2, timeout=(1.0, 1.0))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        fetch(client, f"http://127.0.0.1:{unused_port()}/__version__")
@@ -0,0 +1,204 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import sqlite3
+from unittest import mock
+
+import pytest
+
+from app.libcache import ConditionalCache, SQLiteCache, TTLCache, deep_sizeof
+
+
+def run_now(fun):
+    fun()
+
+
+class TestTTLCache:
+    def test_miss_then_hit(self):
+        cache = TTLCache(maxsize=10, ttl=60, stale_ttl=60, submit=run_now)
+        fetch_fun = mock.Mock(return_value="value")
+
+        assert cache.get_or_fetch("key", fetch_fun) == "value"
+        assert cache.get_or_fetch("key", fetch_fun) == "value"
+        assert fetch_fun.call_count == 1
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_stale_served_and_refreshed(self):
+        submitted = []
+        cache = TTLCache(maxsize=10, ttl=0, stale_ttl=60, submit=submitted.append)
+        cache.set("key", "old")
+
+        # The stale value is returned right away and one refresh is queued
+        assert cache.get_or_fetch("key", lambda: "new") == "old"
+        assert cache.get_or_fetch("key", lambda: "new") == "old"
+        assert len(submitted) == 1
+        assert cache.stats()["stale"] == 2
+
+        submitted[0]()
+        assert cache.get("key")[0] == "new"
+
+    def test_failed_refresh_keeps_stale_value(self):
+        cache = TTLCache(maxsize=10, ttl=0, stale_ttl=60, submit=run_now)
+        cache.set("key", "old")
+
+        def broken():
+            raise ValueError("upstream is down")
+
+        assert cache.get_or_fetch("key", broken) == "old"
+        assert cache.get("key")[0] == "old"
+
+    def test_too_stale_is_a_miss(self):
+        cache = TTLCache(maxsize=10, ttl=0, stale_ttl=0, submit=run_now)
+        cache.set("key", "old")
+
+        assert cache.get_or_fetch("key", lambda: "new") == "new"
+        assert cache.stats()["misses"] == 1
+
+    def test_miss_raises(self):
+        cache = TTLCache(maxsize=10, ttl=60, stale_ttl=60, submit=run_now)
+
+        def broken():
+            raise ValueError("upstream is down")
+
+        with pytest.raises(ValueError):
+            cache.get_or_fetch("key", broken)
+        assert cache.get("key") is None
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60, stale_ttl=60, submit=run_now)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # Touch "a" so "b" is the least recently used
+        cache.get_or_fetch("a", lambda: 1)
+        cache.set("c", 3)
+
+        assert cache.get("a") is not None
+        assert cache.get("b") is None
+        assert cache.get("c") is not None
+
+
+def test_deep_sizeof():
+    small = deep_sizeof({"sha": "abc"})
+    large = deep_sizeof({"sha": "abc", "files": [{"patch": "x" * 10_000}]})
+    assert large - small > 10_000
+
+    shared = "x" * 10_000
+    assert deep_sizeof([shared, shared]) < 2 * len(shared)
+
+
+def test_conditional_cache_memory_usage():
+    cache = ConditionalCache(maxsize=10)
+    assert cache.stats()["bytes"] < 1_000
+    cache.set("url", etag=None, last_modified=None, data="x" * 10_000)
+    assert cache.stats()["bytes"] > 10_000
+
+
+def test_conditional_cache_invalidate_prefix():
+    cache = ConditionalCache(maxsize=10)
+    cache.set("/repos/Example/service1/commits", etag="a", last_modified=None, data=1)
+    cache.set("/repos/example/service1/compare", etag="b", last_modified=None, data=2)
+    cache.set("/repos/example/service10/commits", etag="c", last_modified=None, data=3)
+
+    assert cache.invalidate_prefix("/repos/example/service1/") == 1
+    assert cache.invalidate_prefix("/repos/example/service1/", ignore_case=True) == 1
+    assert cache.get("/repos/example/service10/commits").data == 3
+
+
+def test_conditional_cache_freshness():
+    cache = ConditionalCache(maxsize=10, ttl=60)
+    cache.set("url", etag="a", last_modified=None, data=1)
+    entry = cache.get("url")
+    assert entry.is_fresh()
+
+    # Stale entries are fresh again once they're revalidated
+    entry.expires_at = 0
+    assert not entry.is_fresh()
+    cache.record_revalidated(entry)
+    assert entry.is_fresh()
+    assert cache.stats()["revalidated"] == 1
+
+
+@pytest.fixture()
+def sqlite_cache(tmp_path):
+    return SQLiteCache(path=str(tmp_path / "cache.sqlite"), max_entries=3)
+
+
+class TestSQLiteCache:
+    def test_round_trip(self, sqlite_cache):
+        sqlite_cache.store("ns", "key", {"commit": "abc"}, ttl=60)
+        value, age = sqlite_cache.load("ns", "key")
+        assert value == {"commit": "abc"}
+        assert age < 5
+        assert sqlite_cache.load("otherns", "key") is None
+
+    def test_expired(self, sqlite_cache):
+        sqlite_cache.store("ns", "key", "value", ttl=-1)
+        assert sqlite_cache.load("ns", "key") is None
+
+    def test_wal_mode(self, sqlite_cache):
+        (mode,) = sqlite_cache._conn().execute("PRAGMA journal_mode").fetchone()
+        assert mode == "wal"
+
+    def test_evict_oldest(self, sqlite_cache):
+        for i in range(5):
+            sqlite_cache.store("ns", str(i), i, ttl=60)
+        sqlite_cache.evict()
+
+        assert sqlite_cache.stats()["size"] == 3
+        assert sqlite_cache.load("ns", "0") is None
+        assert sqlite_cache.load("ns", "4") == (4, pytest.approx(0, abs=5))
+
+    def test_shared_between_instances(self, sqlite_cache, tmp_path):
+        # A second instance stands in for another worker process or a restart
+        sqlite_cache.store("ns", "key", "value", ttl=60)
+        other = SQLiteCache(path=str(tmp_path / "cache.sqlite"), max_entries=3)
+        assert other.load("ns", "key")[0] == "value"
+
+    def test_database_errors_are_logged(self, sqlite_cache, caplog):
+        class LockedConnection:
+            """Writes go through but deletes and counts find the database locked"""
+
+            def __init__(self, conn):
+                self.conn = conn
+
+            def execute(self, sql, *args):
+                if sql.startswith("INSERT"):
+                    return self.conn.execute(sql, *args)
+                raise sqlite3.OperationalError("database is locked")
+
+        sqlite_cache._local.conn = LockedConnection(sqlite_cache._conn())
+        sqlite_cache.EVICT_EVERY = 1
+
+        # Storing evicts on every write here
+        sqlite_cache.store("ns", "key", "value", ttl=60)
+        sqlite_cache.invalidate("ns", "key")
+        assert sqlite_cache.stats()["size"] is None
+
+        assert [record.message for record in caplog.records] == [
+            "persistent cache eviction failed",
+            "persistent cache invalidate failed",
+            "persistent cache stats failed",
+        ]
+
+    def test_warms_ttl_cache(self, sqlite_cache):
+        backing = sqlite_cache.namespace("version", ttl=60)
+        TTLCache(maxsize=10, ttl=60, stale_ttl=60, backing=backing).set("key", "v1")
+
+        fresh_cache = TTLCache(maxsize=10, ttl=60, stale_ttl=60, backing=backing)
+        fetch_fun = mock.Mock()
+        assert fresh_cache.get_or_fetch("key", fetch_fun) == "v1"
+        fetch_fun.assert_not_called()
+
+    def test_warms_conditional_cache(self, sqlite_cache):
+        backing = sqlite_cache.namespace("github", ttl=60)
+        ConditionalCache(maxsize=10, ttl=60, backing=backing).set(
+            "url", etag='"abc"', last_modified=None, data={"total_commits": 0}
+        )
+
+        entry = ConditionalCache(maxsize=10, ttl=60, backing=backing).get("url")
+        assert entry.data == {"total_commits": 0}
+        assert entry.conditional_headers() == {"If-None-Match": '"abc"'}
+        # Entries from the backing store are revalidated before they're used
+        assert not entry.is_fresh()
@@ -0,0 +1,66 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import hashlib
+import threading
+import time
+
+import pytest
+
+from app.libcpu import PoolFull, ProcessPool, TaskTimeout, hash_text
+
+
+@pytest.fixture()
+def pool():
+    pool = ProcessPool(max_workers=1, max_queue=0, timeout=5)
+    yield pool
+    pool.shutdown()
+
+
+def test_run(pool):
+    expected = "abc"
+    for _ in range(3):
+        expected = hashlib.sha256(expected.encode("utf-8")).hexdigest()
+
+    assert pool.run(hash_text, "abc", 3) == expected
+    stats = pool.stats()
+    assert stats["completed"] == 1
+    assert stats["running"] == 0
+    assert stats["queued"] == 0
+
+
+def test_full_pool_rejects_and_timed_out_tasks_stop(pool):
+    # Warm up the worker so the slow task starts right away
+    pool.run(hash_text, "abc", 1)
+
+    errors = []
+
+    def run_slow_task():
+        try:
+            pool.run(hash_text, "abc", 10**9, timeout=1)
+        except TaskTimeout as exc:
+            errors.append(exc)
+
+    thread = threading.Thread(target=run_slow_task)
+    thread.start()
+    while pool.stats()["running"] == 0:
+        time.sleep(0.01)
+
+    with pytest.raises(PoolFull):
+        pool.run(hash_text, "abc", 1)
+
+    thread.join()
+    assert len(errors) == 1
+
+    # The timed out task stops itself, so the worker is free again soon
+    start = time.monotonic()
+    while pool.stats()["running"] == 1:
+        time.sleep(0.01)
+    assert time.monotonic() - start < 1
+    pool.run(hash_text, "abc", 1)
+
+    stats = pool.stats()
+    assert stats["rejected"] == 1
+    assert stats["timed_out"] == 1
+    assert stats["completed"] == 2
@@ -0,0 +1,73 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import threading
+
+import pytest
+import requests
+
+from app.libdeadline import (
+    Deadline,
+    DeadlineExceeded,
+    check_deadline,
+    clamp_timeout,
+    is_retryable,
+    use_deadline,
+)
+from app.libupstream import fan_out
+
+
+def test_clamp():
+    deadline = Deadline(2)
+    assert deadline.clamp(5) <= 2
+    assert deadline.clamp((1, 5)) == (1, pytest.approx(2, abs=0.1))
+
+    # Timeouts are never 0
+    assert Deadline(-1).clamp((3, 5)) == (0.001, 0.001)
+
+
+def test_check():
+    Deadline(10).check()
+    with pytest.raises(DeadlineExceeded):
+        Deadline(-1).check()
+
+
+def test_current_deadline():
+    # Without a deadline, nothing changes
+    check_deadline()
+    assert clamp_timeout((3, 5)) == (3, 5)
+
+    with use_deadline(Deadline(-1)), pytest.raises(DeadlineExceeded):
+        check_deadline()
+    check_deadline()
+
+
+def test_is_retryable():
+    assert is_retryable(requests.exceptions.ConnectionError())
+    assert not is_retryable(DeadlineExceeded())
+    assert not is_retryable(ValueError())
+
+
+def test_fan_out_deadline():
+    release = threading.Event()
+
+    def wait_unless_first(item):
+        if item != 0:
+            release.wait(timeout=2)
+        return item
+
+    results = fan_out(
+        wait_unless_first, [0, 1], return_exceptions=True, deadline=Deadline(0.05)
+    )
+    release.set()
+    assert results[0] == 0
+    assert isinstance(results[1], DeadlineExceeded)
+
+
+def test_fan_out_passes_deadline_to_calls():
+    deadline = Deadline(10)
+
+    with use_deadline(deadline):
+        results = fan_out(lambda item: clamp_timeout(100), [0, 1])
+    assert all(result <= 10 for result in results)
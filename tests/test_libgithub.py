@@ -0,0 +1,321 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import concurrent.futures
+import json
+
+import pytest
+import requests
+from responses import matchers
+
+from app import libgithub
+from app.libgithub import (
+    GITHUB_CACHE,
+    REST_RATE_LIMIT,
+    Commit,
+    GitHubGraphQLError,
+    GraphQLHistoryPlanner,
+    History,
+    HistoryPlanner,
+    compact_compare,
+    fetch_history_from_github,
+    load_history,
+)
+from app.libratelimit import RateLimited
+
+COMPARE_URL = "https://api.github.com/repos/example/service1/compare/aaaaa12345...main"
+
+
+def test_fetch_history_revalidates_with_etag(responses, monkeypatch):
+    monkeypatch.setattr(GITHUB_CACHE, "ttl", 0)
+    # The 304 only matches the conditional request
+    responses.get(
+        url=COMPARE_URL,
+        status=304,
+        match=[
+            matchers.header_matcher({"If-None-Match": '"abc123"'}, strict_match=False)
+        ],
+    )
+    responses.get(
+        url=COMPARE_URL,
+        status=200,
+        json={"total_commits": 0},
+        headers={"ETag": '"abc123"'},
+    )
+
+    first = fetch_history_from_github(
+        user="example", repo="service1", from_sha="aaaaa12345"
+    )
+    second = fetch_history_from_github(
+        user="example", repo="service1", from_sha="aaaaa12345"
+    )
+
+    assert first == second == History(total_commits=0, commits=())
+    assert [call.response.status_code for call in responses.calls] == [200, 304]
+    assert GITHUB_CACHE.stats()["revalidated"] == 1
+    assert GITHUB_CACHE.stats()["misses"] == 1
+
+
+def test_fetch_history_uses_fresh_response(responses):
+    responses.get(
+        url=COMPARE_URL,
+        status=200,
+        json={"total_commits": 0},
+        headers={"ETag": '"abc123"'},
+    )
+
+    for _ in range(3):
+        history = fetch_history_from_github(
+            user="example", repo="service1", from_sha="aaaaa12345"
+        )
+        assert history == History(total_commits=0, commits=())
+
+    # The response is used without revalidating it until it's stale
+    assert len(responses.calls) == 1
+    assert GITHUB_CACHE.stats()["hits"] == 2
+    assert GITHUB_CACHE.stats()["revalidated"] == 0
+
+
+def test_fetch_history_refetches_when_main_moves(responses, monkeypatch):
+    monkeypatch.setattr(GITHUB_CACHE, "ttl", 0)
+    responses.get(
+        url=COMPARE_URL,
+        status=200,
+        json={"total_commits": 0},
+        headers={"ETag": '"old"'},
+    )
+    responses.get(
+        url=COMPARE_URL,
+        status=200,
+        json={"total_commits": 1, "commits": []},
+        headers={"ETag": '"new"'},
+    )
+
+    fetch_history_from_github(user="example", repo="service1", from_sha="aaaaa12345")
+    history = fetch_history_from_github(
+        user="example", repo="service1", from_sha="aaaaa12345"
+    )
+
+    assert history.total_commits == 1
+    assert responses.calls[1].request.headers["If-None-Match"] == '"old"'
+
+
+def test_fetch_history_serves_cached_when_rate_limited(responses, monkeypatch):
+    monkeypatch.setattr(GITHUB_CACHE, "ttl", 0)
+    responses.get(
+        url=COMPARE_URL,
+        status=200,
+        json={"total_commits": 0},
+        headers={"ETag": '"abc123"'},
+    )
+    responses.get(url=COMPARE_URL, status=429, headers={"Retry-After": "60"})
+
+    for _ in range(3):
+        history = fetch_history_from_github(
+            user="example", repo="service1", from_sha="aaaaa12345"
+        )
+        assert history == History(total_commits=0, commits=())
+
+    # The third fetch didn't call GitHub because it's backing off
+    assert [call.response.status_code for call in responses.calls] == [200, 429]
+    assert GITHUB_CACHE.stats()["unrevalidated"] == 2
+    assert REST_RATE_LIMIT.stats()["backoffs"] == 1
+
+
+def test_fetch_history_rate_limited_without_cache(responses):
+    responses.get(url=COMPARE_URL, status=429, headers={"Retry-After": "60"})
+
+    with pytest.raises(RateLimited):
+        fetch_history_from_github(
+            user="example", repo="service1", from_sha="aaaaa12345"
+        )
+    assert len(responses.calls) == 1
+
+
+def test_compact_compare():
+    data = {
+        "total_commits": 2,
+        "files": [{"filename": "README.md", "patch": "+" * 10_000}],
+        "commits": [
+            {
+                "sha": "ddb3277c7e6365ac28c61cef8f25c3e295e6329a",
+                "parents": [{"sha": "aaa"}, {"sha": "bbb"}],
+                "commit": {"message": "Merge pull request #1\n\nLots of text"},
+                "author": None,
+            },
+            {
+                "sha": "ee46327ef8dc59347749b06c60aed07730ed58aa",
+                "parents": [{"sha": "ddb"}],
+                "commit": {"message": "chore: update README"},
+                "author": {"login": "willkg", "avatar_url": "https://example.com"},
+            },
+        ],
+    }
+    history = compact_compare(data)
+    assert history == History(
+        total_commits=2,
+        commits=(
+            Commit(
+                sha="ddb3277c7e6365ac28c61cef8f25c3e295e6329a",
+                parents=2,
+                message="Merge pull request #1",
+                author="?",
+            ),
+            Commit(
+                sha="ee46327ef8dc59347749b06c60aed07730ed58aa",
+                parents=1,
+                message="chore: update README",
+                author="willkg",
+            ),
+        ),
+    )
+
+    # The JSON form from the persistent cache loads back to the same thing
+    assert load_history(json.loads(json.dumps(history))) == history
+
+
+COMMITS_URL = (
+    "https://api.github.com/repos/example/service1/commits?sha=main&per_page=100"
+)
+
+
+def make_commit(sha, parents=1):
+    return {
+        "sha": sha,
+        "parents": [{}] * parents,
+        "commit": {"message": f"commit {sha}"},
+        "author": {"login": "willkg"},
+    }
+
+
+class TestHistoryPlanner:
+    def test_one_commit_list_per_repo(self, responses):
+        responses.get(
+            url=COMMITS_URL,
+            json=[make_commit("ccc"), make_commit("bbb"), make_commit("aaa")],
+        )
+        planner = HistoryPlanner()
+
+        stage = planner.get_history(user="example", repo="service1", from_sha="ccc")
+        prod = planner.get_history(user="example", repo="service1", from_sha="aaa")
+
+        assert stage == History(total_commits=0, commits=())
+        # Commits are oldest first like in a compare
+        assert prod.total_commits == 2
+        assert [commit.sha for commit in prod.commits] == ["bbb", "ccc"]
+        assert len(responses.calls) == 1
+
+    def test_abbreviated_sha(self, responses):
+        responses.get(
+            url=COMMITS_URL, json=[make_commit("bbb123"), make_commit("aaa123")]
+        )
+        history = HistoryPlanner().get_history(
+            user="example", repo="service1", from_sha="aaa"
+        )
+        assert history.total_commits == 1
+
+    def test_compare_when_sha_not_in_window(self, responses):
+        responses.get(url=COMMITS_URL, json=[make_commit("bbb")])
+        responses.get(
+            url="https://api.github.com/repos/example/service1/compare/old...main",
+            json={"total_commits": 150, "commits": []},
+        )
+        history = HistoryPlanner().get_history(
+            user="example", repo="service1", from_sha="old"
+        )
+        assert history.total_commits == 150
+
+    def test_compare_when_merge_commits_ahead(self, responses):
+        responses.get(
+            url=COMMITS_URL,
+            json=[
+                make_commit("ccc", parents=2),
+                make_commit("bbb"),
+                make_commit("aaa"),
+            ],
+        )
+        responses.get(
+            url="https://api.github.com/repos/example/service1/compare/aaa...main",
+            json={"total_commits": 3, "commits": []},
+        )
+        history = HistoryPlanner().get_history(
+            user="example", repo="service1", from_sha="aaa"
+        )
+        assert history.total_commits == 3
+
+    def test_failed_commit_list_is_shared(self, responses):
+        responses.get(url=COMMITS_URL, status=404)
+        planner = HistoryPlanner()
+        for sha in ("aaa", "bbb"):
+            with pytest.raises(requests.exceptions.HTTPError):
+                planner.get_history(user="example", repo="service1", from_sha=sha)
+        assert len(responses.calls) == 1
+
+    def test_interrupted_commit_list_is_cancelled(self, monkeypatch):
+        def fetch_commits_from_github(user, repo, per_page):
+            raise KeyboardInterrupt()
+
+        monkeypatch.setattr(
+            libgithub, "fetch_commits_from_github", fetch_commits_from_github
+        )
+        planner = HistoryPlanner()
+        with pytest.raises(KeyboardInterrupt):
+            planner.get_history(user="example", repo="service1", from_sha="aaa")
+
+        # Threads waiting on the fetch get CancelledError instead of hanging
+        with pytest.raises(concurrent.futures.CancelledError):
+            planner.get_history(user="example", repo="service1", from_sha="aaa")
+
+
+GRAPHQL_URL = "https://api.github.com/graphql"
+
+
+class TestGraphQLHistoryPlanner:
+    def test_one_query_per_batch(self, fake_graphql):
+        fake = fake_graphql(
+            {
+                ("example", "service1"): ["ccc", "bbb", "aaa"],
+                ("example", "service2"): ["zzz", "yyy"],
+            }
+        )
+        planner = GraphQLHistoryPlanner(url=GRAPHQL_URL)
+
+        planner.prime(
+            [
+                ("example", "service1", "ccc"),
+                ("example", "service1", "aaa"),
+                ("example", "service2", "yyy"),
+            ]
+        )
+        assert len(fake.queries) == 1
+
+        assert planner.get_history("example", "service1", "ccc") == History(0, ())
+        history = planner.get_history("example", "service1", "aaa")
+        assert history.total_commits == 2
+        assert [commit.sha for commit in history.commits] == ["bbb", "ccc"]
+        assert history.commits[0].message == "commit bbb"
+        assert history.commits[0].author == "willkg"
+        assert planner.get_history("example", "service2", "yyy").total_commits == 1
+        assert len(fake.queries) == 1
+
+    def test_unprimed_key(self, fake_graphql):
+        fake = fake_graphql({("example", "service1"): ["bbb", "aaa"]})
+        planner = GraphQLHistoryPlanner(url=GRAPHQL_URL)
+
+        assert planner.get_history("example", "service1", "aaa").total_commits == 1
+        assert len(fake.queries) == 1
+
+    def test_unknown_sha(self, fake_graphql):
+        fake_graphql({("example", "service1"): ["bbb", "aaa"]})
+        planner = GraphQLHistoryPlanner(url=GRAPHQL_URL)
+        with pytest.raises(GitHubGraphQLError, match="example/service1 has no commit"):
+            planner.prime([("example", "service1", "zzz")])
+
+    def test_errors(self, responses):
+        responses.post(
+            url=GRAPHQL_URL, json={"errors": [{"message": "Bad credentials"}]}
+        )
+        planner = GraphQLHistoryPlanner(url=GRAPHQL_URL)
+        with pytest.raises(GitHubGraphQLError, match="Bad credentials"):
+            planner.prime([("example", "service1", "aaa")])
@@ -0,0 +1,69 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.libhttp import SessionPool, github_headers
+
+
+class VersionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b'{"commit": "abc"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def local_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), VersionHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_sessions_are_per_host():
+    pool = SessionPool(pool_maxsize=2, timeout=1)
+    session = pool.get_session("https://a.example.com/__version__")
+    assert pool.get_session("https://a.example.com/other") is session
+    assert pool.get_session("https://b.example.com/__version__") is not session
+
+
+def test_host_headers():
+    pool = SessionPool(
+        pool_maxsize=2,
+        timeout=1,
+        host_headers={"api.github.com": github_headers("secret")},
+    )
+    github_session = pool.get_session("https://api.github.com/repos")
+    assert github_session.headers["Authorization"] == "Bearer secret"
+    other_session = pool.get_session("https://example.com/__version__")
+    assert "Authorization" not in other_session.headers
+
+
+def test_github_headers_without_token():
+    assert "Authorization" not in github_headers("")
+
+
+def test_connections_are_reused(local_server, responses):
+    responses.add_passthru(local_server)
+    pool = SessionPool(pool_maxsize=2, timeout=1)
+    for _ in range(3):
+        assert pool.get(f"{local_server}/__version__").json() == {"commit": "abc"}
+
+    host = local_server.split("//")[1]
+    assert pool.stats() == {host: {"requests": 3, "connections": 1}}
+    pool.close()
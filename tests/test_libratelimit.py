@@ -0,0 +1,122 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+
+import pytest
+import requests
+
+from app.libratelimit import RateLimited, RateLimitScheduler, background_priority
+
+
+def build_response(status_code=200, headers=None, text=""):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.headers.update(headers or {})
+    resp._content = text.encode("utf-8")
+    return resp
+
+
+def build_scheduler(**kwargs):
+    kwargs = {
+        "name": "test",
+        "limit": 100,
+        "burst": 10,
+        "reserve": 0.2,
+        "max_wait": 0,
+        **kwargs,
+    }
+    return RateLimitScheduler(**kwargs)
+
+
+def test_burst():
+    scheduler = build_scheduler()
+    for _ in range(10):
+        scheduler.acquire()
+    with pytest.raises(RateLimited):
+        scheduler.acquire()
+    assert scheduler.stats()["interactive_calls"] == 10
+    assert scheduler.stats()["throttled"] == 1
+
+
+def test_interactive_calls_wait_for_tokens():
+    # 3600 calls over an hour is a token a second
+    scheduler = build_scheduler(limit=3600, burst=1, max_wait=2, window=3600)
+    scheduler.acquire()
+    scheduler.tokens = 0.9
+    start_time = time.monotonic()
+    scheduler.acquire()
+    assert time.monotonic() - start_time < 0.5
+
+
+def test_background_calls_leave_the_reserve():
+    scheduler = build_scheduler()
+    scheduler.update(build_response(headers={"X-RateLimit-Remaining": "20"}))
+
+    with background_priority(), pytest.raises(RateLimited, match="reserved"):
+        scheduler.acquire()
+    # Interactive calls can still use it
+    scheduler.acquire()
+
+
+def test_update_syncs_budget():
+    scheduler = build_scheduler()
+    reset = int(time.time()) + 600
+    scheduler.update(
+        build_response(
+            headers={
+                "X-RateLimit-Limit": "5000",
+                "X-RateLimit-Remaining": "4",
+                "X-RateLimit-Reset": str(reset),
+            }
+        )
+    )
+    stats = scheduler.stats()
+    assert stats["limit"] == 5000
+    assert stats["remaining"] == 4
+    assert stats["tokens"] <= 4
+    assert 590 <= stats["reset_in"] <= 600
+
+
+def test_retry_after():
+    scheduler = build_scheduler()
+    with pytest.raises(RateLimited):
+        scheduler.update(build_response(status_code=429, headers={"Retry-After": "30"}))
+    assert 29 <= scheduler.stats()["blocked_for"] <= 30
+
+    with pytest.raises(RateLimited, match="rate limited for"):
+        scheduler.acquire()
+
+
+def test_used_up_budget_blocks_until_reset():
+    scheduler = build_scheduler()
+    with pytest.raises(RateLimited):
+        scheduler.update(
+            build_response(
+                status_code=403,
+                headers={
+                    "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset": str(int(time.time()) + 120),
+                },
+            )
+        )
+    assert 119 <= scheduler.stats()["blocked_for"] <= 120
+
+
+def test_secondary_rate_limit():
+    scheduler = build_scheduler()
+    with pytest.raises(RateLimited):
+        scheduler.update(
+            build_response(
+                status_code=403,
+                text='{"message": "You have exceeded a secondary rate limit."}',
+            )
+        )
+    assert scheduler.stats()["backoffs"] == 1
+
+
+def test_other_403s_are_not_rate_limits():
+    scheduler = build_scheduler()
+    scheduler.update(build_response(status_code=403, text="Resource not accessible"))
+    assert scheduler.stats()["blocked_for"] == 0
@@ -0,0 +1,171 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from app import main
+from app.libgithub import GITHUB_CACHE
+from app.libsnapshot import SnapshotRefresher
+from app.libsystems import Systems
+
+SYSTEMS = Systems.model_validate(
+    {
+        "systems": {
+            "exampleapp": {
+                "services": [
+                    {
+                        "name": "Service 1",
+                        "environments": [
+                            {"name": "prod", "host": "http://service1.example.com"},
+                        ],
+                    },
+                ],
+            },
+        },
+    }
+)
+
+
+def add_responses(responses, commit):
+    responses.get(
+        url="http://service1.example.com/__version__",
+        json={
+            "source": "https://github.com/example/service1",
+            "version": "main",
+            "commit": commit,
+            "build": "",
+        },
+    )
+    responses.get(
+        url="https://api.github.com/repos/example/service1/commits?sha=main&per_page=100",
+        json=[
+            {
+                "sha": commit,
+                "parents": [{}],
+                "commit": {"message": "fix: release"},
+                "author": {"login": "willkg"},
+            }
+        ],
+    )
+
+
+@pytest.fixture()
+def refresher():
+    return SnapshotRefresher(
+        get_systems=lambda: SYSTEMS, min_interval=10, max_interval=40
+    )
+
+
+def test_refresh_due_builds_snapshot(responses, refresher):
+    add_responses(responses, commit="aaaaa12345")
+
+    assert refresher.get_system_data(SYSTEMS.systems["exampleapp"]) is None
+    assert refresher.refresh_due() == 1
+
+    data, age = refresher.get_system_data(SYSTEMS.systems["exampleapp"])
+    assert data[0]["environments"][0]["commit"] == "aaaaa12345"
+    assert data[0]["environments"][0]["status"] == "up-to-date"
+    assert age >= 0
+
+    # Nothing is due right after a poll
+    assert refresher.refresh_due() == 0
+
+
+def test_mark_due(responses, refresher):
+    add_responses(responses, commit="aaaaa12345")
+    assert refresher.refresh_due() == 1
+    assert refresher.refresh_due() == 0
+
+    assert refresher.mark_due(host="http://other.example.com") == 0
+    assert refresher.mark_due(repo=("example", "other")) == 0
+    assert refresher.mark_due(repo=("Example", "Service1")) == 1
+    assert refresher.refresh_due() == 1
+
+    assert refresher.mark_due(host="http://service1.example.com") == 1
+    assert refresher.refresh_due() == 1
+
+
+def test_poll_interval_adapts(responses, refresher, monkeypatch):
+    # Main moves along with the deploy below
+    monkeypatch.setattr(GITHUB_CACHE, "ttl", 0)
+    add_responses(responses, commit="aaaaa12345")
+    environment = SYSTEMS.systems["exampleapp"].services[0].environments[0]
+
+    refresher._poll([environment])
+    assert refresher._states[environment.host].interval == 10
+
+    # Unchanged environments back off up to max_interval
+    for expected in [20, 40, 40]:
+        refresher._poll([environment])
+        assert refresher._states[environment.host].interval == expected
+
+    # A new deploy resets the interval
+    responses.reset()
+    add_responses(responses, commit="bbbbb12345")
+    refresher._poll([environment])
+    assert refresher._states[environment.host].interval == 10
+
+
+def test_failed_poll_keeps_last_data(responses, refresher):
+    add_responses(responses, commit="aaaaa12345")
+    environment = SYSTEMS.systems["exampleapp"].services[0].environments[0]
+    refresher._poll([environment])
+
+    responses.reset()
+    responses.get(url="http://service1.example.com/__version__", status=500)
+    refresher._poll([environment])
+
+    state = refresher._states[environment.host]
+    assert state.data["commit"] == "aaaaa12345"
+    assert state.error is not None
+    assert refresher.stats()["errors"] == 1
+
+
+def test_system_page_renders_from_snapshot(app, responses, refresher, monkeypatch):
+    monkeypatch.setattr(main, "get_systems_data", lambda: SYSTEMS)
+    add_responses(responses, commit="aaaaa12345")
+    refresher.refresh_due()
+    app.extensions["snapshot_refresher"] = refresher
+
+    # Rendering doesn't touch upstreams
+    responses.reset()
+    resp = app.test_client().get("/system/exampleapp")
+    assert resp.status_code == 200
+    assert b"aaaaa12345" in resp.data
+    assert b"Status as of 0 seconds ago" in resp.data
+
+
+def test_failed_environment_rendered_from_snapshot(responses):
+    systems = Systems.model_validate(
+        {
+            "systems": {
+                "exampleapp": {
+                    "services": [
+                        {
+                            "name": "Service 1",
+                            "environments": [
+                                {"name": "prod", "host": "http://service1.example.com"},
+                                {"name": "dev", "host": "http://down.example.com"},
+                            ],
+                        },
+                    ],
+                },
+            },
+        }
+    )
+    refresher = SnapshotRefresher(
+        get_systems=lambda: systems, min_interval=10, max_interval=40
+    )
+    add_responses(responses, commit="aaaaa12345")
+    responses.get(url="http://down.example.com/__version__", status=500)
+    assert refresher.refresh_due() == 2
+
+    # The system is still served from the snapshot with the failed environment
+    # rendered as unknown
+    data, _ = refresher.get_system_data(systems.systems["exampleapp"])
+    prod, dev = data[0]["environments"]
+    assert prod["status"] == "up-to-date"
+    assert dev["name"] == "dev"
+    assert dev["status"] == "unknown"
+    assert "500" in dev["error"]
@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import gzip
+import os
+
+import brotli
+import pytest
+from flask import Flask
+
+from app.libstatic import StaticAssets, compress_directory, hashed_name, main
+
+CSS = b"body { color: black; }\n" * 100
+
+
+@pytest.fixture()
+def static_dir(tmp_path):
+    (tmp_path / "css").mkdir()
+    (tmp_path / "css" / "site.css").write_bytes(CSS)
+    (tmp_path / "image.png").write_bytes(b"\x89PNG")
+    return tmp_path
+
+
+def get(assets, filename, headers=None):
+    with Flask(__name__).test_request_context(headers=headers or {}):
+        return assets.response(filename)
+
+
+def test_hashed_name():
+    assert hashed_name("css/site.min.css", "abc") == "css/site.min.abc.css"
+    assert hashed_name("favicon", "abc") == "favicon.abc"
+
+
+def test_url(static_dir):
+    assets = StaticAssets(str(static_dir))
+    url = assets.url("css/site.css")
+    assert url.startswith("css/site.") and url.endswith(".css")
+    assert url != "css/site.css"
+    assert assets.url("missing.css") == "missing.css"
+
+
+def test_hashed_response(static_dir):
+    assets = StaticAssets(str(static_dir))
+    resp = get(assets, assets.url("css/site.css"), {"Accept-Encoding": "gzip"})
+    assert resp.status_code == 200
+    assert resp.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.headers["Vary"] == "Accept-Encoding"
+    assert resp.mimetype == "text/css"
+    assert gzip.decompress(resp.get_data()) == CSS
+
+    resp = get(assets, assets.url("css/site.css"))
+    assert "Content-Encoding" not in resp.headers
+    assert resp.get_data() == CSS
+
+
+def test_unhashed_response(static_dir):
+    assets = StaticAssets(str(static_dir))
+    resp = get(assets, "css/site.css")
+    assert resp.status_code == 200
+    assert resp.headers["Cache-Control"] == "no-cache"
+
+    resp = get(assets, "css/site.css", {"If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+
+    # Files that don't compress are only served as they are
+    resp = get(assets, "image.png", {"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in resp.headers
+    assert "Vary" not in resp.headers
+
+    assert get(assets, "missing.css") is None
+
+
+def test_precompressed_variants(static_dir):
+    written = compress_directory(str(static_dir))
+    assert sorted(os.path.relpath(path, static_dir) for path in written) == [
+        "css/site.css.br",
+        "css/site.css.gz",
+    ]
+
+    assets = StaticAssets(str(static_dir))
+    resp = get(assets, assets.url("css/site.css"), {"Accept-Encoding": "br"})
+    assert resp.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(resp.get_data()) == CSS
+
+    resp = get(assets, assets.url("css/site.css"), {"Accept-Encoding": "gzip, br"})
+    assert resp.headers["Content-Encoding"] == "br"
+
+    # Precompressed files older than the file are ignored
+    os.utime(static_dir / "css" / "site.css.br", (0, 0))
+    assets = StaticAssets(str(static_dir))
+    resp = get(assets, assets.url("css/site.css"), {"Accept-Encoding": "gzip, br"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+
+
+def test_main(static_dir, capsys):
+    main([str(static_dir)])
+    assert capsys.readouterr().out.split() == [
+        str(static_dir / "css" / "site.css.br"),
+        str(static_dir / "css" / "site.css.gz"),
+    ]
+    assert brotli.decompress((static_dir / "css" / "site.css.br").read_bytes()) == CSS
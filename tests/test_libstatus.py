@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+
+import requests
+
+from app.libstatus import get_environments_data, get_overview_data, summarize_overview
+from app.libsystems import Environment, Systems
+from app.settings import settings
+
+ENVIRONMENTS = [
+    Environment(name="stage", host="http://service1-stage.example.com"),
+    Environment(name="prod", host="http://service1.example.com"),
+]
+
+
+def add_version(responses, host, commit):
+    responses.get(
+        url=f"{host}/__version__",
+        json={
+            "source": "https://github.com/example/service1",
+            "version": "main",
+            "commit": commit,
+            "build": "",
+        },
+    )
+
+
+def test_graphql_backend(responses, fake_graphql, monkeypatch):
+    monkeypatch.setattr(settings, "APP_GITHUB_BACKEND", "graphql")
+    add_version(responses, "http://service1-stage.example.com", "ccc")
+    add_version(responses, "http://service1.example.com", "aaa")
+    fake = fake_graphql({("example", "service1"): ["ccc", "bbb", "aaa"]})
+
+    stage, prod = get_environments_data(ENVIRONMENTS)
+
+    assert stage["status"] == "up-to-date"
+    assert prod["status"] == "2 commits behind"
+    assert [commit["sha"] for commit in prod["commits"]] == ["bbb", "ccc"]
+    assert prod["commits"][0]["message"] == "commit bbb"
+    # Both environments were resolved in a single query
+    assert len(fake.queries) == 1
+    assert json.loads(responses.calls[-1].request.body)["variables"]["r0_c1"] == "ccc"
+
+
+def test_return_exceptions(responses, fake_graphql, monkeypatch):
+    monkeypatch.setattr(settings, "APP_GITHUB_BACKEND", "graphql")
+    add_version(responses, "http://service1.example.com", "aaa")
+    responses.get(url="http://service1-stage.example.com/__version__", status=500)
+    fake_graphql({("example", "service1"): ["aaa"]})
+
+    stage, prod = get_environments_data(ENVIRONMENTS, return_exceptions=True)
+
+    assert isinstance(stage, requests.exceptions.HTTPError)
+    assert prod["status"] == "up-to-date"
+
+
+def test_overview_fetches_shared_hosts_once(responses):
+    systems = Systems.model_validate(
+        {
+            "systems": {
+                name: {
+                    "services": [
+                        {
+                            "name": f"{name} service",
+                            "environments": [
+                                {
+                                    "name": "stage",
+                                    "host": "http://service1-stage.example.com",
+                                },
+                                {"name": "prod", "host": "http://service1.example.com"},
+                            ],
+                        },
+                    ],
+                }
+                for name in ("app1", "app2", "app3")
+            },
+        }
+    )
+    add_version(responses, "http://service1-stage.example.com", "ccc")
+    responses.get(url="http://service1.example.com/__version__", status=500)
+    responses.get(
+        url="https://api.github.com/repos/example/service1/commits?sha=main&per_page=100",
+        json=[
+            {"sha": sha, "parents": [{}], "commit": {"message": sha}, "author": None}
+            for sha in ("ccc", "bbb")
+        ],
+    )
+
+    overview = get_overview_data(systems)
+
+    assert list(overview) == ["app1", "app2", "app3"]
+    for services in overview.values():
+        stage, prod = services[0]["environments"]
+        assert (stage["name"], stage["status"]) == ("stage", "up-to-date")
+        assert (prod["name"], prod["status"]) == ("prod", "unknown")
+
+    # Each host and repository was fetched once for all three systems
+    assert sorted(call.request.url.split("?")[0] for call in responses.calls) == [
+        "http://service1-stage.example.com/__version__",
+        "http://service1.example.com/__version__",
+        "https://api.github.com/repos/example/service1/commits",
+    ]
+
+    assert summarize_overview(overview) == {
+        "systems": 3,
+        "environments": 6,
+        "hosts": 2,
+        "repos": 1,
+        "statuses": {"up-to-date": 3, "behind": 0, "unknown": 3},
+    }
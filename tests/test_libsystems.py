@@ -2,7 +2,12 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from app.libsystems import Systems
+import os
+
+import pytest
+import yaml
+
+from app.libsystems import Systems, SystemsConfig
 
 
 def test_empty():
@@ -11,3 +16,92 @@ def test_empty():
 
 def test_system_with_no_services():
     Systems.model_validate({"systems": {"examplesystem": {"services": []}}})
+
+
+SYSTEMS_YAML = """\
+systems:
+  zeta:
+    services:
+      - name: Zeta
+        environments:
+          - name: prod
+            host: "https://shared.example.com"
+  alpha:
+    services:
+      - name: Alpha
+        environments:
+          - name: stage
+            host: "https://alpha-stage.example.com"
+          - name: prod
+            host: "https://shared.example.com"
+      - name: Beta
+        environments:
+          - name: prod
+            host: "https://beta.example.com"
+"""
+
+
+def write_config(path, text, mtime):
+    path.write_text(text)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_indexes():
+    systems = Systems.model_validate(yaml.safe_load(SYSTEMS_YAML))
+    assert systems.system_list == [("alpha", 2), ("zeta", 1)]
+    assert list(systems.hosts) == [
+        "https://alpha-stage.example.com",
+        "https://shared.example.com",
+        "https://beta.example.com",
+    ]
+    assert systems.environments_for_host("https://shared.example.com") == [
+        ("alpha", "Alpha", "prod"),
+        ("zeta", "Zeta", "prod"),
+    ]
+    assert systems.environments_for_host("https://unknown.example.com") == []
+
+
+def test_config_reloads_when_file_changes(tmp_path):
+    path = tmp_path / "systems.yaml"
+    write_config(path, SYSTEMS_YAML, mtime=1_000_000_000)
+    config = SystemsConfig(path=str(path), check_interval=0)
+
+    first = config.get()
+    assert first.system_list == [("alpha", 2), ("zeta", 1)]
+    # Unchanged files aren't reloaded
+    assert config.get() is first
+
+    write_config(path, SYSTEMS_YAML.split("  alpha:")[0], mtime=2_000_000_000)
+    assert config.get().system_list == [("zeta", 1)]
+    assert config.stats()["reloads"] == 1
+
+
+def test_config_keeps_last_good_systems(tmp_path, caplog):
+    path = tmp_path / "systems.yaml"
+    write_config(path, SYSTEMS_YAML, mtime=1_000_000_000)
+    config = SystemsConfig(path=str(path), check_interval=0)
+    first = config.get()
+
+    write_config(path, "systems:\n  broken: {}\n", mtime=2_000_000_000)
+    assert config.get() is first
+    assert config.get() is first
+    stats = config.stats()
+    assert stats["errors"] == 1
+    assert stats["reloads"] == 0
+    assert "not reloaded" in caplog.text
+
+
+def test_config_checks_at_most_every_interval(tmp_path):
+    path = tmp_path / "systems.yaml"
+    write_config(path, SYSTEMS_YAML, mtime=1_000_000_000)
+    config = SystemsConfig(path=str(path), check_interval=60)
+    first = config.get()
+
+    write_config(path, SYSTEMS_YAML.split("  alpha:")[0], mtime=2_000_000_000)
+    assert config.get() is first
+
+
+def test_config_fails_without_a_good_file(tmp_path):
+    config = SystemsConfig(path=str(tmp_path / "missing.yaml"), check_interval=0)
+    with pytest.raises(OSError):
+        config.get()
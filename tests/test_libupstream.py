@@ -0,0 +1,283 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import threading
+import time
+
+import pytest
+import requests
+
+from app.libupstream import (
+    BREAKERS,
+    CircuitBreakers,
+    CircuitOpen,
+    Hedger,
+    HostLimiter,
+    SingleFlight,
+    fan_out,
+    fan_out_iter,
+    fetch_version,
+)
+
+
+def test_fan_out_preserves_order():
+    def slow_square(item):
+        # Earlier items take longer so they finish last
+        time.sleep(0.01 * (5 - item))
+        return item * item
+
+    assert fan_out(slow_square, [1, 2, 3, 4]) == [1, 4, 9, 16]
+
+
+def test_fan_out_runs_concurrently():
+    barrier = threading.Barrier(3, timeout=2)
+
+    def wait_for_others(item):
+        # This only passes if all three items are in flight at the same time
+        barrier.wait()
+        return item
+
+    assert fan_out(wait_for_others, ["a", "b", "c"]) == ["a", "b", "c"]
+
+
+def test_fan_out_raises_earliest_exception():
+    def fail_odd(item):
+        if item % 2:
+            raise ValueError(str(item))
+        return item
+
+    with pytest.raises(ValueError, match="1"):
+        fan_out(fail_odd, [0, 1, 2, 3])
+
+
+def test_fan_out_iter_yields_before_later_items_finish():
+    release = threading.Event()
+
+    def wait_unless_first(item):
+        if item != 0:
+            release.wait(timeout=2)
+        return item
+
+    results = fan_out_iter(wait_unless_first, [0, 1, 2])
+    # The first result is in while the others are still waiting
+    assert next(results) == 0
+    release.set()
+    assert list(results) == [1, 2]
+
+
+def test_host_limiter():
+    limiter = HostLimiter(max_per_host=2)
+    lock = threading.Lock()
+    in_flight = {"a.example.com": 0, "b.example.com": 0}
+    max_in_flight = dict(in_flight)
+
+    def call(url):
+        host = url.split("/")[2]
+        with limiter.limit(url):
+            with lock:
+                in_flight[host] += 1
+                max_in_flight[host] = max(max_in_flight[host], in_flight[host])
+            time.sleep(0.02)
+            with lock:
+                in_flight[host] -= 1
+
+    urls = [f"https://a.example.com/{i}" for i in range(6)] + [
+        f"https://b.example.com/{i}" for i in range(6)
+    ]
+    threads = [threading.Thread(target=call, args=(url,)) for url in urls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max_in_flight == {"a.example.com": 2, "b.example.com": 2}
+
+
+class TestSingleFlight:
+    def test_coalesces_concurrent_calls(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def slow_fetch():
+            calls.append(1)
+            release.wait(timeout=2)
+            return {"commit": "abc"}
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(single_flight.do("url", slow_fetch))
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        # Wait for every caller to be either in flight or waiting on it
+        while single_flight.stats()["coalesced"] < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert results == [{"commit": "abc"}] * 5
+        assert single_flight.stats() == {"in_flight": 0, "calls": 1, "coalesced": 4}
+
+    def test_shares_exceptions(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def broken_fetch():
+            started.set()
+            release.wait(timeout=2)
+            raise ValueError("upstream is down")
+
+        errors = []
+
+        def call():
+            try:
+                single_flight.do("url", broken_fetch)
+            except ValueError as exc:
+                errors.append(exc)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(timeout=2)
+        follower = threading.Thread(target=call)
+        follower.start()
+        while single_flight.stats()["coalesced"] < 1:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+
+        assert len(errors) == 2
+
+    def test_sequential_calls_are_not_coalesced(self):
+        single_flight = SingleFlight()
+        assert single_flight.do("url", lambda: 1) == 1
+        assert single_flight.do("url", lambda: 2) == 2
+
+
+class TestHedger:
+    def test_no_hedging_without_samples(self):
+        hedger = Hedger(percentile=95, min_delay=0, min_samples=5)
+        assert hedger.delay() is None
+        for _ in range(5):
+            assert hedger.call(lambda: 1) == 1
+        assert hedger.delay() is not None
+        assert hedger.stats()["hedged"] == 0
+
+    def test_disabled(self):
+        hedger = Hedger(percentile=0, min_delay=0, min_samples=0)
+        hedger.call(lambda: 1)
+        assert hedger.delay() is None
+
+    def test_slow_call_is_hedged(self):
+        hedger = Hedger(percentile=50, min_delay=0.01, min_samples=1)
+        hedger.call(lambda: "warm up")
+
+        release = threading.Event()
+        calls = []
+
+        def first_call_is_slow():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait(timeout=2)
+                return "slow"
+            return "fast"
+
+        assert hedger.call(first_call_is_slow) == "fast"
+        release.set()
+        assert hedger.stats()["hedged"] == 1
+        assert hedger.stats()["hedge_wins"] == 1
+
+    def test_both_calls_fail(self):
+        hedger = Hedger(percentile=50, min_delay=0.01, min_samples=1)
+        hedger.call(lambda: "warm up")
+
+        def broken():
+            time.sleep(0.05)
+            raise ValueError("upstream is down")
+
+        with pytest.raises(ValueError):
+            hedger.call(broken)
+
+
+class TestCircuitBreakers:
+    URL = "https://a.example.com/__version__"
+
+    def fail(self, breakers, exc):
+        with pytest.raises(type(exc)), breakers.guard(self.URL):
+            raise exc
+
+    def test_opens_after_threshold(self):
+        breakers = CircuitBreakers(failure_threshold=2, cooldown=60)
+        self.fail(breakers, requests.exceptions.ConnectionError())
+        assert breakers.state(self.URL) == "closed"
+        self.fail(breakers, requests.exceptions.ConnectionError())
+        assert breakers.state(self.URL) == "open"
+
+        with pytest.raises(CircuitOpen), breakers.guard(self.URL):
+            pass
+        assert breakers.stats() == {
+            "closed": 0,
+            "open": 1,
+            "half_open": 0,
+            "rejected": 1,
+        }
+        assert breakers.not_closed() == ["a.example.com"]
+
+        # Other hosts aren't affected
+        with breakers.guard("https://b.example.com/__version__"):
+            pass
+
+    def test_success_resets_failures(self):
+        breakers = CircuitBreakers(failure_threshold=2, cooldown=60)
+        self.fail(breakers, requests.exceptions.ConnectionError())
+        with breakers.guard(self.URL):
+            pass
+        self.fail(breakers, requests.exceptions.ConnectionError())
+        assert breakers.state(self.URL) == "closed"
+
+    def test_client_errors_are_not_failures(self):
+        breakers = CircuitBreakers(failure_threshold=1, cooldown=60)
+        resp = requests.Response()
+        resp.status_code = 404
+        self.fail(breakers, requests.exceptions.HTTPError(response=resp))
+        assert breakers.state(self.URL) == "closed"
+
+    def test_half_open_probe(self):
+        breakers = CircuitBreakers(failure_threshold=1, cooldown=0)
+        self.fail(breakers, requests.exceptions.ConnectionError())
+        assert breakers.state(self.URL) == "open"
+
+        # After the cooldown, one probe goes through while others fail fast
+        with breakers.guard(self.URL):
+            assert breakers.state(self.URL) == "half-open"
+            with pytest.raises(CircuitOpen), breakers.guard(self.URL):
+                pass
+        assert breakers.state(self.URL) == "closed"
+
+    def test_failed_probe_reopens(self):
+        breakers = CircuitBreakers(failure_threshold=1, cooldown=0)
+        self.fail(breakers, requests.exceptions.ConnectionError())
+        self.fail(breakers, requests.exceptions.ConnectionError())
+        assert breakers.state(self.URL) == "open"
+
+
+def test_fetch_version_fails_fast_when_open(monkeypatch, responses):
+    # NOTE(willkg): stamina makes one attempt per call in tests
+    monkeypatch.setattr(BREAKERS, "failure_threshold", 1)
+    host = "http://down.example.com"
+    responses.get(f"{host}/__version__", status=503)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        fetch_version(host)
+    # The circuit is open now, so the next fetch doesn't call the host at all
+    with pytest.raises(CircuitOpen):
+        fetch_version(host)
+    assert len(responses.calls) == 1
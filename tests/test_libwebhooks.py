@@ -0,0 +1,70 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from app.libgithub import GITHUB_CACHE
+from app.libupstream import VERSION_CACHE
+from app.libwebhooks import (
+    WebhookError,
+    handle_deploy,
+    handle_push,
+    sign,
+    verify_signature,
+)
+
+
+def test_verify_signature():
+    body = b'{"ref": "refs/heads/main"}'
+    signature = sign("secret", body)
+    assert signature.startswith("sha256=")
+    assert verify_signature("secret", body, signature)
+    assert not verify_signature("secret", body + b" ", signature)
+    assert not verify_signature("other", body, signature)
+    assert not verify_signature("secret", body, None)
+    assert not verify_signature("", body, sign("", body))
+
+
+def test_handle_push_ignores_other_branches():
+    url = "https://api.github.com/repos/example/service1/commits?sha=main"
+    GITHUB_CACHE.set(url, etag="a", last_modified=None, data=[])
+
+    payload = {
+        "ref": "refs/heads/feature",
+        "repository": {"full_name": "example/service1"},
+    }
+    assert handle_push(payload, refresher=None)["github_cache"] == 0
+    assert GITHUB_CACHE.get(url) is not None
+
+    payload["ref"] = "refs/heads/main"
+    payload["repository"]["full_name"] = "Example/Service1"
+    assert handle_push(payload, refresher=None)["github_cache"] == 1
+    assert GITHUB_CACHE.get(url) is None
+
+
+@pytest.mark.parametrize("payload", [{}, [], {"ref": "x", "repository": {}}])
+def test_handle_push_bad_payload(payload):
+    with pytest.raises(WebhookError):
+        handle_push(payload, refresher=None)
+
+
+@pytest.mark.parametrize("payload", [{}, [], {"host": 5, "commit": "a"}])
+def test_handle_deploy_bad_payload(payload):
+    with pytest.raises(WebhookError):
+        handle_deploy(payload, hosts={}, refresher=None)
+
+
+@pytest.mark.parametrize(
+    "host", ["https://dev.example.com", "https://dev.example.com/"]
+)
+def test_handle_deploy_host_with_trailing_slash(host):
+    configured = "https://dev.example.com/"
+    url = f"{configured}/__version__"
+    VERSION_CACHE.set(url, {"commit": "aaa"})
+
+    result = handle_deploy(
+        {"host": host, "commit": "bbb"}, hosts={configured: None}, refresher=None
+    )
+    assert result["host"] == configured
+    assert VERSION_CACHE.get(url) is None
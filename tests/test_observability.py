@@ -0,0 +1,160 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import stamina
+
+from app.libupstream import fetch_version
+from app.observability import (
+    _TIMER,
+    METRICS,
+    MetricsRegistry,
+    RequestTimer,
+    setup_opentelemetry,
+    span,
+)
+
+
+def test_render_prometheus():
+    registry = MetricsRegistry()
+    counter = registry.counter("calls_total", "Calls", labels=("host",))
+    counter.inc(host="a.example.com")
+    counter.inc(2, host="a.example.com")
+    gauge = registry.gauge("in_flight", "In flight")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    registry.collector("ratio", "Ratio", lambda: [({"cache": "version"}, 0.5)])
+
+    assert registry.render_prometheus() == (
+        "# HELP calls_total Calls\n"
+        "# TYPE calls_total counter\n"
+        'calls_total{host="a.example.com"} 3\n'
+        "# HELP in_flight In flight\n"
+        "# TYPE in_flight gauge\n"
+        "in_flight 1\n"
+        "# HELP ratio Ratio\n"
+        "# TYPE ratio gauge\n"
+        'ratio{cache="version"} 0.5\n'
+    )
+
+
+def test_histogram():
+    registry = MetricsRegistry()
+    histogram = registry.histogram(
+        "duration_seconds", "Duration", labels=("route",), buckets=(0.1, 1)
+    )
+    for value in (0.05, 0.5, 0.7, 5):
+        histogram.observe(value, route="/")
+
+    lines = registry.render_prometheus().splitlines()
+    assert lines[2:] == [
+        'duration_seconds_bucket{route="/",le="0.1"} 1',
+        'duration_seconds_bucket{route="/",le="1"} 3',
+        'duration_seconds_bucket{route="/",le="+Inf"} 4',
+        'duration_seconds_sum{route="/"} 6.25',
+        'duration_seconds_count{route="/"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter("calls_total", "Calls", labels=("error",)).inc(error='a "b"')
+    assert 'calls_total{error="a \\"b\\""} 1' in registry.render_prometheus()
+
+
+def test_metrics_page(client, responses):
+    client.get("/__lbheartbeat__")
+
+    resp = client.get("/__metrics__")
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/plain"
+    text = resp.data.decode("utf-8")
+    assert (
+        'http_request_duration_seconds_count{route="/__lbheartbeat__",method="GET",'
+        + 'status="200"}'
+    ) in text
+    assert 'cache_hit_ratio{cache="version"}' in text
+    assert 'github_rate_limit_remaining{api="rest"}' in text
+
+
+def test_metrics_page_disabled(app, client):
+    app.config["APP_METRICS_ENABLED"] = False
+    assert client.get("/__metrics__").status_code == 404
+
+
+def test_upstream_and_retry_metrics(client, responses):
+    responses.get("http://flaky.example.com/__version__", status=503)
+    responses.get("http://flaky.example.com/__version__", json={"commit": "abc"})
+
+    with stamina.set_testing(True, attempts=2):
+        assert fetch_version("http://flaky.example.com") == {"commit": "abc"}
+
+    text = client.get("/__metrics__").data.decode("utf-8")
+    assert (
+        'upstream_request_duration_seconds_count{host="flaky.example.com",'
+        + 'status="503"} 1'
+    ) in text
+    assert 'upstream_retries_total{function="app.libupstream._fetch",' in text
+    assert 'upstream_requests_in_flight{host="flaky.example.com"} 0' in text
+
+
+def test_opentelemetry_export(fake_collector, responses):
+    endpoint = f"http://127.0.0.1:{fake_collector.server_address[1]}"
+    responses.add_passthru(endpoint)
+
+    listeners = len(METRICS._listeners)
+    provider = setup_opentelemetry(endpoint=endpoint, export_interval=60)
+    # Setting up the same endpoint again, like another create_app does, reuses it
+    assert setup_opentelemetry(endpoint=endpoint, export_interval=60) is provider
+    assert len(METRICS._listeners) == listeners + 1
+
+    provider.force_flush()
+    provider.shutdown()
+
+    assert fake_collector.received
+    assert fake_collector.received[0][0] == "/v1/metrics"
+
+
+def test_span_outside_request():
+    with span("version") as current:
+        assert current is None
+
+
+def test_spans_nest_and_sum_by_phase():
+    timer = RequestTimer()
+    token = _TIMER.set(timer)
+    try:
+        with span("config"):
+            pass
+        with span("version", host="a") as outer, span("github") as inner:
+            pass
+        with span("version", host="b"):
+            pass
+    finally:
+        _TIMER.reset(token)
+    timer.finish()
+
+    assert inner.parent_id == outer.span_id
+    assert outer.parent_id is None
+    assert [(name, count) for name, _, count in timer.phases()] == [
+        ("config", 1),
+        ("version", 2),
+        ("github", 1),
+    ]
+
+    header = timer.server_timing()
+    assert header.startswith("config;dur=")
+    assert "version;dur=" in header
+    assert 'desc="2 calls"' in header
+    assert header.split(", ")[-1].startswith("total;dur=")
+
+    data = timer.to_dict()
+    assert data["trace_id"] == timer.trace_id
+    assert [item["name"] for item in data["spans"]] == [
+        "config",
+        "version",
+        "github",
+        "version",
+    ]
+    assert data["spans"][1]["host"] == "a"
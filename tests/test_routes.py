@@ -2,12 +2,20 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import gzip
 import json
+import threading
+import time
 
 import pytest
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import (
+    ExportTraceServiceRequest,
+)
 
 from app import main
 from app.libsystems import Systems
+from app.libupstream import VERSION_CACHE
+from app.libwebhooks import SIGNATURE_HEADER, sign
 
 
 def test_index_page(client, caplog):
@@ -48,7 +56,7 @@ def test_dockerflow_heartbeat(client, responses):
 
     resp = client.get("/__heartbeat__")
     assert resp.status_code == 200
-    assert resp.data == b'{"github":"ok"}\n'
+    assert resp.data == b'{"github":"ok","open_circuits":[]}\n'
 
 
 def test_dockerflow_lbheartbeat(client):
@@ -128,46 +136,52 @@ def fake_systems_data(monkeypatch, responses):
             "build": "https://github.com/example/service1/actions/runs/15555555542",
         },
     )
+    # NOTE(willkg): the deploy status planner fetches recent commits on main once
+    # per repository. Prod's commit is in that list, so its history is worked out
+    # from it. Stage's commit isn't, so stage falls back to the compare above.
     responses.get(
-        url="https://api.github.com/repos/example/service1/compare/bbbbb12345...main",
+        url="https://api.github.com/repos/example/service1/commits?sha=main&per_page=100",
         status=200,
         content_type="application/json",
-        json={
-            "total_commits": 2,
-            "commits": [
-                {
-                    "sha": "ee46327ef8dc59347749b06c60aed07730ed58aa",
-                    "parents": [
-                        # NOTE(willkg): service-deploy-status only looks at the number
-                        # of parents--it doesn't look at the data
-                        {},
-                    ],
-                    "commit": {
-                        "message": (
-                            "chore: updated csp dependency\n\n"
-                            "This version of csp fixes bug 111111."
-                        ),
-                    },
-                    "author": {
-                        "login": "willkg",
-                    },
+        json=[
+            {
+                "sha": "ee46327ef8dc59347749b06c60aed07730ed58aa",
+                "parents": [
+                    # NOTE(willkg): service-deploy-status only looks at the number
+                    # of parents--it doesn't look at the data
+                    {},
+                ],
+                "commit": {
+                    "message": (
+                        "chore: updated csp dependency\n\n"
+                        "This version of csp fixes bug 111111."
+                    ),
                 },
-                {
-                    "sha": "ddb3277c7e6365ac28c61cef8f25c3e295e6329a",
-                    "parents": [
-                        # NOTE(willkg): service-deploy-status only looks at the number
-                        # of parents--it doesn't look at the data
-                        {},
-                    ],
-                    "commit": {
-                        "message": "chore: update README",
-                    },
-                    "author": {
-                        "login": "willkg",
-                    },
+                "author": {
+                    "login": "willkg",
                 },
-            ],
-        },
+            },
+            {
+                "sha": "ddb3277c7e6365ac28c61cef8f25c3e295e6329a",
+                "parents": [{}],
+                "commit": {
+                    "message": "chore: update README",
+                },
+                "author": {
+                    "login": "willkg",
+                },
+            },
+            {
+                "sha": "bbbbb12345",
+                "parents": [{}],
+                "commit": {
+                    "message": "fix: prod release",
+                },
+                "author": {
+                    "login": "willkg",
+                },
+            },
+        ],
     )
 
 
@@ -198,6 +212,119 @@ def test_system_page(client, responses, fake_systems_data):
         assert expected_string in resp.data
 
 
+def test_system_page_server_timing(app, client, responses, fake_systems_data):
+    app.config["APP_STREAM_SYSTEM_PAGE"] = False
+    resp = client.get("/system/exampleapp")
+    assert resp.status_code == 200
+
+    phases = [item.split(";")[0] for item in resp.headers["Server-Timing"].split(", ")]
+    assert phases == ["config", "version", "github", "render", "total"]
+
+
+def test_system_page_trace_export(fake_collector, responses, fake_systems_data):
+    endpoint = f"http://127.0.0.1:{fake_collector.server_address[1]}"
+    responses.add_passthru(endpoint)
+    app = main.create_app(
+        settings_overrides={
+            "TESTING": True,
+            "APP_SNAPSHOT_ENABLED": False,
+            "APP_STREAM_SYSTEM_PAGE": False,
+            "APP_OTEL_ENABLED": True,
+            "APP_OTEL_COLLECTOR_ENDPOINT": endpoint,
+        }
+    )
+    resp = app.test_client().get("/system/exampleapp")
+    assert resp.status_code == 200
+
+    provider = app.extensions["otel_tracer_provider"]
+    provider.force_flush()
+    provider.shutdown()
+    app.extensions["otel_meter_provider"].shutdown()
+
+    spans = {}
+    for path, body in fake_collector.received:
+        if path != "/v1/traces":
+            continue
+        export = ExportTraceServiceRequest.FromString(body)
+        for resource_spans in export.resource_spans:
+            for scope_spans in resource_spans.scope_spans:
+                for otel_span in scope_spans.spans:
+                    spans[otel_span.span_id] = otel_span
+    assert spans
+
+    # The request is the root span and its phases are children of it
+    (root,) = [
+        otel_span for otel_span in spans.values() if not otel_span.parent_span_id
+    ]
+    assert root.name == "GET /system/exampleapp"
+    children = sorted(
+        {
+            otel_span.name
+            for otel_span in spans.values()
+            if otel_span.parent_span_id == root.span_id
+        }
+    )
+    assert children == ["config", "github", "render", "version"]
+
+
+def test_slow_request_log(app, client, responses, fake_systems_data, caplog):
+    app.config["APP_SLOW_REQUEST_THRESHOLD"] = 0
+    resp = client.get("/api/system/exampleapp")
+    assert resp.status_code == 200
+
+    records = [
+        record.message
+        for record in caplog.records
+        if record.message.startswith("slow request: GET /api/system/exampleapp")
+    ]
+    assert len(records) == 1
+    data = json.loads(records[0].split(" ", 5)[-1])
+    assert {item["name"] for item in data["spans"]} == {
+        "config",
+        "version",
+        "github",
+        "serialize",
+    }
+
+
+def test_system_page_streams(client, responses, fake_systems_data):
+    resp = client.get("/system/exampleapp")
+    assert resp.status_code == 200
+
+    chunks = iter(resp.response)
+    head = b""
+    while b"</table>" not in head:
+        head += next(chunks)
+
+    # The overview is sent before anything is fetched
+    assert b'<span id="status-0-1" class="badge text-bg-secondary">' in head
+    assert len(responses.calls) == 0
+
+    rest = b"".join(chunks)
+    assert b"chore: updated csp dependency" in rest
+    assert b'badge.textContent = "2 commits behind";' in rest
+
+
+def test_system_page_streams_errors(client, responses, fake_systems_data):
+    responses.replace(
+        responses.GET, "http://service1.example.com/__version__", status=500
+    )
+    resp = client.get("/system/exampleapp")
+    assert resp.status_code == 200
+    # Prod shows the error and stage still shows its status
+    assert b"500 Server Error" in resp.data
+    assert b'badge.textContent = "unknown";' in resp.data
+    assert b'badge.textContent = "up-to-date";' in resp.data
+
+
+def test_system_page_without_streaming(app, client, responses, fake_systems_data):
+    app.config["APP_STREAM_SYSTEM_PAGE"] = False
+    resp = client.get("/system/exampleapp")
+    assert resp.status_code == 200
+    assert b"2 commits" in resp.data
+    assert b"<script>" not in resp.data
+
+
 def test_system_page_bad_system(client, responses, fake_systems_data, caplog):
     # NOTE(willkg): we want to use the fake system data, but we don't want to enforce
     # that all responses are matched, so we remove the expected responses.
@@ -229,3 +356,280 @@ def test_cpu_intensive_page_with_text(client):
     assert resp.data == (
         b'{"msg":"83b10c5421b8589775ee6eaaa267739ca9d95a41bed8c81167f1a1f73597662c"}\n'
     )
+
+
+def test_cpu_intensive_page_sheds_load(client, monkeypatch):
+    # Every worker is busy and the queue is full
+    pool = main.CPU_POOL
+    monkeypatch.setattr(pool, "_in_flight", pool.max_workers + pool.max_queue)
+
+    resp = client.get("/cpu_intensive")
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+
+
+def test_system_page_caches_versions(client, responses, fake_systems_data):
+    resp = client.get("/system/exampleapp")
+    assert resp.status_code == 200
+    assert b"up-to-date" in resp.data
+
+    # The second page load serves versions from the cache
+    resp = client.get("/system/exampleapp")
+    assert resp.status_code == 200
+    assert b"up-to-date" in resp.data
+    version_calls = [
+        call for call in responses.calls if call.request.url.endswith("/__version__")
+    ]
+    assert len(version_calls) == 2
+
+    resp = client.get("/__stats__")
+    assert resp.status_code == 200
+    stats = json.loads(resp.data)
+    assert stats["version_cache"]["hits"] == 2
+    assert stats["version_cache"]["misses"] == 2
+
+
+def test_api_system(client, responses, fake_systems_data):
+    resp = client.get("/api/system/exampleapp")
+    assert resp.status_code == 200
+    assert resp.headers["Cache-Control"] == "no-cache"
+    etag = resp.headers["ETag"]
+
+    data = json.loads(resp.data)
+    assert data[0]["name"] == "Service 1"
+    stage, prod = data[0]["environments"]
+    assert stage["status"] == "up-to-date"
+    assert prod["status"] == "2 commits behind"
+    assert [commit["sha"] for commit in prod["commits"]] == [
+        "ddb3277c7e6365ac28c61cef8f25c3e295e6329a",
+        "ee46327ef8dc59347749b06c60aed07730ed58aa",
+    ]
+
+    # Nothing changed, so the client's copy is still good
+    resp = client.get("/api/system/exampleapp", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.data == b""
+    assert resp.headers["ETag"] == etag
+
+
+def test_api_system_gzip(app, client, responses, fake_systems_data):
+    app.config["APP_API_GZIP_MIN_SIZE"] = 100
+    resp = client.get("/api/system/exampleapp", headers={"Accept-Encoding": "gzip"})
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.headers["Vary"] == "Accept-Encoding"
+    assert json.loads(gzip.decompress(resp.data))[0]["name"] == "Service 1"
+
+    etag = resp.headers["ETag"]
+    resp = client.get(
+        "/api/system/exampleapp",
+        headers={"Accept-Encoding": "gzip", "If-None-Match": etag},
+    )
+    assert resp.status_code == 304
+
+
+def test_api_system_bad_system(client, responses, fake_systems_data):
+    responses.reset()
+
+    resp = client.get("/api/system/badvalue")
+    assert resp.status_code == 404
+
+
+def test_api_systems(client, responses, fake_systems_data):
+    resp = client.get("/api/systems")
+    assert resp.status_code == 200
+    data = json.loads(resp.data)
+    assert list(data) == ["exampleapp"]
+    assert data["exampleapp"][0]["environments"][0]["status"] == "up-to-date"
+
+    # A different ETag doesn't match
+    resp = client.get("/api/systems", headers={"If-None-Match": '"abc"'})
+    assert resp.status_code == 200
+
+
+def test_overview_page(client, responses, fake_systems_data):
+    resp = client.get("/overview")
+    assert resp.status_code == 200
+    assert b"exampleapp" in resp.data
+    assert b"1 up-to-date" in resp.data
+    assert b"1 behind" in resp.data
+
+
+def test_api_overview(client, responses, fake_systems_data):
+    resp = client.get("/api/overview")
+    assert resp.status_code == 200
+    data = json.loads(resp.data)
+    assert data["summary"] == {
+        "systems": 1,
+        "environments": 2,
+        "hosts": 2,
+        "repos": 1,
+        "statuses": {"up-to-date": 1, "behind": 1, "unknown": 0},
+    }
+    assert [
+        env["status"] for env in data["systems"]["exampleapp"][0]["environments"]
+    ] == [
+        "up-to-date",
+        "2 commits behind",
+    ]
+
+
+def test_system_page_deadline(app, client, monkeypatch, responses):
+    def get_systems_data_mock():
+        return Systems.model_validate(
+            {
+                "systems": {
+                    "exampleapp": {
+                        "services": [
+                            {
+                                "name": "Service 1",
+                                "environments": [
+                                    {"name": "prod", "host": "http://slow.example.com"}
+                                ],
+                            },
+                        ],
+                    },
+                },
+            }
+        )
+
+    monkeypatch.setattr(main, "get_systems_data", get_systems_data_mock)
+    app.config["APP_REQUEST_DEADLINE"] = 0.1
+    app.config["APP_STREAM_SYSTEM_PAGE"] = False
+
+    # There's an expired version from a while ago
+    url = "http://slow.example.com/__version__"
+    VERSION_CACHE._set_local(
+        url,
+        {"source": "https://github.com/example/slow", "commit": "aaaaa12345"},
+        age=100_000,
+    )
+
+    release = threading.Event()
+
+    def slow_version(request):
+        release.wait(timeout=2)
+        return (500, {}, "")
+
+    responses.add_callback(responses.GET, url, callback=slow_version)
+
+    start_time = time.monotonic()
+    resp = client.get("/system/exampleapp")
+    assert time.monotonic() - start_time < 1
+    release.set()
+
+    assert resp.status_code == 200
+    assert b"unknown/stale" in resp.data
+    assert b"deadline of 0.1s exceeded" in resp.data
+    assert b"aaaaa12345" in resp.data
+
+
+def post_webhook(client, path, payload, secret="secret", headers=None):
+    body = json.dumps(payload).encode("utf-8")
+    return client.post(
+        path,
+        data=body,
+        content_type="application/json",
+        headers={SIGNATURE_HEADER: sign(secret, body), **(headers or {})},
+    )
+
+
+def test_webhooks_disabled(client):
+    resp = post_webhook(client, "/webhooks/deploy", {})
+    assert resp.status_code == 404
+
+
+def test_webhook_bad_signature(app, client):
+    app.config["APP_WEBHOOK_SECRET"] = "secret"
+    resp = post_webhook(
+        client, "/webhooks/deploy", {}, secret="wrong", headers={"X-Foo": "bar"}
+    )
+    assert resp.status_code == 401
+
+    resp = client.post("/webhooks/deploy", data=b"{}")
+    assert resp.status_code == 401
+
+
+def test_github_push_webhook(app, client, responses, fake_systems_data):
+    app.config["APP_WEBHOOK_SECRET"] = "secret"
+    resp = client.get("/system/exampleapp")
+    assert resp.status_code == 200
+    assert b"up-to-date" in resp.data
+
+    push = {
+        "ref": "refs/heads/main",
+        "repository": {"full_name": "example/service1"},
+    }
+    resp = post_webhook(
+        client, "/webhooks/github", push, headers={"X-GitHub-Event": "push"}
+    )
+    assert resp.status_code == 200
+    assert json.loads(resp.data) == {
+        "repository": "example/service1",
+        "github_cache": 2,
+        "environments": 0,
+    }
+
+    # The repository's commits are fetched again, but versions are still cached
+    resp = client.get("/system/exampleapp")
+    assert resp.status_code == 200
+    assert b"up-to-date" in resp.data
+    urls = [call.request.url for call in responses.calls]
+    assert len([url for url in urls if "/commits" in url]) == 2
+    assert len([url for url in urls if url.endswith("/__version__")]) == 2
+
+
+def test_github_ping_webhook(app, client):
+    app.config["APP_WEBHOOK_SECRET"] = "secret"
+    resp = post_webhook(
+        client, "/webhooks/github", {"zen": "hi"}, headers={"X-GitHub-Event": "ping"}
+    )
+    assert resp.status_code == 200
+
+
+def test_deploy_webhook(app, client, responses, fake_systems_data):
+    app.config["APP_WEBHOOK_SECRET"] = "secret"
+    resp = client.get("/system/exampleapp")
+    assert resp.status_code == 200
+    assert b"up-to-date" in resp.data
+
+    deploy = {"host": "http://service1.example.com/", "commit": "ccccc12345"}
+    resp = post_webhook(client, "/webhooks/deploy", deploy)
+    assert resp.status_code == 200
+    assert json.loads(resp.data)["host"] == "http://service1.example.com"
+
+    # Only the deployed host's version is invalidated
+    assert VERSION_CACHE.get("http://service1.example.com/__version__") is None
+    assert VERSION_CACHE.get("http://service1-stage.example.com/__version__")
+
+    resp = post_webhook(
+        client, "/webhooks/deploy", {"host": "http://nope.example.com", "commit": "a"}
+    )
+    assert resp.status_code == 400
+    assert json.loads(resp.data) == {"error": "unknown host http://nope.example.com"}
+
+
+def test_static_assets(client):
+    resp = client.get("/")
+    assert resp.status_code == 200
+    html = resp.data.decode("utf-8")
+    start = html.index("/static/bootstrap-5.3.7-dist/bootstrap.min.")
+    url = html[start : html.index('"', start)]
+    assert url != "/static/bootstrap-5.3.7-dist/bootstrap.min.css"
+
+    resp = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert gzip.decompress(resp.data).startswith(b"@charset")
+
+    resp = client.get("/static/bootstrap-5.3.7-dist/bootstrap.min.css")
+    assert resp.status_code == 200
+    assert resp.headers["Cache-Control"] == "no-cache"
+
+    resp = client.get("/static/nope.css")
+    assert resp.status_code == 404
+
+    resp = client.get("/favicon.ico")
+    assert resp.status_code == 200
+    assert resp.mimetype in ("image/vnd.microsoft.icon", "image/x-icon")